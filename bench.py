@@ -0,0 +1,360 @@
+# bench.py — offline load test for main.py (no Telegram connection needed)
+# Drives the real handlers against FakeClient and a temporary SQLite file (or a scratch
+# Postgres database via --postgres), simulating:
+# - N groups on the quiz scheduler (short --interval instead of minutes)
+# - K poll votes per second arriving as UpdateMessagePollVote
+# - a mix of /leaderboard, /myrank, /weekboard, /globalboard and admin commands
+# Reports p50/p95/p99 latency and DB queries per operation; results can be saved as a
+# JSON baseline and compared against a later run.
+#
+#   python bench.py --groups 200 --votes 300 --duration 30 --save bench_results/baseline.json
+#   python bench.py --groups 200 --votes 300 --duration 30 --compare bench_results/baseline.json
+
+import os
+import io
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import contextvars
+import subprocess
+from collections import Counter, defaultdict
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+main = None  # imported in setup_env(), after the environment is prepared
+
+# ---------------- Stand-in Telegram client ----------------
+class FakeClient:
+    # Implements the client surface main.py uses; every RPC sleeps ~rpc_ms to mimic network
+    def __init__(self, rpc_ms: float, admin_id: int):
+        self.rpc = rpc_ms / 1000
+        self.admin_id = admin_id
+        self._msg_id = 0
+        self.calls = Counter()
+        self.poll_votes = defaultdict(dict)  # (chat_id, msg_id) -> {user_id: option}, for GetPollVotes
+
+    async def _rpc(self, name: str):
+        self.calls[name] += 1
+        if self.rpc:
+            await asyncio.sleep(self.rpc * random.uniform(0.5, 1.5))
+
+    def _message(self, chat_id, poll_id=None):
+        self._msg_id += 1
+        media = SimpleNamespace(poll=SimpleNamespace(id=poll_id)) if poll_id else None
+        return SimpleNamespace(id=self._msg_id, chat_id=chat_id, media=media)
+
+    async def __call__(self, request):
+        # raw calls: SendMediaRequest (quiz polls) and, in close scoring mode, GetPollVotesRequest
+        await self._rpc(type(request).__name__)
+        if isinstance(request, main.functions.messages.GetPollVotesRequest):
+            voters = [uid for uid, opt in self.poll_votes[(request.peer, request.id)].items() if opt == request.option]
+            start = int(request.offset or 0)
+            page = voters[start:start + request.limit]
+            nxt = str(start + len(page)) if start + len(page) < len(voters) else None
+            return main.types.messages.VotesList(
+                count=len(voters), votes=[main.types.MessagePeerVote(peer=main.types.PeerUser(uid), option=request.option, date=None) for uid in page],
+                chats=[], users=[main.types.User(id=uid, username=f"user{uid}", first_name=f"User {uid}") for uid in page], next_offset=nxt)
+        return SimpleNamespace(updates=[SimpleNamespace(message=self._message(request.peer, random.getrandbits(62)))])
+
+    async def send_message(self, chat_id, *args, **kwargs):
+        await self._rpc("send_message")
+        return self._message(chat_id)
+
+    async def edit_message(self, *args, **kwargs):
+        await self._rpc("edit_message")
+
+    async def delete_messages(self, chat_id, ids):
+        await self._rpc("delete_messages")
+
+    async def send_file(self, chat_id, *args, **kwargs):
+        await self._rpc("send_file")
+        return self._message(chat_id)
+
+    async def get_me(self):
+        return SimpleNamespace(id=1, username="bench_bot")
+
+    async def get_permissions(self, chat_id, user_id):
+        await self._rpc("get_permissions")
+        return SimpleNamespace(is_admin=user_id == self.admin_id, is_creator=False)
+
+    async def _admins(self, chat_id):
+        await self._rpc("get_participants")
+        user = main.types.User(id=self.admin_id, username="admin", first_name="Admin")
+        user.participant = main.types.ChannelParticipantCreator(user_id=self.admin_id, admin_rights=main.types.ChatAdminRights())
+        yield user
+
+    def iter_participants(self, chat_id, filter=None):
+        return self._admins(chat_id)
+
+    def is_connected(self):
+        return True
+
+class FakeEvent:
+    # Just enough of events.NewMessage.Event for the group command handlers
+    def __init__(self, client: FakeClient, chat_id: int, sender_id: int, text: str, pattern: str):
+        self._client = client
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.is_group = chat_id < 0
+        self.is_private = chat_id > 0
+        self.is_reply = False
+        self.raw_text = text
+        self.message = SimpleNamespace(id=0, sender_id=sender_id, post_author=None, text=text, file=None)
+        self.pattern_match = re.match(pattern, text)
+
+    async def respond(self, *args, **kwargs):
+        await self._client._rpc("respond")
+        return self._client._message(self.chat_id)
+
+# ---------------- Instrumentation ----------------
+_ops: contextvars.ContextVar = contextvars.ContextVar("bench_ops", default=())
+latencies: dict = defaultdict(list)   # op -> [seconds]
+queries: Counter = Counter()          # op -> statements issued while the op was running
+
+def timed(name: str, fn):
+    async def wrapper(*args, **kwargs):
+        token = _ops.set(_ops.get() + (name,))
+        t0 = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            latencies[name].append(time.perf_counter() - t0)
+            _ops.reset(token)
+    return wrapper
+
+def count_query(label, sql, seconds, failed):
+    # main's query hook: attribute each statement to every op on the current stack
+    for op in _ops.get() or ("background",):
+        queries[op] += 1
+
+def instrument():
+    main.add_query_hook(count_query)
+    # module globals are looked up at call time, so main's own callers go through these
+    main.send_quiz_question = timed("send_quiz_question", main.send_quiz_question)
+    main.get_next_question = timed("get_next_question", main.get_next_question)
+
+# ---------------- Load generators ----------------
+COMMANDS = [
+    # (weight, text, pattern, handler name, admin sender)
+    (60, "/leaderboard", r"/leaderboard", "leaderboard", False),
+    (25, "/myrank", r"/myrank", "my_rank", False),
+    (8, "/weekboard", r"/weekboard", "week_board", False),
+    (4, "/globalboard", r"/globalboard", "global_board", False),
+    (5, "/quiznow", r"/quiznow", "quiz_now", True),
+    (5, "/setinterval 30", r"/setinterval (\d+)", "set_interval", True),
+    (3, "/quizstop", r"/quizstop", "quiz_stop", True),
+    (2, "/quizstart", r"/quizstart", "quiz_start", True),
+]
+
+async def seed_db(groups: list, questions: int, label: str):
+    # groups and a question bank of at least `questions` rows, through main's named queries
+    async with main.db_transaction() as conn:
+        await conn.executemany("groups.add", [(g, f"{label.lower()} {g}") for g in groups])
+        have = await conn.fetchval("questions.count")
+        if have < questions:
+            await conn.executemany("questions.insert", [(f"{label} question {i}?", "A", "B", "C", "D", i % 4, label) for i in range(have, questions)])
+    await main.load_group_settings()
+    await main.load_question_bank()
+
+async def paced(rate: float, stop: asyncio.Event, fire):
+    loop = asyncio.get_running_loop()
+    step = 1 / rate
+    next_t = loop.time()
+    while not stop.is_set():
+        fire()
+        next_t += step
+        await asyncio.sleep(max(0.0, next_t - loop.time()))
+
+async def run_load(args, fake: FakeClient) -> dict:
+    types = main.types
+    groups = [-(1000000 + i) for i in range(args.groups)]
+    pending = set()
+
+    def spawn(coro):
+        t = asyncio.create_task(coro)
+        pending.add(t)
+        t.add_done_callback(pending.discard)
+
+    on_vote = timed("on_poll_vote", main.on_poll_vote)
+    votes_sent = 0
+
+    def fire_vote():
+        nonlocal votes_sent
+        polls = list(main._active_polls.values())
+        if not polls:
+            return
+        ap = random.choice(polls)
+        uid = random.randint(2, args.users + 1)
+        option = bytes([65 + random.randrange(4)])
+        fake.poll_votes[(ap.group_id, ap.message_id)].setdefault(uid, option)
+        upd = types.UpdateMessagePollVote(poll_id=int(ap.poll_id), peer=types.PeerUser(uid), options=[option], qts=0)
+        if random.random() < 0.5:
+            upd._entities = {uid: types.User(id=uid, username=f"user{uid}", first_name=f"User {uid}")}
+        votes_sent += 1
+        spawn(on_vote(upd))
+
+    weights = [c[0] for c in COMMANDS]
+    handlers = {c[3]: timed(f"cmd {c[1].split()[0]}", getattr(main, c[3])) for c in COMMANDS}
+
+    def fire_command():
+        _, text, pattern, name, admin = random.choices(COMMANDS, weights)[0]
+        sender = fake.admin_id if admin and random.random() < 0.8 else random.randint(2, args.users + 1)
+        spawn(handlers[name](FakeEvent(fake, random.choice(groups), sender, text, pattern)))
+
+    # seed groups and questions, then schedule every group within the first interval
+    await seed_db(groups, args.questions, "Bench")
+    if not main._question_ids:
+        print("warning: question bank is empty after seeding, no quizzes will be sent", file=sys.stderr)
+    main._interval_delay = lambda minutes: args.interval * random.uniform(0.9, 1.1)
+    now = time.time()
+    for g in groups:
+        main.schedule_group_at(g, now + random.uniform(0, args.interval))
+
+    stop = asyncio.Event()
+    t0 = time.perf_counter()
+    gens = [asyncio.create_task(paced(args.votes, stop, fire_vote))]
+    if args.commands > 0:
+        gens.append(asyncio.create_task(paced(args.commands, stop, fire_command)))
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*gens)
+    if pending:
+        await asyncio.wait(pending)
+    elapsed = time.perf_counter() - t0
+    return {"elapsed_s": round(elapsed, 3), "votes_sent": votes_sent, "votes_per_s": round(votes_sent / elapsed, 1)}
+
+# ---------------- Reporting ----------------
+def percentile(data: list, pct: float) -> float:
+    if not data:
+        return 0.0
+    data = sorted(data)
+    k = max(0, min(len(data) - 1, int(round(pct / 100 * len(data) + 0.5)) - 1))
+    return data[k]
+
+def summarize(args, load: dict, fake: FakeClient, pipeline: dict) -> dict:
+    ops = {}
+    for name, samples in sorted(latencies.items()):
+        n = len(samples)
+        ops[name] = {
+            "count": n,
+            "p50_ms": round(percentile(samples, 50) * 1000, 3),
+            "p95_ms": round(percentile(samples, 95) * 1000, 3),
+            "p99_ms": round(percentile(samples, 99) * 1000, 3),
+            "mean_ms": round(sum(samples) / n * 1000, 3),
+            "max_ms": round(max(samples) * 1000, 3),
+            "db_queries_per_op": round(queries[name] / n, 3),
+        }
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        rev = ""
+    return {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "git": rev, "python": platform.python_version(),
+                 "backend": "postgres" if main.USE_POSTGRES else "sqlite", "args": vars(args)},
+        "load": load,
+        "ops": ops,
+        "background_db_queries": queries["background"],
+        "rpc_calls": dict(fake.calls),
+        "vote_pipeline": pipeline,
+    }
+
+def print_report(result: dict, baseline: dict = None):
+    print(f"\n== bench {result['meta']['git'] or ''} ({result['meta']['backend']}) ==")
+    print(json.dumps(result["load"]))
+    cols = ("count", "p50_ms", "p95_ms", "p99_ms", "max_ms", "db_queries_per_op")
+    print(f"{'op':<24}" + "".join(f"{c:>20}" for c in cols))
+    for name, st in result["ops"].items():
+        base = (baseline or {}).get("ops", {}).get(name)
+        cells = []
+        for c in cols:
+            cell = f"{st[c]}"
+            if base and c != "count" and base.get(c):
+                cell += f" ({(st[c] - base[c]) / base[c] * 100:+.0f}%)"
+            cells.append(f"{cell:>20}")
+        print(f"{name:<24}" + "".join(cells))
+    print(f"background DB statements (vote flusher etc.): {result['background_db_queries']}")
+    print(f"vote pipeline: {json.dumps(result['vote_pipeline'])}")
+    if "outbound" in result:
+        print(f"outbound: {json.dumps(result['outbound'])}")
+
+# ---------------- Entry point ----------------
+def setup_env(args) -> str:
+    global main
+    tmpdir = tempfile.mkdtemp(prefix="quizbench_")
+    os.environ.update({"API_ID": "1", "API_HASH": "bench", "SESSION_NAME": "", "KEEPALIVE_URL": "", "OWNER_ID": "1"})
+    os.environ["SCORING_MODE"] = args.scoring
+    # close mode: polls close after one simulated interval (Telegram's minimum is 5s)
+    os.environ["POLL_CLOSE_SECONDS"] = str(max(5, int(args.interval)))
+    os.environ["ROLLUP_INTERVAL"] = "2"  # so /weekboard and /globalboard have rows within a short run
+    if not args.rate_limits:
+        # simulated intervals are far denser than Telegram allows; measure the bot, not the limiter
+        os.environ.update({"OUTBOUND_RATE": "1e6", "OUTBOUND_GROUP_PER_MIN": "1e8", "OUTBOUND_GROUP_BURST": "1e6", "OUTBOUND_PM_RATE": "1e6"})
+    if args.postgres:
+        os.environ["DATABASE_URL"] = args.postgres
+    else:
+        os.environ.pop("DATABASE_URL", None)
+        os.environ["DB_PATH"] = os.path.join(tmpdir, "bench.db")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as main_module
+    main = main_module
+    return tmpdir
+
+async def bench(args) -> dict:
+    fake = FakeClient(args.rpc_ms, admin_id=1)
+    main.client = fake
+    instrument()
+    log = io.StringIO()
+    with redirect_stdout(log if args.quiet else sys.stdout):
+        await main.start_services()
+        load = await run_load(args, fake)
+        await main.stop_services()
+        pipeline = main.vote_pipeline_stats()
+        outbound = main.outbound_stats()
+    result = summarize(args, load, fake, pipeline)
+    result["outbound"] = outbound
+    return result
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Offline load test for the quiz bot handlers")
+    p.add_argument("--groups", type=int, default=100, help="simulated groups on the scheduler")
+    p.add_argument("--users", type=int, default=2000, help="distinct voters")
+    p.add_argument("--questions", type=int, default=2000, help="question bank size")
+    p.add_argument("--interval", type=float, default=5.0, help="seconds between quizzes per group")
+    p.add_argument("--votes", type=float, default=200.0, help="poll votes per second")
+    p.add_argument("--commands", type=float, default=20.0, help="group commands per second")
+    p.add_argument("--duration", type=float, default=20.0, help="seconds of load")
+    p.add_argument("--rpc-ms", type=float, default=20.0, help="simulated Telegram RPC latency")
+    p.add_argument("--postgres", metavar="URL", help="use this (scratch!) Postgres database instead of a temp SQLite file")
+    p.add_argument("--scoring", choices=("vote", "close"), default="vote", help="SCORING_MODE to run the bot with")
+    p.add_argument("--rate-limits", action="store_true", help="keep the outbound dispatcher's Telegram rate limits (off by default)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--save", metavar="PATH", help="write results JSON here")
+    p.add_argument("--compare", metavar="PATH", help="baseline JSON to diff against")
+    p.add_argument("--verbose", dest="quiet", action="store_false", help="show the bot's own log lines")
+    return p.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    random.seed(args.seed)
+    tmpdir = setup_env(args)
+    try:
+        result = asyncio.run(bench(args))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)  # the temp SQLite DB
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"saved {args.save}")
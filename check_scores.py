@@ -0,0 +1,97 @@
+# check_scores.py — consistency check for the vote flusher and the in-memory leaderboards
+# Runs random vote batches (repeat voters, streak resets, profile changes) through the
+# real _flush_votes on a temporary SQLite file (or a scratch Postgres database via
+# --postgres) and checks that every loaded board in _boards matches its players.group
+# rows, so a change to the players upsert or to apply_board_deltas can't drift apart.
+# Lists the mismatching rows and exits non-zero if any board differs.
+#
+#   python check_scores.py
+#   python check_scores.py --batches 500 --seed 7
+
+import sys
+import random
+import shutil
+import asyncio
+import argparse
+
+import bench
+
+def random_batch(args, names: dict) -> list:
+    main = bench.main
+    batch = []
+    for _ in range(random.randint(1, args.max_batch)):
+        uid = random.randint(1, args.users)
+        changed = random.random() < 0.1
+        if changed or uid not in names:
+            names[uid] = (random.choice([None, f"user{uid}_{random.getrandbits(16):x}"]), f"User {uid}")
+        username, first_name = names[uid]
+        gid = -random.randint(1, args.groups)
+        batch.append(main.Vote(uid, gid, username, first_name, random.random() < 0.6, changed))
+    return batch
+
+async def compare(group_id: int, board) -> list:
+    main = bench.main
+    rows = await main.db_fetch("players.group", group_id)
+    db = {int(r[0]): [r[1], r[2], int(r[3]), int(r[4]), int(r[5]), int(r[6]), int(r[7])] for r in rows}
+    problems = []
+    for uid in sorted(set(db) | set(board.players)):
+        if db.get(uid) != board.players.get(uid):
+            problems.append(f"group {group_id} user {uid}: db {db.get(uid)} board {board.players.get(uid)}")
+    if board.order != sorted(board.key(uid, p) for uid, p in board.players.items()):
+        problems.append(f"group {group_id}: board order out of sync with its players")
+    return problems
+
+async def check(args) -> list:
+    main = bench.main
+    await main.init_db()
+    try:
+        # half the groups have a board loaded before any votes (kept current by deltas),
+        # the rest load one part-way through, after some of their rows were written
+        groups = [-g for g in range(1, args.groups + 1)]
+        for gid in groups[::2]:
+            await main.get_board(gid)
+        names = {}
+        for i in range(args.batches):
+            await main._flush_votes(random_batch(args, names))
+            if i == args.batches // 2:
+                for gid in groups[1::2]:
+                    await main.get_board(gid)
+            if random.random() < 0.05:
+                gid = random.choice(groups)
+                main.drop_board(gid)  # as on a lost lease; reloaded from the rows written so far
+                await main.get_board(gid)
+        problems = []
+        for gid, board in sorted(main._boards.items()):
+            problems += await compare(gid, board)
+        stats = main.vote_pipeline_stats()
+        print(f"{args.batches} batches, {stats['flushed']} votes, {stats['rows']} player rows written, "
+              f"{len(main._boards)} boards checked, {stats['errors']} flush errors")
+        return problems
+    finally:
+        await main.close_db()
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Check that the in-memory leaderboards match the players table after random vote batches")
+    p.add_argument("--batches", type=int, default=200, help="vote batches to flush")
+    p.add_argument("--max-batch", type=int, default=80, help="largest batch")
+    p.add_argument("--groups", type=int, default=8)
+    p.add_argument("--users", type=int, default=150, help="distinct voters (few, so batches repeat them)")
+    p.add_argument("--postgres", metavar="URL", help="use this (scratch!) Postgres database instead of a temp SQLite file")
+    p.add_argument("--seed", type=int, default=1)
+    args = p.parse_args(argv)
+    args.scoring, args.interval, args.rate_limits = "vote", 5.0, False  # what bench.setup_env reads
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    random.seed(args.seed)
+    tmpdir = bench.setup_env(args)
+    try:
+        problems = asyncio.run(check(args))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)  # the temp SQLite DB
+    for line in problems[:20]:
+        print(line)
+    if problems:
+        sys.exit(f"{len(problems)} mismatches between players and _boards")
+    print("boards match players")
@@ -1,23 +1,43 @@
 # main.py — NK Quiz Bot (Dual DB: Supabase Postgres or local SQLite)
-# Telethon 1.34.0 + Flask keep-alive + aiosqlite/asyncpg
+# Telethon 1.34.0 + aiohttp health/status server + aiosqlite/asyncpg
 # Features:
 # - Dual-mode DB: use POSTGRES if DATABASE_URL provided, else fallback to SQLite
-# - Same quiz features: per-group scheduler, polls (Telethon), leaderboard, admin checks
+# - Same quiz features: central heap scheduler, polls (Telethon), leaderboard, admin checks
 # - Robust PM vs Group replies, owner-only commands, broadcast flow, inline add-to-group button
 # - Uses async DB drivers: asyncpg (Postgres) and aiosqlite (SQLite)
+# - Prometheus metrics (handler, DB statement, RPC and scheduler timings) on /metrics
+# - One prioritized outbound queue (polls > replies > deletes > bulk) under Telegram's global and per-chat limits
+# - Optional close-time scoring (SCORING_MODE=close): each poll is scored in one write when it closes
+# - Optional multi-worker mode (SHARDING=1, Postgres): groups split across workers via heartbeated leases
 
 import os
+import time
 import asyncio
 import random
 import json
-from datetime import datetime
-from typing import Optional, Tuple
+import heapq
+import csv
+import hashlib
+import tempfile
+import bisect
+import re
+import itertools
+import socket
+import functools
+import signal
+import contextvars
+import cProfile
+import pstats
+import io
+import hmac
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import NamedTuple, Optional, Tuple
 
-from flask import Flask
-import multiprocessing
 import aiohttp
+from aiohttp import web
 
-from telethon import TelegramClient, events, Button
+from telethon import TelegramClient, events, Button, errors
 from telethon.tl import functions, types
 from telethon.utils import get_peer_id
 
@@ -42,6 +62,56 @@ DB_URL = os.environ.get("DATABASE_URL")  # Supabase connection string
 DB_PATH = os.environ.get("DB_PATH", "quiz_bot.db")  # fallback file path for sqlite
 KEEPALIVE_URL = os.environ.get("KEEPALIVE_URL", "")
 KEEPALIVE_INTERVAL = int(os.environ.get("KEEPALIVE_INTERVAL", 240))
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))  # asyncpg pool size bounds
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_ACQUIRE_TIMEOUT = float(os.environ.get("DB_ACQUIRE_TIMEOUT", 30))  # seconds to wait for a free connection
+DB_READ_URL = os.environ.get("DATABASE_READ_URL")  # optional Postgres read replica for lag-tolerant reads
+READ_YOUR_WRITES_SECONDS = float(os.environ.get("READ_YOUR_WRITES_SECONDS", 10))  # reads of a group written this recently go to the primary
+REPLICA_RETRY_SECONDS = float(os.environ.get("REPLICA_RETRY_SECONDS", 30))  # after a replica failure, reads use the primary this long
+SQLITE_MMAP_MB = int(os.environ.get("SQLITE_MMAP_MB", 256))  # sqlite memory-mapped I/O window; 0 disables
+DB_VACUUM_ON_START = os.environ.get("DB_VACUUM_ON_START", "").lower() in ("1", "true", "yes")  # VACUUM (ANALYZE) at startup
+VOTE_QUEUE_MAX = int(os.environ.get("VOTE_QUEUE_MAX", 10000))  # pending votes before backpressure kicks in
+VOTE_QUEUE_POLICY = os.environ.get("VOTE_QUEUE_POLICY", "block")  # block: handler waits for room | drop: discard vote
+VOTE_FLUSH_MS = int(os.environ.get("VOTE_FLUSH_MS", 250))  # max time a vote waits before its batch is written
+VOTE_BATCH_MAX = int(os.environ.get("VOTE_BATCH_MAX", 500))  # max votes per write transaction
+QUIZ_SEND_CONCURRENCY = int(os.environ.get("QUIZ_SEND_CONCURRENCY", 8))  # scheduled sends running at once
+SCHED_JITTER_SECONDS = float(os.environ.get("SCHED_JITTER_SECONDS", 30))  # +/- spread applied to each next fire time
+SHUTDOWN_GRACE = float(os.environ.get("SHUTDOWN_GRACE", 20))  # seconds in-flight quiz sends get to finish on SIGTERM
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", 50000))  # user profiles kept in memory
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", 3600))  # seconds before a cached profile is re-checked
+ROLLUP_INTERVAL = float(os.environ.get("ROLLUP_INTERVAL", 60))  # seconds between answer-log rollups (weekly/global boards lag by up to this)
+ROLLUP_BATCH = int(os.environ.get("ROLLUP_BATCH", 50000))  # answer-log rows folded into the rollups per transaction
+ANSWER_LOG_DAYS = int(os.environ.get("ANSWER_LOG_DAYS", 7))  # raw answers kept this long after they are rolled up
+ROLLUP_DAILY_DAYS = int(os.environ.get("ROLLUP_DAILY_DAYS", 90))  # per-group daily aggregates kept this long
+ADMIN_CACHE_SIZE = int(os.environ.get("ADMIN_CACHE_SIZE", 20000))  # cached admin lists / (chat, user) permission entries
+ADMIN_CACHE_TTL = float(os.environ.get("ADMIN_CACHE_TTL", 600))  # seconds; participant updates invalidate earlier
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", 8))  # concurrent senders per broadcast job
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))  # messages per second across all broadcasts
+BROADCAST_PAGE = int(os.environ.get("BROADCAST_PAGE", 500))  # recipient ids read (and checkpointed) per page
+BROADCAST_PROGRESS_SECONDS = float(os.environ.get("BROADCAST_PROGRESS_SECONDS", 5))  # min gap between status edits
+IMPORT_BATCH = int(os.environ.get("IMPORT_BATCH", 2000))  # questions per insert batch for /importq (and page size for /exportq)
+WEB_PORT = int(os.environ.get("PORT", 10000))  # health / status / metrics HTTP server
+READY_MAX_SCHED_LAG = float(os.environ.get("READY_MAX_SCHED_LAG", 120))  # seconds overdue before /ready fails
+READY_DB_TIMEOUT = float(os.environ.get("READY_DB_TIMEOUT", 2))  # seconds for the /ready DB ping
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")  # enables GET /debug/profile?seconds=N (Authorization: Bearer <token>)
+PROFILE_MAX_SECONDS = int(os.environ.get("PROFILE_MAX_SECONDS", 300))  # longest /profile session
+CAPTURE_PATH = os.environ.get("CAPTURE_PATH", "")  # append incoming votes/commands (anonymized JSONL) here, for replay.py
+CAPTURE_MAX_EVENTS = int(os.environ.get("CAPTURE_MAX_EVENTS", 1000000))  # capture stops itself after this many records
+SHARDING = os.environ.get("SHARDING", "").lower() in ("1", "true", "yes")  # split groups across worker processes (Postgres only)
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"  # must be unique per worker
+LEASE_TTL = float(os.environ.get("LEASE_TTL", 30))  # seconds without a heartbeat before a worker's groups move
+LEASE_HEARTBEAT = float(os.environ.get("LEASE_HEARTBEAT", 10))  # seconds between heartbeats (keep well under LEASE_TTL)
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 500))  # log statements slower than this; 0 disables
+SCORING_MODE = os.environ.get("SCORING_MODE", "vote")  # vote: score each vote as it arrives | close: score each poll once, when it closes
+POLL_CLOSE_SECONDS = int(os.environ.get("POLL_CLOSE_SECONDS", 600))  # close mode: how long a poll stays open (Telegram allows 5..600)
+FLOOD_SLEEP_THRESHOLD = int(os.environ.get("FLOOD_SLEEP_THRESHOLD", 60))  # flood waits up to this many seconds are slept and retried
+OUTBOUND_RATE = float(os.environ.get("OUTBOUND_RATE", 30))  # outgoing messages per second, whole bot (Telegram: ~30/s)
+OUTBOUND_GROUP_PER_MIN = float(os.environ.get("OUTBOUND_GROUP_PER_MIN", 20))  # messages per minute into one group (Telegram: 20/min)
+OUTBOUND_GROUP_BURST = float(os.environ.get("OUTBOUND_GROUP_BURST", 3))  # back-to-back messages a quiet group may get
+OUTBOUND_PM_RATE = float(os.environ.get("OUTBOUND_PM_RATE", 1))  # messages per second into one private chat (Telegram: ~1/s)
+OUTBOUND_CONCURRENCY = int(os.environ.get("OUTBOUND_CONCURRENCY", 16))  # outgoing requests in flight at once
+OUTBOUND_MAX_FLOOD_WAIT = int(os.environ.get("OUTBOUND_MAX_FLOOD_WAIT", 300))  # longer flood waits fail the message instead of rescheduling it
+OUTBOUND_CHAT_QUEUE = int(os.environ.get("OUTBOUND_CHAT_QUEUE", 100))  # calls queued per chat before deletes / broadcast messages are shed
 
 USE_POSTGRES = bool(DB_URL)
 if USE_POSTGRES and asyncpg is None:
@@ -49,13 +119,489 @@ if USE_POSTGRES and asyncpg is None:
 if (not USE_POSTGRES) and aiosqlite is None:
     # aiosqlite useful for async sqlite; if missing we'll try to import sync sqlite later
     raise RuntimeError("aiosqlite not installed. Add aiosqlite to requirements or set DATABASE_URL.")
+if SCORING_MODE not in ("vote", "close"):
+    raise RuntimeError("SCORING_MODE must be 'vote' or 'close'.")
+if DB_READ_URL and not USE_POSTGRES:
+    print("[DB] DATABASE_READ_URL needs DATABASE_URL (Postgres); ignoring it")
+    DB_READ_URL = None
+if SHARDING and not USE_POSTGRES:
+    print("[SHARD] SHARDING needs DATABASE_URL (Postgres); running as a single worker")
+    SHARDING = False
+
+# ---------------- Metrics ----------------
+# In-process counters, gauges and histograms, rendered in the Prometheus text format by
+# render_metrics() and served at /metrics by the web server. Labels are passed as keyword arguments.
+_METRICS: list = []
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _label_value(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(key: tuple, extra: str = "") -> str:
+    parts = [f'{k}="{_label_value(v)}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, doc: str):
+        self.name, self.doc = name, doc
+        self.values: dict = {}
+        _METRICS.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(k)} {v}" for k, v in self.values.items()]
+        return lines
+
+class Gauge:
+    # value is read when scraped: fn() returns a number
+    def __init__(self, name: str, doc: str, fn):
+        self.name, self.doc, self.fn = name, doc, fn
+        _METRICS.append(self)
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge", f"{self.name} {self.fn()}"]
+
+class Histogram:
+    def __init__(self, name: str, doc: str, buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.buckets = name, doc, tuple(buckets)
+        self.series: dict = {}  # label key -> [count per bucket (last is +Inf)..., sum]
+        _METRICS.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        s = self.series.get(key)
+        if s is None:
+            s = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, s in self.series.items():
+            total = 0
+            for le, n in zip(self.buckets + ("+Inf",), s):
+                total += n
+                bound = 'le="%s"' % le
+                lines.append(f"{self.name}_bucket{_labels(key, bound)} {total}")
+            lines.append(f"{self.name}_sum{_labels(key)} {s[-1]}")
+            lines.append(f"{self.name}_count{_labels(key)} {total}")
+        return lines
+
+HANDLER_SECONDS = Histogram("quizbot_handler_seconds", "Event handler latency")
+HANDLER_ERRORS = Counter("quizbot_handler_errors_total", "Event handlers that raised")
+DB_QUERY_SECONDS = Histogram("quizbot_db_query_seconds", "Database statement latency (count = statements run)")
+DB_QUERY_ERRORS = Counter("quizbot_db_query_errors_total", "Database statements that raised")
+RPC_SECONDS = Histogram("quizbot_rpc_seconds", "Telegram RPC latency per request type")
+RPC_ERRORS = Counter("quizbot_rpc_errors_total", "Telegram RPCs that raised (flood waits excluded)")
+RPC_FLOOD_WAITS = Counter("quizbot_rpc_flood_waits_total", "FLOOD_WAIT errors per request type")
+DB_READ_ROUTES = Counter("quizbot_db_read_routes_total", "Replica-eligible reads by route (replica, primary, read_your_writes, fallback)")
+SCHED_LAG_SECONDS = Histogram("quizbot_scheduler_lag_seconds", "Scheduled quiz send start minus planned fire time")
+OUTBOUND_WAIT_SECONDS = Histogram("quizbot_outbound_wait_seconds", "Time an outgoing message waited in the dispatcher queue, per priority class", LATENCY_BUCKETS + (60.0, 120.0, 300.0))
+OUTBOUND_RESCHEDULED = Counter("quizbot_outbound_rescheduled_total", "Outgoing messages requeued after a FloodWait, per priority class")
+OUTBOUND_FAILED = Counter("quizbot_outbound_failed_total", "Outgoing messages that raised, per priority class")
+# gauges read module state defined further down at scrape time
+Gauge("quizbot_db_connections_in_use", "Borrowed DB connections", lambda: _db_stats["in_use"])
+Gauge("quizbot_db_acquire_waiting", "Tasks waiting for a DB connection", lambda: _db_stats["waiting"])
+Gauge("quizbot_vote_queue_depth", "Votes waiting to be written", lambda: _vote_queue.qsize() if _vote_queue else 0)
+Gauge("quizbot_scheduled_groups", "Groups on the quiz scheduler", lambda: len(_sched_due))
+Gauge("quizbot_active_polls", "Open quiz polls", lambda: len(_active_polls))
+Gauge("quizbot_outbound_queue_depth", "Outgoing messages waiting in the dispatcher", lambda: _out_stats["queued"])
+Gauge("quizbot_live_workers", "Live workers sharing the groups (1 when not sharded)", lambda: len(_workers) if SHARDING else 1)
+
+def render_metrics() -> str:
+    lines = []
+    for m in _METRICS:
+        lines += m.render()
+    return "\n".join(lines) + "\n"
+
+def instrumented(handler):
+    # Times a coroutine function (event handler, send path) into quizbot_handler_seconds
+    name = handler.__name__
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, handler=name)
+    return wrapper
+
+_query_labels: dict = {}
+_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+(\w+)", re.I)
+
+def query_label(sql: str) -> str:
+    # "select players", "insert questions", "begin": low-cardinality label for a statement
+    label = _query_labels.get(sql)
+    if label is None:
+        words = sql.split(None, 1)
+        verb = words[0].lower() if words else "?"
+        m = _TABLE_RE.search(sql)
+        label = f"{verb} {m.group(1).lower()}" if m else verb
+        if len(_query_labels) < 4096:
+            _query_labels[sql] = label
+    return label
 
 # ---------------- TELEGRAM CLIENT ----------------
-client = TelegramClient("quiz_bot", API_ID, API_HASH).start(bot_token=BOT_TOKEN)
+# Set inside outbound dispatcher tasks: a FloodWait is raised to the dispatcher, which
+# requeues the message, instead of being slept here while holding a dispatcher slot
+_no_flood_sleep = contextvars.ContextVar("no_flood_sleep", default=False)
+
+class InstrumentedClient(TelegramClient):
+    # Times every request and counts flood waits. Telethon's own flood sleeping is turned off
+    # (flood_sleep_threshold=0) and done here instead, so short waits are counted too.
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        method = "batch" if isinstance(request, (list, tuple)) else type(request).__name__
+        threshold = FLOOD_SLEEP_THRESHOLD if flood_sleep_threshold is None else flood_sleep_threshold
+        if _no_flood_sleep.get():
+            threshold = 0
+        while True:
+            t0 = time.perf_counter()
+            try:
+                return await super()._call(sender, request, ordered=ordered)
+            except errors.FloodWaitError as e:
+                RPC_FLOOD_WAITS.inc(method=method)
+                if e.seconds > threshold:
+                    raise
+                wait = max(1, e.seconds)
+            except Exception:
+                RPC_ERRORS.inc(method=method)
+                raise
+            finally:
+                RPC_SECONDS.observe(time.perf_counter() - t0, method=method)
+            print(f"[RPC] flood wait {wait}s on {method}")
+            await asyncio.sleep(wait)
+
+# Not connected at import time: __main__ calls client.start(), so tools (bench.py) can import
+# this module and drive the handlers against a stand-in client. SESSION_NAME="" keeps the
+# session in memory.
+SESSION_NAME = os.environ.get("SESSION_NAME", "quiz_bot")
+client = InstrumentedClient(SESSION_NAME or None, API_ID, API_HASH, flood_sleep_threshold=0)
 BOT_USERNAME = None
 
-# Scheduler tasks
-_group_tasks: dict[int, asyncio.Task] = {}
+# ---------------- Outbound dispatcher ----------------
+# Every message the bot sends goes through one dispatcher: outbound(chat_id, prio, fn) queues
+# fn (a coroutine function making one Telegram call into chat_id) and returns its result.
+# Each chat has a heap of pending calls ordered by (priority, arrival) and its own token
+# bucket (OUTBOUND_GROUP_PER_MIN for groups, OUTBOUND_PM_RATE for private chats); the bot
+# as a whole has one more (OUTBOUND_RATE). The loop always starts the best-priority head
+# among chats whose bucket has a token, so a backlog of replies or broadcast messages never
+# holds up a quiz poll. A FloodWait pauses only that chat and requeues the call in place.
+# Telethon remembers a flood wait per request type and raises it again, without a network
+# call, for every chat that makes the same kind of request before it ends; those re-raised
+# waits hold just that call until the wait is over instead of pausing each chat in turn.
+# A chat with OUTBOUND_CHAT_QUEUE calls queued sheds its newest delete / broadcast call.
+class TokenBucket:
+    # rate tokens/second with a burst allowance; pause() stops everyone (FloodWait)
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def peek(self) -> float:
+        # seconds until a token is available (0 = now)
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> float:
+        # take a token if one is available; else return the seconds until there is one
+        wait = self.peek()
+        if wait == 0:
+            self.tokens -= 1
+        return wait
+
+    def idle(self) -> bool:
+        # full and not paused: indistinguishable from a new bucket
+        return self.peek() == 0 and self.tokens >= self.burst
+
+    async def acquire(self):
+        async with self._lock:
+            while (wait := self.take()) > 0:
+                await asyncio.sleep(wait)
+
+PRIO_POLL, PRIO_REPLY, PRIO_DELETE, PRIO_BULK = range(4)
+PRIO_NAMES = ("poll", "reply", "delete", "bulk")
+_PRIO_CHAT_COST = (1, 1, 0, 1)  # deletes don't count against a chat's message limit
+
+class _OutItem:
+    __slots__ = ("prio", "seq", "chat_id", "fn", "future", "queued_at")
+
+    def __init__(self, prio: int, seq: int, chat_id: int, fn, future):
+        self.prio, self.seq, self.chat_id, self.fn, self.future = prio, seq, chat_id, fn, future
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.prio, self.seq) < (other.prio, other.seq)
+
+class _OutChat:
+    __slots__ = ("queue", "bucket", "gen", "where", "running")
+
+    def __init__(self, chat_id: int):
+        self.queue: list[_OutItem] = []
+        if chat_id < 0:
+            self.bucket = TokenBucket(OUTBOUND_GROUP_PER_MIN / 60, OUTBOUND_GROUP_BURST)
+        else:
+            self.bucket = TokenBucket(OUTBOUND_PM_RATE, 1)
+        self.gen = 0       # bumped on every (re)schedule; older heap entries are stale
+        self.where = None  # "ready" / "sleeping": the heap holding the live entry
+        self.running = 0
+
+_out_chats: dict[int, _OutChat] = {}
+_out_ready: list = []     # (prio, seq, gen, chat_id): head call of a chat that may be sent now
+_out_sleeping: list = []  # (ready_at, gen, chat_id): chats waiting on their bucket or a FloodWait
+_out_global = TokenBucket(OUTBOUND_RATE, max(1.0, OUTBOUND_RATE))
+_out_seq = itertools.count()
+_out_wakeup = asyncio.Event()
+_out_task: Optional[asyncio.Task] = None
+_out_sem: Optional[asyncio.Semaphore] = None
+_out_running: set = set()
+_out_stats = {"queued": 0, "sent": 0, "failed": 0, "rescheduled": 0, "held": 0, "shed": 0}
+_out_type_waits: dict[str, float] = {}      # request type -> monotonic end of its flood wait
+_out_held: dict[str, list[_OutItem]] = {}   # request type -> calls waiting out that flood wait
+
+def _out_ready_push(chat_id: int, chat: _OutChat):
+    chat.gen += 1
+    chat.where = "ready"
+    head = chat.queue[0]
+    heapq.heappush(_out_ready, (head.prio, head.seq, chat.gen, chat_id))
+    _out_wakeup.set()
+
+def _out_sleep_push(chat_id: int, chat: _OutChat, delay: float):
+    chat.gen += 1
+    chat.where = "sleeping"
+    heapq.heappush(_out_sleeping, (time.monotonic() + delay, chat.gen, chat_id))
+    _out_wakeup.set()
+
+def _out_enqueue(item: _OutItem):
+    chat = _out_chats.get(item.chat_id)
+    if chat is None:
+        chat = _out_chats[item.chat_id] = _OutChat(item.chat_id)
+    idle = not chat.queue
+    heapq.heappush(chat.queue, item)
+    _out_stats["queued"] += 1
+    if idle:
+        wait = chat.bucket.peek()
+        if wait > 0:
+            _out_sleep_push(item.chat_id, chat, wait)
+        else:
+            _out_ready_push(item.chat_id, chat)
+    elif chat.queue[0] is item and chat.where == "ready":
+        _out_ready_push(item.chat_id, chat)  # new head: re-key (sleeping chats read the head on wake)
+
+def _out_shed(item: _OutItem) -> bool:
+    # a full chat queue drops its newest low-priority call; False if that is item itself
+    chat = _out_chats.get(item.chat_id)
+    if chat is None or len(chat.queue) < OUTBOUND_CHAT_QUEUE:
+        return True
+    victim = max(chat.queue)
+    if item.prio >= victim.prio:
+        victim = item
+    if victim.prio < PRIO_DELETE:
+        return True  # only polls and replies queued: never shed those
+    _out_stats["shed"] += 1
+    OUTBOUND_FAILED.inc(prio=PRIO_NAMES[victim.prio])
+    if not victim.future.done():
+        victim.future.set_exception(RuntimeError(f"outbound queue for {item.chat_id} is full"))
+    if victim is item:
+        return False
+    chat.queue.remove(victim)
+    heapq.heapify(chat.queue)
+    _out_stats["queued"] -= 1
+    return True
+
+def outbound_nowait(chat_id: int, prio: int, fn) -> asyncio.Future:
+    # queue fn() and return a future for its result
+    if _out_task is None:
+        return asyncio.ensure_future(fn())  # dispatcher not running (tools, shutdown): call straight through
+    future = asyncio.get_running_loop().create_future()
+    item = _OutItem(prio, next(_out_seq), chat_id, fn, future)
+    if _out_shed(item):
+        _out_enqueue(item)
+    return future
+
+async def outbound(chat_id: int, prio: int, fn):
+    return await outbound_nowait(chat_id, prio, fn)
+
+def outbound_background(chat_id: int, prio: int, fn):
+    # fire and forget (deletes): failures are counted, not raised
+    outbound_nowait(chat_id, prio, fn).add_done_callback(lambda f: f.cancelled() or f.exception())
+
+async def respond(event, *args, **kwargs):
+    # event.respond() as a command reply through the dispatcher
+    return await outbound(event.chat_id, PRIO_REPLY, functools.partial(event.respond, *args, **kwargs))
+
+def _out_hold(rtype: str, item: _OutItem):
+    # park item until rtype's flood wait ends; the first call parked arms the release
+    held = _out_held.setdefault(rtype, [])
+    if not held:
+        delay = _out_type_waits[rtype] - time.monotonic() + 1
+        asyncio.get_running_loop().call_later(max(delay, 0), _out_release, rtype)
+    held.append(item)
+    _out_stats["held"] += 1
+
+def _out_release(rtype: str):
+    _out_type_waits.pop(rtype, None)
+    for item in _out_held.pop(rtype, []):
+        _out_stats["held"] -= 1
+        if not item.future.done():
+            item.queued_at = time.monotonic()
+            _out_enqueue(item)
+
+async def _out_run(chat_id: int, chat: _OutChat, item: _OutItem):
+    _no_flood_sleep.set(True)
+    name = PRIO_NAMES[item.prio]
+    try:
+        result = await item.fn()
+    except errors.FloodWaitError as e:
+        rtype = type(e.request).__name__ if e.request is not None else None
+        until = _out_type_waits.get(rtype, 0.0)
+        remaining = until - time.monotonic()
+        if e.seconds > OUTBOUND_MAX_FLOOD_WAIT:
+            _out_fail(item, name, e)
+        elif rtype and remaining > 0 and abs(e.seconds - remaining) <= 2:
+            # Telethon re-raising a wait already seen in another chat: the wait is on the
+            # request type, not on this chat, so only this call sits it out
+            _out_hold(rtype, item)
+        else:
+            if rtype:
+                _out_type_waits[rtype] = max(until, time.monotonic() + e.seconds)
+            # pause just this chat; the call keeps its place in the chat's queue
+            _out_stats["rescheduled"] += 1
+            OUTBOUND_RESCHEDULED.inc(prio=name)
+            print(f"[OUT] flood wait {e.seconds}s in {chat_id}, {name} requeued")
+            chat.bucket.pause(e.seconds + 1)
+            item.queued_at = time.monotonic()
+            _out_enqueue(item)
+    except asyncio.CancelledError:
+        item.future.cancel()
+        raise
+    except Exception as e:
+        _out_fail(item, name, e)
+    else:
+        _out_stats["sent"] += 1
+        if not item.future.done():
+            item.future.set_result(result)
+    finally:
+        chat.running -= 1
+        _out_sem.release()
+
+def _out_fail(item: _OutItem, name: str, exc: BaseException):
+    _out_stats["failed"] += 1
+    OUTBOUND_FAILED.inc(prio=name)
+    if not item.future.done():
+        item.future.set_exception(exc)
+
+def _out_prune():
+    # forget chats with nothing queued or running and a full bucket
+    for cid in [c for c, ch in _out_chats.items() if not ch.queue and not ch.running and ch.bucket.idle()]:
+        del _out_chats[cid]
+
+async def _outbound_loop():
+    last_prune = time.monotonic()
+    while True:
+        now = time.monotonic()
+        while _out_sleeping and _out_sleeping[0][0] <= now:
+            _, gen, cid = heapq.heappop(_out_sleeping)
+            chat = _out_chats.get(cid)
+            if chat is not None and chat.gen == gen and chat.queue:
+                _out_ready_push(cid, chat)
+        if now - last_prune > 60:
+            _out_prune()
+            last_prune = now
+        if not _out_ready:
+            timeout = _out_sleeping[0][0] - now if _out_sleeping else None
+            _out_wakeup.clear()
+            try:
+                await asyncio.wait_for(_out_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        wait = _out_global.peek()
+        if wait > 0:
+            await asyncio.sleep(wait)
+            continue
+        await _out_sem.acquire()
+        prio, seq, gen, cid = heapq.heappop(_out_ready)
+        chat = _out_chats.get(cid)
+        if chat is None or chat.gen != gen or not chat.queue:
+            _out_sem.release()
+            continue  # stale entry
+        item = chat.queue[0]
+        if _PRIO_CHAT_COST[item.prio]:
+            wait = chat.bucket.take()
+            if wait > 0:
+                _out_sem.release()
+                _out_sleep_push(cid, chat, wait)
+                continue
+        _out_global.take()
+        heapq.heappop(chat.queue)
+        _out_stats["queued"] -= 1
+        if chat.queue:
+            _out_ready_push(cid, chat)
+        else:
+            chat.gen += 1
+            chat.where = None
+        if item.future.done():
+            _out_sem.release()
+            continue  # caller gave up waiting
+        OUTBOUND_WAIT_SECONDS.observe(now - item.queued_at, prio=PRIO_NAMES[item.prio])
+        chat.running += 1
+        task = asyncio.create_task(_out_run(cid, chat, item))
+        _out_running.add(task)
+        task.add_done_callback(_out_running.discard)
+
+async def start_outbound():
+    global _out_task, _out_sem
+    _out_sem = asyncio.Semaphore(OUTBOUND_CONCURRENCY)
+    _out_task = asyncio.create_task(_outbound_loop())
+
+async def stop_outbound():
+    # send what is queued (up to SHUTDOWN_GRACE), then fail the rest
+    global _out_task
+    if _out_task is None:
+        return
+    deadline = time.monotonic() + SHUTDOWN_GRACE
+    while (_out_stats["queued"] or _out_held or _out_running) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    _out_task.cancel()
+    _out_task = None
+    for t in list(_out_running):
+        t.cancel()
+    dropped = 0
+    for chat in _out_chats.values():
+        for item in chat.queue:
+            item.future.cancel()
+            dropped += 1
+        chat.queue.clear()
+    for held in _out_held.values():
+        for item in held:
+            item.future.cancel()
+            dropped += 1
+    _out_chats.clear(); _out_ready.clear(); _out_sleeping.clear()
+    _out_held.clear(); _out_type_waits.clear()
+    _out_stats["queued"] = _out_stats["held"] = 0
+    print(f"[OUT] dispatcher stopped ({_out_stats['sent']} sent, {dropped} dropped)")
+
+def outbound_stats() -> dict:
+    return {**_out_stats, "chats": len(_out_chats), "in_flight": len(_out_running)}
 
 # ---------------- DB: schema ----------------
 CREATE_TABLES = {
@@ -105,12 +651,42 @@ CREATE_TABLES = {
         "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
         ")"
     ),
-    "question_usage": (
-        "CREATE TABLE IF NOT EXISTS question_usage ("
-        "group_id BIGINT,"
-        "question_id BIGINT,"
-        "used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,"
-        "PRIMARY KEY (group_id, question_id)"
+    "question_decks": (
+        "CREATE TABLE IF NOT EXISTS question_decks ("
+        "group_id BIGINT PRIMARY KEY,"
+        "seed BIGINT NOT NULL,"
+        "position INTEGER NOT NULL DEFAULT 0,"
+        "bits INTEGER NOT NULL"
+        ")"
+    ),
+    "broadcast_jobs": (
+        "CREATE TABLE IF NOT EXISTS broadcast_jobs ("
+        "job_id BIGINT PRIMARY KEY,"
+        "owner_chat BIGINT,"
+        "status_msg_id BIGINT,"
+        "text TEXT NOT NULL,"
+        "target TEXT NOT NULL,"
+        "phase INTEGER DEFAULT 0,"
+        "cursor BIGINT,"
+        "sent INTEGER DEFAULT 0,"
+        "failed INTEGER DEFAULT 0,"
+        "unreachable INTEGER DEFAULT 0,"
+        "state TEXT DEFAULT 'running',"
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+        ")"
+    ),
+    "unreachable_peers": (
+        "CREATE TABLE IF NOT EXISTS unreachable_peers ("
+        "peer_id BIGINT PRIMARY KEY,"
+        "reason TEXT,"
+        "marked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+        ")"
+    ),
+    "worker_leases": (
+        "CREATE TABLE IF NOT EXISTS worker_leases ("
+        "worker_id TEXT PRIMARY KEY,"
+        "started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,"
+        "heartbeat_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
         ")"
     ),
     "active_polls": (
@@ -124,195 +700,1574 @@ CREATE_TABLES = {
     )
 }
 
+# ---------------- DB: migrations ----------------
+# Ordered, append-only. Each migration runs in its own transaction and is recorded in
+# schema_version; startup applies the ones newer than the recorded version. Steps are listed
+# per dialect ("all" runs on both). Never edit a released migration: add a new one.
+SCHEMA_VERSION_TABLE = (
+    "CREATE TABLE IF NOT EXISTS schema_version ("
+    "version INTEGER PRIMARY KEY,"
+    "name TEXT,"
+    "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+    ")"
+)
+_MIGRATION_LOCK = 0x5155495A  # pg advisory lock key: one worker migrates at a time
+
+MIGRATIONS = [
+    # 1: the tables as CREATE_TABLES defines them (no-op on databases that already have them)
+    (1, "base tables", {"all": list(CREATE_TABLES.values())}),
+    # 2: SQLite doesn't know SERIAL, so questions/players ids were plain nullable columns.
+    # Rebuild both with real rowid ids; questions keep their ids, NULL ones get new ids.
+    (2, "sqlite autoincrement ids", {"sqlite": [
+        "CREATE TABLE questions_new ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "question TEXT NOT NULL,"
+        "option_a TEXT NOT NULL,"
+        "option_b TEXT NOT NULL,"
+        "option_c TEXT NOT NULL,"
+        "option_d TEXT NOT NULL,"
+        "correct_answer INTEGER NOT NULL,"
+        "category TEXT DEFAULT 'General',"
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+        ")",
+        "INSERT INTO questions_new (id, question, option_a, option_b, option_c, option_d, correct_answer, category, created_at) "
+        "SELECT id, question, option_a, option_b, option_c, option_d, correct_answer, category, created_at FROM questions ORDER BY id IS NULL, id, rowid",
+        "DROP TABLE questions",
+        "ALTER TABLE questions_new RENAME TO questions",
+        "CREATE TABLE players_new ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "user_id BIGINT NOT NULL,"
+        "group_id BIGINT NOT NULL,"
+        "username TEXT,"
+        "first_name TEXT,"
+        "score INTEGER DEFAULT 0,"
+        "correct_answers INTEGER DEFAULT 0,"
+        "wrong_answers INTEGER DEFAULT 0,"
+        "current_streak INTEGER DEFAULT 0,"
+        "max_streak INTEGER DEFAULT 0,"
+        "last_answer_time TIMESTAMP,"
+        "UNIQUE(user_id, group_id)"
+        ")",
+        "INSERT INTO players_new (user_id, group_id, username, first_name, score, correct_answers, wrong_answers, current_streak, max_streak, last_answer_time) "
+        "SELECT user_id, group_id, username, first_name, score, correct_answers, wrong_answers, current_streak, max_streak, last_answer_time FROM players WHERE user_id IS NOT NULL AND group_id IS NOT NULL",
+        "DROP TABLE players",
+        "ALTER TABLE players_new RENAME TO players",
+    ]}),
+    # 3: leaderboard loads/ranks a group's players in score order
+    (3, "players leaderboard index", {"all": [
+        "CREATE INDEX IF NOT EXISTS players_group_rank ON players (group_id, score DESC, correct_answers DESC)",
+    ]}),
+    # 4: per-group decks replaced question_usage; drop it where an old install still has it
+    (4, "drop question_usage", {"all": ["DROP TABLE IF EXISTS question_usage"]}),
+    # 5: next fire time per group, written on graceful shutdown and read back on start
+    (5, "scheduler checkpoint", {"all": [
+        "CREATE TABLE IF NOT EXISTS scheduler_state ("
+        "group_id BIGINT PRIMARY KEY,"
+        "fire_at DOUBLE PRECISION NOT NULL"
+        ")",
+    ]}),
+    # 6: append-only answer log (answered_at in unix seconds) and its rollups: per-group
+    # daily and weekly (epoch-day and Monday-based epoch-week numbers) and global per-user
+    (6, "answer log and rollups", {
+        "postgres": [
+            "CREATE TABLE IF NOT EXISTS answer_log ("
+            "id BIGSERIAL PRIMARY KEY,"
+            "group_id BIGINT NOT NULL,"
+            "user_id BIGINT NOT NULL,"
+            "points SMALLINT NOT NULL,"
+            "answered_at BIGINT NOT NULL"
+            ")",
+        ],
+        "sqlite": [
+            "CREATE TABLE IF NOT EXISTS answer_log ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "group_id BIGINT NOT NULL,"
+            "user_id BIGINT NOT NULL,"
+            "points SMALLINT NOT NULL,"
+            "answered_at BIGINT NOT NULL"
+            ")",
+        ],
+        "all": [
+            "CREATE TABLE IF NOT EXISTS answer_daily ("
+            "group_id BIGINT NOT NULL,"
+            "user_id BIGINT NOT NULL,"
+            "day INTEGER NOT NULL,"
+            "score INTEGER NOT NULL DEFAULT 0,"
+            "correct INTEGER NOT NULL DEFAULT 0,"
+            "wrong INTEGER NOT NULL DEFAULT 0,"
+            "PRIMARY KEY (group_id, user_id, day)"
+            ")",
+            "CREATE TABLE IF NOT EXISTS answer_weekly ("
+            "group_id BIGINT NOT NULL,"
+            "user_id BIGINT NOT NULL,"
+            "week INTEGER NOT NULL,"
+            "score INTEGER NOT NULL DEFAULT 0,"
+            "correct INTEGER NOT NULL DEFAULT 0,"
+            "wrong INTEGER NOT NULL DEFAULT 0,"
+            "PRIMARY KEY (group_id, user_id, week)"
+            ")",
+            "CREATE INDEX IF NOT EXISTS answer_weekly_rank ON answer_weekly (group_id, week, score DESC)",
+            "CREATE TABLE IF NOT EXISTS global_scores ("
+            "user_id BIGINT PRIMARY KEY,"
+            "score INTEGER NOT NULL DEFAULT 0,"
+            "correct INTEGER NOT NULL DEFAULT 0,"
+            "wrong INTEGER NOT NULL DEFAULT 0"
+            ")",
+            "CREATE INDEX IF NOT EXISTS global_scores_rank ON global_scores (score DESC)",
+            "CREATE TABLE IF NOT EXISTS rollup_state ("
+            "name TEXT PRIMARY KEY,"
+            "last_id BIGINT NOT NULL"
+            ")",
+        ],
+    }),
+    # 7: who has been scored on each open poll (vote mode), so redelivered updates score once
+    (7, "poll vote dedupe", {"all": [
+        "CREATE TABLE IF NOT EXISTS poll_votes ("
+        "poll_id TEXT NOT NULL,"
+        "user_id BIGINT NOT NULL,"
+        "PRIMARY KEY (poll_id, user_id)"
+        ")",
+    ]}),
+    # 8: peer-invalid and write-forbidden are no longer permanent (a muted bot, a stale peer)
+    (8, "unreachable: drop transient marks", {"all": [
+        "DELETE FROM unreachable_peers WHERE reason IN ('PeerIdInvalidError', 'ChatWriteForbiddenError')",
+    ]}),
+    # 9: close mode: votes seen live on open polls, saved at shutdown for the fallback scorer
+    (9, "poll tallies", {"all": [
+        "CREATE TABLE IF NOT EXISTS poll_tallies ("
+        "poll_id TEXT NOT NULL,"
+        "user_id BIGINT NOT NULL,"
+        "choice TEXT NOT NULL,"
+        "PRIMARY KEY (poll_id, user_id)"
+        ")",
+    ]}),
+]
+
+# ---------------- DB: named queries ----------------
+# Every statement the bot runs is registered here once, by name, in Postgres syntax ($n
+# placeholders). compile_queries() builds the active dialect's text at startup: SQLite gets
+# ?n placeholders (same numbering, so a parameter may repeat) or its own statement from
+# SQLITE_OVERRIDES where the syntax differs (None: Postgres-only). Connections accept a name
+# wherever they accept SQL, so the text is fixed per name and both drivers' statement caches
+# (asyncpg per pooled connection, sqlite3 on the one connection) reuse the prepared statement.
+# Raw SQL is still accepted for DDL and transaction control.
+_QUESTION_SELECT = "SELECT id, question, option_a, option_b, option_c, option_d, correct_answer, category FROM questions"
+GROUP_SETTING_COLUMNS = ("quiz_active", "interval_minutes")
+
+QUERIES = {
+    "ping": "SELECT 1",
+    "schema.version": "SELECT COALESCE(MAX(version), 0) FROM schema_version",
+    "schema.record": "INSERT INTO schema_version (version, name) VALUES ($1,$2)",
+    "locks.xact": "SELECT pg_advisory_xact_lock($1)",
+    # questions / decks
+    "questions.count": "SELECT COUNT(*) FROM questions",
+    "questions.stats": "SELECT COUNT(*), MAX(id) FROM questions",
+    "questions.insert": "INSERT INTO questions (question, option_a, option_b, option_c, option_d, correct_answer, category) VALUES ($1,$2,$3,$4,$5,$6,$7)",
+    "questions.insert_returning": "INSERT INTO questions (question, option_a, option_b, option_c, option_d, correct_answer, category) VALUES ($1,$2,$3,$4,$5,$6,$7) RETURNING id",
+    "questions.after": _QUESTION_SELECT + " WHERE id > $1 ORDER BY id",
+    "questions.page": _QUESTION_SELECT + " WHERE id > $1 ORDER BY id LIMIT $2",
+    "questions.get": _QUESTION_SELECT + " WHERE id=$1",
+    "questions.delete_all": "DELETE FROM questions",
+    "decks.all": "SELECT group_id, seed, position, bits FROM question_decks",
+    "decks.save": "INSERT INTO question_decks (group_id, seed, position, bits) VALUES ($1,$2,$3,$4) ON CONFLICT (group_id) DO UPDATE SET seed=EXCLUDED.seed, position=EXCLUDED.position, bits=EXCLUDED.bits",
+    "decks.delete_all": "DELETE FROM question_decks",
+    # groups / users
+    "groups.add": "INSERT INTO groups (group_id, group_name) VALUES ($1,$2) ON CONFLICT (group_id) DO NOTHING",
+    "groups.settings_all": "SELECT group_id, quiz_active, interval_minutes FROM groups",
+    "groups.settings": "SELECT quiz_active, interval_minutes FROM groups WHERE group_id=$1",
+    "users.upsert": "INSERT INTO users (user_id, username, first_name) VALUES ($1,$2,$3) ON CONFLICT (user_id) DO UPDATE SET username=EXCLUDED.username, first_name=EXCLUDED.first_name",
+    "users.profile": "SELECT username, first_name FROM users WHERE user_id=$1",
+    # players
+    "players.profile": "SELECT username, first_name FROM players WHERE user_id=$1 AND group_id=$2",
+    "players.group": "SELECT user_id, username, first_name, score, correct_answers, wrong_answers, current_streak, max_streak FROM players WHERE group_id=$1",
+    "players.active_groups": (
+        "SELECT p.group_id, p.user_id, p.username, p.first_name, p.score, p.correct_answers, p.wrong_answers, p.current_streak, p.max_streak "
+        "FROM players p JOIN active_polls ap ON ap.group_id=p.group_id"
+    ),
+    "players.any_profile": "SELECT username, first_name FROM players WHERE user_id=$1 LIMIT 1",
+    "players.reset_group": "UPDATE players SET score=0, correct_answers=0, wrong_answers=0, current_streak=0, max_streak=0 WHERE group_id=$1",
+    # one coalesced score delta per (user, group); params: uid, gid, username, first_name, score,
+    # correct, wrong, run, best, reset, lead, profile_changed (see _ScoreDelta)
+    "players.add_scores": (
+        "INSERT INTO players (user_id, group_id, username, first_name, score, correct_answers, wrong_answers, current_streak, max_streak, last_answer_time) "
+        "VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,CURRENT_TIMESTAMP) "
+        "ON CONFLICT (user_id, group_id) DO UPDATE SET username=CASE WHEN $12 THEN EXCLUDED.username ELSE players.username END, first_name=CASE WHEN $12 THEN EXCLUDED.first_name ELSE players.first_name END, "
+        "score=players.score+EXCLUDED.score, correct_answers=players.correct_answers+EXCLUDED.correct_answers, wrong_answers=players.wrong_answers+EXCLUDED.wrong_answers, "
+        "current_streak=CASE WHEN $10 THEN EXCLUDED.current_streak ELSE players.current_streak+$11 END, "
+        "max_streak=GREATEST(players.max_streak, players.current_streak+$11, EXCLUDED.max_streak), "
+        "last_answer_time=EXCLUDED.last_answer_time"
+    ),
+    # active polls
+    "scheduler.all": "SELECT group_id, fire_at FROM scheduler_state",
+    "scheduler.save": "INSERT INTO scheduler_state (group_id, fire_at) VALUES ($1,$2) ON CONFLICT (group_id) DO UPDATE SET fire_at=EXCLUDED.fire_at",
+    "scheduler.delete": "DELETE FROM scheduler_state WHERE group_id=$1",
+    "answers.log": "INSERT INTO answer_log (group_id, user_id, points, answered_at) VALUES ($1,$2,$3,$4)",
+    "answers.prune": "DELETE FROM answer_log WHERE id <= $1 AND answered_at < $2",
+    "rollup.watermark": "SELECT last_id FROM rollup_state WHERE name=$1",
+    "rollup.set_watermark": "INSERT INTO rollup_state (name, last_id) VALUES ($1,$2) ON CONFLICT (name) DO UPDATE SET last_id=EXCLUDED.last_id",
+    "rollup.high": "SELECT COALESCE(MAX(id), $1) FROM answer_log WHERE id > $1 AND id <= $2 AND answered_at <= $3",
+    "rollup.daily": (
+        "INSERT INTO answer_daily (group_id, user_id, day, score, correct, wrong) "
+        "SELECT group_id, user_id, answered_at / 86400, SUM(points), SUM(CASE WHEN points > 0 THEN 1 ELSE 0 END), SUM(CASE WHEN points < 0 THEN 1 ELSE 0 END) "
+        "FROM answer_log WHERE id > $1 AND id <= $2 GROUP BY group_id, user_id, answered_at / 86400 "
+        "ON CONFLICT (group_id, user_id, day) DO UPDATE SET score=answer_daily.score+EXCLUDED.score, correct=answer_daily.correct+EXCLUDED.correct, wrong=answer_daily.wrong+EXCLUDED.wrong"
+    ),
+    "rollup.weekly": (
+        "INSERT INTO answer_weekly (group_id, user_id, week, score, correct, wrong) "
+        "SELECT group_id, user_id, (answered_at / 86400 + 3) / 7, SUM(points), SUM(CASE WHEN points > 0 THEN 1 ELSE 0 END), SUM(CASE WHEN points < 0 THEN 1 ELSE 0 END) "
+        "FROM answer_log WHERE id > $1 AND id <= $2 GROUP BY group_id, user_id, (answered_at / 86400 + 3) / 7 "
+        "ON CONFLICT (group_id, user_id, week) DO UPDATE SET score=answer_weekly.score+EXCLUDED.score, correct=answer_weekly.correct+EXCLUDED.correct, wrong=answer_weekly.wrong+EXCLUDED.wrong"
+    ),
+    "rollup.global": (
+        "INSERT INTO global_scores (user_id, score, correct, wrong) "
+        "SELECT user_id, SUM(points), SUM(CASE WHEN points > 0 THEN 1 ELSE 0 END), SUM(CASE WHEN points < 0 THEN 1 ELSE 0 END) "
+        "FROM answer_log WHERE id > $1 AND id <= $2 GROUP BY user_id "
+        "ON CONFLICT (user_id) DO UPDATE SET score=global_scores.score+EXCLUDED.score, correct=global_scores.correct+EXCLUDED.correct, wrong=global_scores.wrong+EXCLUDED.wrong"
+    ),
+    "rollup.prune_daily": "DELETE FROM answer_daily WHERE day < $1",
+    "rollup.week_top": "SELECT user_id, score, correct, wrong FROM answer_weekly WHERE group_id=$1 AND week=$2 ORDER BY score DESC, correct DESC, user_id LIMIT $3",
+    "rollup.global_top": "SELECT user_id, score, correct, wrong FROM global_scores ORDER BY score DESC, correct DESC, user_id LIMIT $1",
+    "votes.record": "INSERT INTO poll_votes (poll_id, user_id) VALUES ($1,$2) ON CONFLICT (poll_id, user_id) DO NOTHING",
+    "votes.active": "SELECT pv.poll_id, pv.user_id FROM poll_votes pv JOIN active_polls ap ON ap.poll_id=pv.poll_id",
+    "votes.forget": "DELETE FROM poll_votes WHERE poll_id=$1",
+    "votes.prune": "DELETE FROM poll_votes WHERE poll_id NOT IN (SELECT poll_id FROM active_polls)",
+    "tallies.save": "INSERT INTO poll_tallies (poll_id, user_id, choice) VALUES ($1,$2,$3) ON CONFLICT (poll_id, user_id) DO UPDATE SET choice=EXCLUDED.choice",
+    "tallies.active": "SELECT pt.poll_id, pt.user_id, pt.choice FROM poll_tallies pt JOIN active_polls ap ON ap.poll_id=pt.poll_id",
+    "tallies.forget": "DELETE FROM poll_tallies WHERE poll_id=$1",
+    "tallies.prune": "DELETE FROM poll_tallies WHERE poll_id NOT IN (SELECT poll_id FROM active_polls)",
+    "polls.all": "SELECT ap.group_id, ap.poll_id, ap.question_id, ap.message_id, q.correct_answer FROM active_polls ap JOIN questions q ON q.id=ap.question_id",
+    "polls.save": "INSERT INTO active_polls (group_id, poll_id, question_id, message_id) VALUES ($1,$2,$3,$4) ON CONFLICT (group_id) DO UPDATE SET poll_id=EXCLUDED.poll_id, question_id=EXCLUDED.question_id, message_id=EXCLUDED.message_id, created_at=CURRENT_TIMESTAMP",
+    "polls.delete": "DELETE FROM active_polls WHERE group_id=$1",
+    "polls.claim": "DELETE FROM active_polls WHERE group_id=$1 AND poll_id=$2 RETURNING group_id",
+    # broadcasts
+    "broadcast.create": "INSERT INTO broadcast_jobs (job_id, owner_chat, status_msg_id, text, target, phase, cursor) VALUES ($1,$2,$3,$4,$5,$6,$7)",
+    "broadcast.save": "UPDATE broadcast_jobs SET phase=$1, cursor=$2, sent=$3, failed=$4, unreachable=$5, state=$6 WHERE job_id=$7",
+    "broadcast.running": "SELECT job_id, owner_chat, status_msg_id, text, target, phase, cursor, sent, failed, unreachable FROM broadcast_jobs WHERE state='running'",
+    "broadcast.page_users": "SELECT user_id FROM users u WHERE user_id > $1 AND NOT EXISTS (SELECT 1 FROM unreachable_peers x WHERE x.peer_id=u.user_id) ORDER BY user_id LIMIT $2",
+    "broadcast.page_groups": "SELECT group_id FROM groups g WHERE group_id > $1 AND NOT EXISTS (SELECT 1 FROM unreachable_peers x WHERE x.peer_id=g.group_id) ORDER BY group_id LIMIT $2",
+    "unreachable.mark": "INSERT INTO unreachable_peers (peer_id, reason) VALUES ($1,$2) ON CONFLICT (peer_id) DO UPDATE SET reason=EXCLUDED.reason, marked_at=CURRENT_TIMESTAMP",
+    "unreachable.clear": "DELETE FROM unreachable_peers WHERE peer_id=$1",
+    # worker leases (SHARDING)
+    "leases.renew": "INSERT INTO worker_leases (worker_id, heartbeat_at) VALUES ($1, now()) ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at=now()",
+    "leases.prune": "DELETE FROM worker_leases WHERE heartbeat_at < now() - make_interval(secs => $1)",
+    "leases.live": "SELECT worker_id FROM worker_leases WHERE heartbeat_at > now() - make_interval(secs => $1)",
+    "leases.release": "DELETE FROM worker_leases WHERE worker_id=$1",
+}
+# settings updates: one statement per column combination, "groups.update:quiz_active,interval_minutes"
+for _n in range(1, len(GROUP_SETTING_COLUMNS) + 1):
+    for _cols in itertools.combinations(GROUP_SETTING_COLUMNS, _n):
+        _sets = ", ".join(f"{k}=${i}" for i, k in enumerate(_cols, start=1))
+        QUERIES["groups.update:" + ",".join(_cols)] = f"UPDATE groups SET {_sets} WHERE group_id=${len(_cols) + 1} RETURNING quiz_active, interval_minutes"
+
+SQLITE_OVERRIDES = {
+    "locks.xact": None,
+    "players.add_scores": QUERIES["players.add_scores"].replace("GREATEST(", "MAX("),
+    "leases.renew": None,
+    "leases.prune": None,
+    "leases.live": None,
+    "leases.release": None,
+}
+
+# Reads that may be served by the read replica (DATABASE_READ_URL): they tolerate a little
+# replication lag. Value: index of the group_id parameter, for read-your-writes (None =
+# not group-scoped). Everything else, including the state loaded at startup and on
+# rebalance, goes to the primary.
+READ_QUERIES = {
+    "players.group": 0,
+    "players.profile": 1,
+    "players.any_profile": None,
+    "users.profile": None,
+    "questions.count": None,
+    "questions.page": None,
+    "broadcast.page_users": None,
+    "broadcast.page_groups": None,
+    "rollup.week_top": None,  # rollups lag by design
+    "rollup.global_top": None,
+}
+
+_compiled: dict[str, str] = {}  # name -> SQL for the active backend
+
+def compile_queries():
+    _compiled.clear()
+    for name, sql in QUERIES.items():
+        if not USE_POSTGRES:
+            sql = SQLITE_OVERRIDES.get(name, sql)
+            if sql is None:
+                continue
+            sql = re.sub(r"\$(\d+)", r"?\1", sql)
+        _compiled[name] = sql
+
+# ---------------- DB: connection pool ----------------
+# Built once in init_db: an asyncpg pool (Postgres) or one long-lived aiosqlite
+# connection (SQLite). Every query borrows from here instead of reconnecting.
+_pg_pool = None
+_pg_read_pool = None  # DATABASE_READ_URL; opened lazily, see _replica_pool()
+_sqlite_conn = None
+_sqlite_lock = asyncio.Lock()  # sqlite has one connection: serialize statements and transactions on it
+_db_stats = {"in_use": 0, "waiting": 0, "acquired": 0, "acquire_ms_total": 0.0, "acquire_ms_max": 0.0}
+
+class _SqliteConn:
+    # asyncpg-style facade (fetch/fetchrow/fetchval/execute/executemany) over aiosqlite
+    def __init__(self, db):
+        self.db = db
+
+    async def fetch(self, query: str, *params):
+        async with self.db.execute(query, params) as cur:
+            return await cur.fetchall()
+
+    async def fetchrow(self, query: str, *params):
+        async with self.db.execute(query, params) as cur:
+            return await cur.fetchone()
+
+    async def fetchval(self, query: str, *params):
+        row = await self.fetchrow(query, *params)
+        return row[0] if row else None
+
+    async def execute(self, query: str, *params):
+        async with self.db.execute(query, params):
+            pass
+
+    async def executemany(self, query: str, args):
+        async with self.db.executemany(query, args):
+            pass
+
+# Per-statement hooks: fn(label, sql, seconds, failed), called after every statement run
+# through db_conn. label is the registry name (or query_label() for raw SQL).
+_query_hooks: list = []
+
+def add_query_hook(fn):
+    _query_hooks.append(fn)
+
+def _metrics_query_hook(label: str, sql: str, seconds: float, failed: bool):
+    DB_QUERY_SECONDS.observe(seconds, query=label)
+    if failed:
+        DB_QUERY_ERRORS.inc(query=label)
+
+def _slow_query_hook(label: str, sql: str, seconds: float, failed: bool):
+    if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        print(f"[SLOW] {seconds * 1000:.0f}ms {label}: {' '.join(sql.split())[:200]}")
+
+add_query_hook(_metrics_query_hook)
+add_query_hook(_slow_query_hook)
+
+def _resolve(query: str) -> Tuple[str, str]:
+    # (label, sql) for a registered name or raw SQL
+    sql = _compiled.get(query)
+    if sql is not None:
+        return query, sql
+    return query_label(query), query
+
+class _TimedConn:
+    # What db_conn hands out: resolves query names to the compiled SQL and runs the query
+    # hooks for every statement. Anything else passes through to the driver connection.
+    __slots__ = ("conn",)
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    async def _run(self, label: str, sql: str, call):
+        t0 = time.perf_counter()
+        failed = False
+        try:
+            return await call
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - t0
+            for hook in _query_hooks:
+                hook(label, sql, elapsed, failed)
+
+    def fetch(self, query: str, *params):
+        label, sql = _resolve(query)
+        return self._run(label, sql, self.conn.fetch(sql, *params))
+
+    def fetchrow(self, query: str, *params):
+        label, sql = _resolve(query)
+        return self._run(label, sql, self.conn.fetchrow(sql, *params))
+
+    def fetchval(self, query: str, *params):
+        label, sql = _resolve(query)
+        return self._run(label, sql, self.conn.fetchval(sql, *params))
+
+    def execute(self, query: str, *params):
+        label, sql = _resolve(query)
+        return self._run(label, sql, self.conn.execute(sql, *params))
+
+    def executemany(self, query: str, args):
+        label, sql = _resolve(query)
+        return self._run(label, sql, self.conn.executemany(sql, args))
+
+    def copy_records_to_table(self, table: str, **kwargs):
+        return self._run(f"copy {table}", f"COPY {table}", self.conn.copy_records_to_table(table, **kwargs))
+
+# WAL: readers don't block the writer; synchronous=NORMAL is durable across app crashes in WAL
+# mode and skips an fsync per commit; mmap serves reads from the page cache without copies
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}",
+    "PRAGMA busy_timeout=5000",
+)
+
+async def open_db():
+    global _pg_pool, _sqlite_conn
+    compile_queries()
+    # statement caches sized to hold the whole registry, so no named query is ever re-prepared
+    cache_size = max(128, 2 * len(_compiled))
+    if USE_POSTGRES:
+        _pg_pool = await asyncpg.create_pool(DB_URL, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, statement_cache_size=cache_size)
+    else:
+        # isolation_level=None: autocommit per statement, explicit BEGIN/COMMIT in db_transaction
+        db = await aiosqlite.connect(DB_PATH, isolation_level=None, cached_statements=cache_size)
+        for pragma in SQLITE_PRAGMAS:
+            await db.execute(pragma)
+        _sqlite_conn = _SqliteConn(db)
+
+async def close_db():
+    global _pg_pool, _sqlite_conn
+    if _pg_pool is not None:
+        await _pg_pool.close()
+        _pg_pool = None
+    await close_replica()
+    if _sqlite_conn is not None:
+        async with _sqlite_lock:
+            await _sqlite_conn.db.close()
+        _sqlite_conn = None
+
+@asynccontextmanager
+async def db_conn(pool=None):
+    # Borrow a connection for a few statements (autocommit); pool: the replica pool, else the primary
+    pool = pool or _pg_pool
+    t0 = time.perf_counter()
+    _db_stats["waiting"] += 1
+    try:
+        if USE_POSTGRES:
+            conn = await pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+        else:
+            await _sqlite_lock.acquire()
+            conn = _sqlite_conn
+    finally:
+        _db_stats["waiting"] -= 1
+    ms = (time.perf_counter() - t0) * 1000
+    _db_stats["acquired"] += 1
+    _db_stats["acquire_ms_total"] += ms
+    _db_stats["acquire_ms_max"] = max(_db_stats["acquire_ms_max"], ms)
+    _db_stats["in_use"] += 1
+    try:
+        yield _TimedConn(conn)
+    finally:
+        _db_stats["in_use"] -= 1
+        if USE_POSTGRES:
+            await pool.release(conn)
+        else:
+            _sqlite_lock.release()
+
+@asynccontextmanager
+async def db_transaction():
+    # One connection, one transaction: commits on success, rolls back on error.
+    # Use the yielded conn inside; calling db_fetch/db_execute here would need a second connection.
+    async with db_conn() as conn:
+        if USE_POSTGRES:
+            async with conn.transaction():
+                yield conn
+        else:
+            await conn.execute("BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                await conn.execute("ROLLBACK")
+                raise
+            await conn.execute("COMMIT")
+
+# ---------------- DB: read replica routing ----------------
+# With DATABASE_READ_URL set, READ_QUERIES run on a second pool unless the group they read
+# (or, for reads that aren't group-scoped, the bank/global data) was written less than
+# READ_YOUR_WRITES_SECONDS ago: note_write() records those writes. A connection error on
+# the replica sends the read to the primary and keeps reads there for REPLICA_RETRY_SECONDS.
+_replica_lock = asyncio.Lock()
+_replica_down_until = 0.0
+_recent_writes: dict = {}  # group_id (None = global) -> monotonic time of the last write
+_route_stats = {"replica": 0, "primary": 0, "read_your_writes": 0, "fallback": 0}
+_REPLICA_ERRORS = (OSError, asyncio.TimeoutError) + (
+    (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, asyncpg.CannotConnectNowError) if asyncpg else ())
+
+def note_write(group_id: Optional[int] = None):
+    now = time.monotonic()
+    _recent_writes[group_id] = now
+    if len(_recent_writes) > 4096:
+        for key in [k for k, t in _recent_writes.items() if now - t > READ_YOUR_WRITES_SECONDS]:
+            del _recent_writes[key]
+
+def _replica_failed(e: Exception):
+    global _replica_down_until
+    if time.monotonic() >= _replica_down_until:
+        print(f"[DB] read replica unavailable ({type(e).__name__}: {e}); reading from the primary for {REPLICA_RETRY_SECONDS:.0f}s")
+    _replica_down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+
+async def _replica_pool():
+    # the replica pool if reads may use it now; opened on first use and after a failed open
+    global _pg_read_pool
+    if not DB_READ_URL or time.monotonic() < _replica_down_until:
+        return None
+    if _pg_read_pool is None:
+        async with _replica_lock:
+            if _pg_read_pool is None:
+                try:
+                    _pg_read_pool = await asyncpg.create_pool(DB_READ_URL, min_size=1, max_size=DB_POOL_MAX, statement_cache_size=max(128, 2 * len(_compiled)))
+                except Exception as e:
+                    _replica_failed(e)
+                    return None
+    return _pg_read_pool
+
+async def close_replica():
+    global _pg_read_pool
+    if _pg_read_pool is not None:
+        await _pg_read_pool.close()
+        _pg_read_pool = None
+
+def _read_route(query: str, params) -> str:
+    idx = READ_QUERIES.get(query, -1)
+    if idx == -1:
+        return "primary"
+    last = _recent_writes.get(params[idx] if idx is not None else None)
+    if last is not None and time.monotonic() - last < READ_YOUR_WRITES_SECONDS:
+        return "read_your_writes"
+    return "replica"
+
+async def _db_read(method: str, query: str, params):
+    route = _read_route(query, params) if DB_READ_URL else "primary"
+    if route == "replica":
+        pool = await _replica_pool()
+        if pool is not None:
+            try:
+                async with db_conn(pool) as conn:
+                    result = await getattr(conn, method)(query, *params)
+                _route_stats["replica"] += 1
+                DB_READ_ROUTES.inc(route="replica")
+                return result
+            except _REPLICA_ERRORS as e:
+                _replica_failed(e)
+                route = "fallback"
+        else:
+            route = "primary"
+    if DB_READ_URL and query in READ_QUERIES:
+        _route_stats[route] += 1
+        DB_READ_ROUTES.inc(route=route)
+    async with db_conn() as conn:
+        return await getattr(conn, method)(query, *params)
+
+def db_pool_stats() -> dict:
+    acquired = _db_stats["acquired"]
+    stats = {
+        "backend": "postgres" if USE_POSTGRES else "sqlite",
+        "schema_version": _schema_version,
+        "in_use": _db_stats["in_use"],
+        "waiting": _db_stats["waiting"],
+        "acquired": acquired,
+        "acquire_ms_avg": round(_db_stats["acquire_ms_total"] / acquired, 3) if acquired else 0.0,
+        "acquire_ms_max": round(_db_stats["acquire_ms_max"], 3),
+    }
+    if _pg_pool is not None:
+        stats.update(size=_pg_pool.get_size(), idle=_pg_pool.get_idle_size(), min=_pg_pool.get_min_size(), max=_pg_pool.get_max_size())
+    if DB_READ_URL:
+        stats.update({f"reads_{k}": v for k, v in _route_stats.items()})
+        stats["replica_up"] = time.monotonic() >= _replica_down_until
+        if _pg_read_pool is not None:
+            stats.update(replica_size=_pg_read_pool.get_size(), replica_idle=_pg_read_pool.get_idle_size())
+    return stats
+
 # ---------------- DB helpers (async) ----------------
+SAMPLE_QUESTIONS = [
+    ("What is the capital of France?","London","Berlin","Paris","Madrid",2,"Geography"),
+    ("Which planet is called Red Planet?","Venus","Mars","Jupiter","Saturn",1,"Science"),
+    ("Square root of 144?","10","11","12","13",2,"Math")
+]
+
+_schema_version = 0
+
+async def run_migrations() -> list:
+    # apply pending MIGRATIONS in order; returns the versions applied
+    global _schema_version
+    dialect = "postgres" if USE_POSTGRES else "sqlite"
+    async with db_conn() as conn:
+        await conn.execute(SCHEMA_VERSION_TABLE)
+        _schema_version = await conn.fetchval("schema.version")
+    applied = []
+    for version, name, steps in MIGRATIONS:
+        if version <= _schema_version:
+            continue
+        async with db_transaction() as conn:
+            if USE_POSTGRES:
+                await conn.execute("locks.xact", _MIGRATION_LOCK)
+                if await conn.fetchval("schema.version") >= version:
+                    continue  # another worker got here first
+            for stmt in steps.get("all", []) + steps.get(dialect, []):
+                await conn.execute(stmt)
+            await conn.execute("schema.record", version, name)
+        _schema_version = version
+        applied.append(version)
+        print(f"[DB] migration {version} applied: {name}")
+    return applied
+
+async def db_maintenance(analyze: bool):
+    # outside a transaction: VACUUM can't run inside one
+    async with db_conn() as conn:
+        if DB_VACUUM_ON_START:
+            await conn.execute("VACUUM ANALYZE" if USE_POSTGRES else "VACUUM")
+            if not USE_POSTGRES:
+                await conn.execute("ANALYZE")
+        elif analyze:
+            await conn.execute("ANALYZE")
+        if not USE_POSTGRES:
+            await conn.execute("PRAGMA optimize")
+
 async def init_db():
-    # Create tables and add sample questions if empty
-    if USE_POSTGRES:
-        conn = await asyncpg.connect(DB_URL)
-        for q in CREATE_TABLES.values():
-            await conn.execute(q)
-        # sample questions
-        count = await conn.fetchval("SELECT COUNT(*) FROM questions")
+    # Open the pool, migrate the schema and add sample questions if empty
+    await open_db()
+    applied = await run_migrations()
+    await db_maintenance(analyze=bool(applied))
+    async with db_transaction() as conn:
+        count = await conn.fetchval("questions.count")
         if count == 0:
-            await conn.executemany(
-                "INSERT INTO questions (question, option_a, option_b, option_c, option_d, correct_answer, category) VALUES ($1,$2,$3,$4,$5,$6,$7)",
-                [
-                    ("What is the capital of France?","London","Berlin","Paris","Madrid",2,"Geography"),
-                    ("Which planet is called Red Planet?","Venus","Mars","Jupiter","Saturn",1,"Science"),
-                    ("Square root of 144?","10","11","12","13",2,"Math")
-                ]
-            )
-        await conn.close()
-    else:
-        # sqlite via aiosqlite
-        async with aiosqlite.connect(DB_PATH) as db:
-            for q in CREATE_TABLES.values():
-                await db.execute(q)
-            await db.commit()
-            cur = await db.execute("SELECT COUNT(*) FROM questions")
-            row = await cur.fetchone()
-            if row and row[0] == 0:
-                await db.executemany(
-                    "INSERT INTO questions (question, option_a, option_b, option_c, option_d, correct_answer, category) VALUES (?,?,?,?,?,?,?)",
-                    [
-                        ("What is the capital of France?","London","Berlin","Paris","Madrid",2,"Geography"),
-                        ("Which planet is called Red Planet?","Venus","Mars","Jupiter","Saturn",1,"Science"),
-                        ("Square root of 144?","10","11","12","13",2,"Math")
-                    ]
-                )
-                await db.commit()
-
-# Generic query helpers
+            await conn.executemany("questions.insert", SAMPLE_QUESTIONS)
+
+# Generic query helpers: query is a QUERIES name (or raw SQL); READ_QUERIES may use the replica
 async def db_fetch(query: str, *params):
-    if USE_POSTGRES:
-        conn = await asyncpg.connect(DB_URL)
-        rows = await conn.fetch(query, *params)
-        await conn.close()
-        return rows
-    else:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute(query, params)
-            rows = await cur.fetchall()
-            return rows
+    return await _db_read("fetch", query, params)
 
 async def db_fetchrow(query: str, *params):
-    if USE_POSTGRES:
-        conn = await asyncpg.connect(DB_URL)
-        row = await conn.fetchrow(query, *params)
-        await conn.close()
-        return row
-    else:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute(query, params)
-            row = await cur.fetchone()
-            return row
+    return await _db_read("fetchrow", query, params)
 
 async def db_execute(query: str, *params):
-    if USE_POSTGRES:
-        conn = await asyncpg.connect(DB_URL)
+    async with db_conn() as conn:
         await conn.execute(query, *params)
-        await conn.close()
-    else:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(query, params)
-            await db.commit()
 
 # Convenience wrappers used by bot logic
 async def add_group(group_id: int, group_name: str):
-    if USE_POSTGRES:
-        await db_execute("INSERT INTO groups (group_id, group_name) VALUES ($1,$2) ON CONFLICT (group_id) DO NOTHING", group_id, group_name)
-    else:
-        await db_execute("INSERT OR IGNORE INTO groups (group_id, group_name) VALUES (?,?)", group_id, group_name)
+    await db_execute("groups.add", group_id, group_name)
+    await db_execute("unreachable.clear", group_id)  # re-added: back on the broadcast list
+
+# In-process cache of (quiz_active, interval_minutes), bulk-loaded at startup and refreshed
+# write-through by update_group_settings, so the scheduler and senders never poll the DB.
+_group_settings: dict[int, Tuple[bool,int]] = {}
+_settings_stats = {"hits": 0, "misses": 0, "updates": 0}
+
+async def load_group_settings():
+    _group_settings.clear()
+    for gid, active, interval in await db_fetch("groups.settings_all"):
+        _group_settings[int(gid)] = (bool(active), int(interval))
+    print(f"[DB] settings cached for {len(_group_settings)} groups")
 
 async def get_group_settings(group_id: int) -> Tuple[bool,int]:
-    row = await db_fetchrow("SELECT quiz_active, interval_minutes FROM groups WHERE group_id=$1" if USE_POSTGRES else "SELECT quiz_active, interval_minutes FROM groups WHERE group_id=?", group_id)
-    if not row:
-        return True, 30
-    # row types differ
-    return bool(row[0]), int(row[1])
+    cached = _group_settings.get(group_id)
+    if cached is not None:
+        _settings_stats["hits"] += 1
+        return cached
+    _settings_stats["misses"] += 1
+    row = await db_fetchrow("groups.settings", group_id)
+    # row types differ; unknown groups get the table defaults (what add_group would insert)
+    settings = (bool(row[0]), int(row[1])) if row else (True, 30)
+    _group_settings[group_id] = settings
+    return settings
 
 async def update_group_settings(group_id: int, **kwargs):
-    # simple approach: update each key
-    for k,v in kwargs.items():
-        if USE_POSTGRES:
-            await db_execute(f"UPDATE groups SET {k}=$1 WHERE group_id=$2", v, group_id)
-        else:
-            await db_execute(f"UPDATE groups SET {k}=? WHERE group_id=?", v, group_id)
-
-async def add_or_update_player(user_id:int, group_id:int, username:Optional[str], first_name:str):
-    if USE_POSTGRES:
-        await db_execute(
-            "INSERT INTO players (user_id, group_id, username, first_name) VALUES ($1,$2,$3,$4) ON CONFLICT (user_id, group_id) DO UPDATE SET username=EXCLUDED.username, first_name=EXCLUDED.first_name",
-            user_id, group_id, username, first_name
-        )
+    # one UPDATE for all columns; RETURNING feeds the cache so it matches the committed row
+    cols = [k for k in GROUP_SETTING_COLUMNS if k in kwargs]
+    if len(cols) != len(kwargs):
+        raise ValueError(f"unknown group setting(s): {sorted(set(kwargs) - set(cols))}")
+    if not cols:
+        return
+    row = await db_fetchrow("groups.update:" + ",".join(cols), *[kwargs[k] for k in cols], group_id)
+    _settings_stats["updates"] += 1
+    if row:
+        _group_settings[group_id] = (bool(row[0]), int(row[1]))
     else:
-        await db_execute(
-            "INSERT INTO players (user_id, group_id, username, first_name) VALUES (?,?,?,?) ON CONFLICT(user_id, group_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name" if False else "INSERT OR REPLACE INTO players (user_id, group_id, username, first_name) VALUES (?,?,?,?)",
-            user_id, group_id, username, first_name
-        )
+        _group_settings.pop(group_id, None)
 
-async def update_player_score(user_id:int, group_id:int, points:int, is_correct:bool):
-    if is_correct:
-        if USE_POSTGRES:
-            await db_execute(
-                "UPDATE players SET score = score + $1, correct_answers = correct_answers + 1, current_streak = current_streak + 1, max_streak = GREATEST(max_streak, current_streak + 1), last_answer_time = CURRENT_TIMESTAMP WHERE user_id=$2 AND group_id=$3",
-                points, user_id, group_id
-            )
+def settings_cache_stats() -> dict:
+    lookups = _settings_stats["hits"] + _settings_stats["misses"]
+    return {"groups": len(_group_settings), **_settings_stats, "hit_ratio": round(_settings_stats["hits"] / lookups, 4) if lookups else 0.0}
+
+# One row per (user, group) per batch; several votes are folded into it by _coalesce_votes.
+# Streaks: "lead" corrects extend the stored streak, "reset" means a wrong answer broke it,
+# "run" is the trailing correct run and "best" the longest run seen inside the batch.
+# username/first_name are only rewritten on conflict when the voter's profile changed.
+async def update_player_scores(conn, deltas):
+    # deltas: iterable of _ScoreDelta, written with one prepared upsert inside the caller's transaction
+    args = [(d.user_id, d.group_id, d.username, d.first_name, d.score, d.correct, d.wrong, d.run, d.best, d.reset, d.lead, d.profile_changed) for d in deltas]
+    if args:
+        await conn.executemany("players.add_scores", args)
+        for gid in {d.group_id for d in deltas}:
+            note_write(gid)
+
+async def log_answers(conn, votes):
+    # one answer_log row per scored vote, in the caller's transaction (rolled up by run_rollup)
+    now = int(time.time())
+    args = [(v.group_id, v.user_id, POINTS_CORRECT if v.is_correct else POINTS_WRONG, now) for v in votes]
+    if args:
+        await conn.executemany("answers.log", args)
+
+# ---------------- Question bank & per-group decks ----------------
+# The bank is loaded once and kept in memory; positions index _question_ids (ascending id,
+# so questions added later are appended). Each group deals from its own shuffled deck:
+# a keyed Feistel permutation over 2**bits slots plus a cursor, so a deck is three ints
+# (seed, position, bits) in memory and in question_decks. Slots mapping past the end of
+# the bank are skipped, which lets questions added mid-cycle land in the remaining slots.
+_question_bank: dict[int, tuple] = {}   # id -> (id, question, a, b, c, d, correct, category)
+_question_ids: list[int] = []
+_decks: dict[int, list] = {}            # group_id -> [seed, position, bits]
+_M64 = (1 << 64) - 1
+
+def _mix64(x: int) -> int:
+    # splitmix64 finalizer
+    x = (x + 0x9E3779B97F4A7C15) & _M64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _M64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _M64
+    return x ^ (x >> 31)
+
+def _deck_slot(seed: int, bits: int, pos: int) -> int:
+    # 4-round balanced Feistel network: a bijection on [0, 2**bits)
+    half = bits // 2
+    mask = (1 << half) - 1
+    left, right = pos >> half, pos & mask
+    for rnd in range(4):
+        left, right = right, left ^ (_mix64(seed ^ (rnd << 56) ^ right) & mask)
+    return (left << half) | right
+
+def _deck_bits(n: int) -> int:
+    bits = 2
+    while (1 << bits) < n:
+        bits += 2
+    return bits
+
+def _new_deck(n: int) -> list:
+    return [random.getrandbits(62), 0, _deck_bits(n)]
+
+def _deal(deck: list, n: int) -> int:
+    # Next bank position for this deck; starts a fresh shuffle when the cycle ends or the bank outgrew the domain
+    if n > (1 << deck[2]):
+        deck[:] = _new_deck(n)
+    while True:
+        if deck[1] >= (1 << deck[2]):
+            deck[:] = _new_deck(n)
+        idx = _deck_slot(deck[0], deck[2], deck[1])
+        deck[1] += 1
+        if idx < n:
+            return idx
+
+def _bank_add(row):
+    qid = row[0]
+    if qid is None or qid in _question_bank:
+        return
+    _question_bank[qid] = tuple(row[:8])
+    _question_ids.append(qid)
+    if _question_hashes is not None:
+        _question_hashes.add(question_hash(row[1:6]))
+
+QUESTION_COLUMNS = ("question", "option_a", "option_b", "option_c", "option_d", "correct_answer", "category")
+_question_hashes: Optional[set] = None  # content hashes of the bank, built on first import
+
+def question_hash(fields) -> str:
+    # question + options, case/whitespace-insensitive
+    norm = "\x1f".join(" ".join(str(f).split()).casefold() for f in fields)
+    return hashlib.sha1(norm.encode()).hexdigest()[:20]
+
+def bank_hashes() -> set:
+    global _question_hashes
+    if _question_hashes is None:
+        _question_hashes = {question_hash(q[1:6]) for q in _question_bank.values()}
+    return _question_hashes
+
+def validate_question(parts) -> tuple:
+    # the /newq rules: 7 fields, correct index 0..3; returns a questions row
+    if len(parts) != 7:
+        raise ValueError("Wrong format: expected 7 fields")
+    q,a,b,c,d,corr,cat = [("" if p is None else str(p)).strip() for p in parts]
+    if not all((q, a, b, c, d)):
+        raise ValueError("Question and options can't be empty")
+    try:
+        corr_i = int(corr)
+    except ValueError:
+        corr_i = -1
+    if corr_i not in (0,1,2,3):
+        raise ValueError("Correct index must be 0..3")
+    return (q, a, b, c, d, corr_i, cat)
+
+async def load_question_bank():
+    # Pull questions newer than what we already hold (everything on first call)
+    last = _question_ids[-1] if _question_ids else 0
+    rows = await db_fetch("questions.after", last)
+    for r in rows:
+        _bank_add(r)
+    return len(rows)
+
+async def refresh_question_bank():
+    # Sharded workers: pick up questions other workers added, rebuild after a /deleteallq elsewhere
+    count, top = await db_fetchrow("questions.stats")
+    if int(count) < len(_question_ids) or (top or 0) < (_question_ids[-1] if _question_ids else 0):
+        _question_bank.clear(); _question_ids.clear()
+        if _question_hashes is not None:
+            _question_hashes.clear()
+        await load_decks()
+    if int(count) != len(_question_ids):
+        await load_question_bank()
+
+async def load_decks():
+    _decks.clear()
+    for gid, seed, pos, bits in await db_fetch("decks.all"):
+        _decks[int(gid)] = [int(seed), int(pos), int(bits)]
+
+async def _save_deck(group_id: int, deck: list):
+    await db_execute("decks.save", group_id, *deck)
+
+async def get_next_question(group_id:int):
+    # deal the next question from the group's deck: O(1), one small row written
+    n = len(_question_ids)
+    if n == 0:
+        return None
+    deck = _decks.get(group_id)
+    if deck is None:
+        deck = _decks[group_id] = _new_deck(n)
+    idx = _deal(deck, n)
+    await _save_deck(group_id, deck)
+    return _question_bank[_question_ids[idx]]
+
+async def reset_question_deck(group_id:int):
+    # O(1): reshuffle with a new seed, nothing to delete
+    deck = _decks[group_id] = _new_deck(len(_question_ids))
+    await _save_deck(group_id, deck)
+
+async def clear_question_bank():
+    async with db_transaction() as conn:
+        await conn.execute("questions.delete_all")
+        note_write()
+        await conn.execute("decks.delete_all")
+    _question_bank.clear(); _question_ids.clear(); _decks.clear()
+    if _question_hashes is not None:
+        _question_hashes.clear()
+
+# ---------------- Active poll registry ----------------
+# Write-through in-memory view of active_polls so the vote path never reads the DB.
+# Rebuilt from the table at startup by load_active_polls(). Votes are matched by poll_id:
+# UpdateMessagePollVote only carries the poll id and the voter's peer.
+# After a rebalance load_active_polls() only adds polls of chats gained and drops those of
+# chats lost; entries of chats kept, or changed while it read the table, are left alone.
+class ActivePoll(NamedTuple):
+    group_id: int
+    poll_id: str
+    question_id: int
+    message_id: int
+    correct_answer: int
+
+_active_polls: dict[int, ActivePoll] = {}     # group_id -> poll
+_polls_by_id: dict[str, ActivePoll] = {}      # poll_id -> poll
+_poll_voters: dict[str, set] = {}             # poll_id -> user ids already scored (vote mode); mirrors poll_votes
+_polls_changed: Optional[set] = None          # groups whose poll changed during a load_active_polls() read
+
+def _poll_changed(group_id: int):
+    if _polls_changed is not None:
+        _polls_changed.add(group_id)
+
+def _register_poll(ap: ActivePoll):
+    _poll_changed(ap.group_id)
+    old = _active_polls.pop(ap.group_id, None)
+    if old:
+        _polls_by_id.pop(old.poll_id, None)
+        _poll_voters.pop(old.poll_id, None)
+    _active_polls[ap.group_id] = ap
+    _polls_by_id[ap.poll_id] = ap
+
+async def load_active_polls():
+    # Every read first, then one synchronous swap: votes keep matching throughout, and a poll
+    # sent or removed while the table was being read isn't undone by the older row.
+    global _polls_changed
+    _polls_changed = set()
+    try:
+        rows = await db_fetch("polls.all")
+        voters = await db_fetch("votes.active") if SCORING_MODE == "vote" else []
+        tallies = await db_fetch("tallies.active") if SCORING_MODE == "close" else []
+        changed = _polls_changed
+    finally:
+        _polls_changed = None
+    for gid in [g for g in _active_polls if not owns_chat(g)]:
+        ap = _active_polls.pop(gid)  # chat lost: its new owner scores and closes it
+        _polls_by_id.pop(ap.poll_id, None)
+        _poll_voters.pop(ap.poll_id, None)
+        disarm_poll(ap.poll_id)
+    gained = []
+    for gid, poll_id, qid, mid, correct in rows:
+        gid = int(gid)
+        if owns_chat(gid) and gid not in _active_polls and gid not in changed:
+            ap = ActivePoll(gid, str(poll_id), qid, int(mid), int(correct))
+            _register_poll(ap)
+            gained.append(ap)
+    new_ids = {ap.poll_id for ap in gained}
+    for pid, uid in voters:
+        if str(pid) in new_ids:
+            _poll_voters.setdefault(str(pid), set()).add(int(uid))
+    if SCORING_MODE == "close":
+        # close times aren't stored: a loaded poll has closed within POLL_CLOSE_SECONDS
+        saved = load_poll_tallies([t for t in tallies if str(t[0]) in new_ids])
+        for ap in gained:
+            if ap.poll_id not in saved:
+                _tallies_partial.add(ap.poll_id)  # no shutdown snapshot: live votes were lost
+            arm_poll_timer(ap, POLL_CLOSE_SECONDS)
+    print(f"[DB] {len(_active_polls)} active polls ({len(gained)} loaded)")
+
+async def store_active_poll(group_id:int, poll_id:str, question_id:int, message_id:int, correct_answer:int):
+    await db_execute("polls.save", group_id, poll_id, question_id, message_id)
+    _register_poll(ActivePoll(group_id, poll_id, question_id, message_id, correct_answer))
+
+def get_active_poll(group_id:int) -> Optional[ActivePoll]:
+    return _active_polls.get(group_id)
+
+def find_active_poll(poll_id) -> Optional[ActivePoll]:
+    return _polls_by_id.get(str(poll_id))
+
+async def remove_active_poll(group_id:int):
+    _poll_changed(group_id)
+    ap = _active_polls.pop(group_id, None)
+    async with db_conn() as conn:
+        await conn.execute("polls.delete", group_id)
+        if ap:
+            _polls_by_id.pop(ap.poll_id, None)
+            if _poll_voters.pop(ap.poll_id, None) is not None:
+                await conn.execute("votes.forget", ap.poll_id)
+            disarm_poll(ap.poll_id)
+
+# ---------------- Caches ----------------
+class LRUCache:
+    # Bounded LRU with a per-entry TTL; counts hits and misses
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def drop_where(self, pred):
+        for key in [k for k in self._data if pred(k)]:
+            del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses, "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0}
+
+# user_id -> (username, first_name): the profile last seen or written for that user
+_profiles = LRUCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+async def resolve_voter_profile(entity, user_id: int, group_id: int) -> Tuple[Optional[str], str, bool]:
+    # (username, first_name, changed) without an MTProto call: the user entity Telegram sent
+    # along (if any), then the cache, then the player's/user's row in the DB
+    cached = _profiles.get(user_id)
+    if entity is not None:
+        prof = (getattr(entity, 'username', None), getattr(entity, 'first_name', None) or "")
+        _profiles.set(user_id, prof)
+        return prof[0], prof[1], prof != cached
+    if cached is not None:
+        return cached[0], cached[1], False
+    row = await db_fetchrow("players.profile", user_id, group_id)
+    changed = row is None  # new player: the insert writes the profile anyway
+    if row is None:
+        row = await db_fetchrow("users.profile", user_id)
+    prof = (row[0], row[1] or "") if row else (None, "User")
+    _profiles.set(user_id, prof)
+    return prof[0], prof[1], changed
+
+# ---------------- Leaderboards ----------------
+# Per-group in-memory board, loaded from players on first use and then kept current by
+# apply_board_deltas after each committed score batch. `order` is sorted by
+# (-score, -correct_answers, user_id), so the top-K is a slice and a rank is a bisect.
+# The rendered /leaderboard text is cached until a change touches the top-K.
+LEADERBOARD_SIZE = 10
+
+class _GroupBoard:
+    __slots__ = ("players", "order", "text")
+
+    def __init__(self):
+        self.players: dict[int, list] = {}   # user_id -> [username, first_name, score, correct, wrong, cur_streak, max_streak]
+        self.order: list[Tuple[int, int, int]] = []
+        self.text: Optional[str] = None
+
+    @staticmethod
+    def key(uid: int, p: list) -> Tuple[int, int, int]:
+        return (-p[2], -p[3], uid)
+
+    def put(self, uid: int, p: list):
+        old = self.players.get(uid)
+        touched = False
+        if old is not None:
+            i = bisect.bisect_left(self.order, self.key(uid, old))
+            del self.order[i]
+            touched = i < LEADERBOARD_SIZE
+        self.players[uid] = p
+        j = bisect.bisect_left(self.order, self.key(uid, p))
+        self.order.insert(j, self.key(uid, p))
+        if touched or j < LEADERBOARD_SIZE:
+            self.text = None
+
+    def rank(self, uid: int) -> Optional[int]:
+        p = self.players.get(uid)
+        return bisect.bisect_left(self.order, self.key(uid, p)) + 1 if p else None
+
+    def top(self, k: int = LEADERBOARD_SIZE):
+        return [(uid, self.players[uid]) for _, _, uid in self.order[:k]]
+
+_boards: dict[int, _GroupBoard] = {}
+_board_gen: dict[int, int] = {}  # bumped on every applied change; a load that raced one is retried
+
+async def get_board(group_id: int) -> _GroupBoard:
+    board = _boards.get(group_id)
+    while board is None:
+        gen = _board_gen.get(group_id, 0)
+        rows = await db_fetch("players.group", group_id)
+        if _board_gen.get(group_id, 0) != gen or group_id in _boards:
+            board = _boards.get(group_id)
+            continue
+        board = _GroupBoard()
+        for r in rows:
+            board.players[int(r[0])] = [r[1], r[2], int(r[3]), int(r[4]), int(r[5]), int(r[6]), int(r[7])]
+        board.order = sorted(board.key(uid, p) for uid, p in board.players.items())
+        _boards[group_id] = board
+    return board
+
+async def warm_boards():
+    # startup: one query loads the boards (and voter profiles) of every group with a poll
+    # running, i.e. the groups whose votes arrive first
+    rows = await db_fetch("players.active_groups")
+    boards = {}
+    for r in rows:
+        gid = int(r[0])
+        if not owns_chat(gid) or gid in _boards:
+            continue
+        board = boards.setdefault(gid, _GroupBoard())
+        board.players[int(r[1])] = [r[2], r[3], int(r[4]), int(r[5]), int(r[6]), int(r[7]), int(r[8])]
+        _profiles.set(int(r[1]), (r[2], r[3] or ""))
+    for gid, board in boards.items():
+        board.order = sorted(board.key(uid, p) for uid, p in board.players.items())
+        _boards[gid] = board
+    print(f"[DB] {len(boards)} leaderboards warmed ({len(rows)} players)")
+
+def apply_board_deltas(deltas):
+    # mirror of the players upsert in update_player_scores, applied after commit
+    for d in deltas:
+        _board_gen[d.group_id] = _board_gen.get(d.group_id, 0) + 1
+        board = _boards.get(d.group_id)
+        if board is None:
+            continue
+        old = board.players.get(d.user_id)
+        if old is None:
+            p = [d.username, d.first_name, d.score, d.correct, d.wrong, d.run, d.best]
         else:
-            await db_execute(
-                "UPDATE players SET score = score + ?, correct_answers = correct_answers + 1, current_streak = current_streak + 1, max_streak = CASE WHEN max_streak < current_streak+1 THEN current_streak+1 ELSE max_streak END, last_answer_time = CURRENT_TIMESTAMP WHERE user_id=? AND group_id=?",
-                points, user_id, group_id
-            )
-    else:
-        if USE_POSTGRES:
-            await db_execute("UPDATE players SET score = score + $1, wrong_answers = wrong_answers + 1, current_streak = 0, last_answer_time = CURRENT_TIMESTAMP WHERE user_id=$2 AND group_id=$3", points, user_id, group_id)
+            p = list(old)
+            if d.profile_changed:
+                p[0], p[1] = d.username, d.first_name
+            p[2] += d.score; p[3] += d.correct; p[4] += d.wrong
+            p[6] = max(p[6], p[5] + d.lead, d.best)
+            p[5] = d.run if d.reset else p[5] + d.lead
+        board.put(d.user_id, p)
+
+def drop_board(group_id: int):
+    # O(1); the next read reloads from the DB
+    _board_gen[group_id] = _board_gen.get(group_id, 0) + 1
+    _boards.pop(group_id, None)
+
+def render_board(board: _GroupBoard) -> Optional[str]:
+    if board.text is None:
+        top = board.top()
+        if not top:
+            return None
+        lines = ["🏆 <b>Group Leaderboard</b>\n"]
+        medals = ["👑","🥈","🥉"]
+        for i, (uid, p) in enumerate(top, start=1):
+            uname, fname, score, corr, wrong, cur, mx = p
+            rank = medals[i-1] if i<=3 else f"{i}."
+            disp = f"@{uname}" if uname else (fname or str(uid))
+            streak = f" ({cur}🔥)" if cur>0 else ""
+            lines.append(f"{rank} <b>{html_escape(disp)}</b>{streak}\n    💯 {score} | ✅ {corr} | ❌ {wrong} | 🔥 Max {mx}")
+        board.text = "\n".join(lines)
+    return board.text
+
+# ---------------- Vote ingestion (write-behind) ----------------
+# on_poll_vote only enqueues; one background flusher coalesces votes per (user, group)
+# and writes each batch in a single transaction.
+class Vote(NamedTuple):
+    user_id: int
+    group_id: int
+    username: Optional[str]
+    first_name: str
+    is_correct: bool
+    profile_changed: bool = True
+    poll_id: Optional[str] = None  # vote mode: recorded in poll_votes with the score
+
+POINTS_CORRECT, POINTS_WRONG = 4, -1
+
+class _ScoreDelta:
+    __slots__ = ("user_id", "group_id", "username", "first_name", "profile_changed", "score", "correct", "wrong", "lead", "reset", "run", "best")
+
+    def __init__(self, user_id: int, group_id: int):
+        self.user_id = user_id; self.group_id = group_id
+        self.username = None; self.first_name = ""; self.profile_changed = False
+        self.score = self.correct = self.wrong = self.lead = self.run = self.best = 0
+        self.reset = False
+
+    def add(self, v: Vote):
+        self.username = v.username; self.first_name = v.first_name
+        self.profile_changed = self.profile_changed or v.profile_changed
+        if v.is_correct:
+            self.score += POINTS_CORRECT; self.correct += 1; self.run += 1
+            if not self.reset:
+                self.lead += 1
+            self.best = max(self.best, self.run)
         else:
-            await db_execute("UPDATE players SET score = score + ?, wrong_answers = wrong_answers + 1, current_streak = 0, last_answer_time = CURRENT_TIMESTAMP WHERE user_id=? AND group_id=?", points, user_id, group_id)
+            self.score += POINTS_WRONG; self.wrong += 1; self.run = 0
+            self.reset = True
 
-async def get_next_question(group_id:int):
-    # choose unused question for group
-    if USE_POSTGRES:
-        rows = await db_fetch(
-            "SELECT q.* FROM questions q LEFT JOIN question_usage qu ON q.id=qu.question_id AND qu.group_id=$1 WHERE qu.question_id IS NULL ORDER BY RANDOM() LIMIT 1", group_id
-        )
-        if not rows:
-            await db_execute("DELETE FROM question_usage WHERE group_id=$1", group_id)
-            rows = await db_fetch("SELECT * FROM questions ORDER BY RANDOM() LIMIT 1")
-        q = rows[0] if rows else None
-        if q:
-            await db_execute("INSERT INTO question_usage (group_id, question_id) VALUES ($1,$2) ON CONFLICT DO NOTHING", group_id, q[0])
-        return q
-    else:
-        rows = await db_fetch("SELECT q.* FROM questions q LEFT JOIN question_usage qu ON q.id=qu.question_id AND qu.group_id=? WHERE qu.question_id IS NULL ORDER BY RANDOM() LIMIT 1", group_id)
-        if not rows:
-            await db_execute("DELETE FROM question_usage WHERE group_id=?", group_id)
-            rows = await db_fetch("SELECT * FROM questions ORDER BY RANDOM() LIMIT 1")
-        q = rows[0] if rows else None
-        if q:
-            await db_execute("INSERT OR REPLACE INTO question_usage (group_id, question_id) VALUES (?,?)", group_id, q[0])
-        return q
-
-async def store_active_poll(group_id:int, poll_id:str, question_id:int, message_id:int):
-    if USE_POSTGRES:
-        await db_execute("INSERT INTO active_polls (group_id, poll_id, question_id, message_id) VALUES ($1,$2,$3,$4) ON CONFLICT (group_id) DO UPDATE SET poll_id=EXCLUDED.poll_id, question_id=EXCLUDED.question_id, message_id=EXCLUDED.message_id", group_id, poll_id, question_id, message_id)
+_vote_queue: Optional[asyncio.Queue] = None
+_vote_flusher: Optional[asyncio.Task] = None
+_vote_stats = {"enqueued": 0, "duplicates": 0, "dropped": 0, "lost": 0, "flushed": 0, "batches": 0, "rows": 0, "last_batch": 0, "max_batch": 0, "errors": 0}
+
+def _coalesce_votes(votes) -> list:
+    deltas: dict[Tuple[int, int], _ScoreDelta] = {}
+    for v in votes:
+        key = (v.user_id, v.group_id)
+        d = deltas.get(key)
+        if d is None:
+            d = deltas[key] = _ScoreDelta(v.user_id, v.group_id)
+        d.add(v)
+    return list(deltas.values())
+
+async def _flush_votes(batch: list):
+    deltas = _coalesce_votes(batch)
+    for attempt in range(3):
+        try:
+            async with db_transaction() as conn:
+                await update_player_scores(conn, deltas)
+                await log_answers(conn, batch)
+                await conn.executemany("votes.record", [(v.poll_id, v.user_id) for v in batch if v.poll_id])
+            break
+        except Exception as e:
+            _vote_stats["errors"] += 1
+            print(f"[ERR] vote flush ({len(batch)} votes, attempt {attempt + 1}): {e}")
+            await asyncio.sleep(0.5 * (attempt + 1))
     else:
-        await db_execute("INSERT OR REPLACE INTO active_polls (group_id, poll_id, question_id, message_id) VALUES (?,?,?,?)", group_id, poll_id, question_id, message_id)
+        print(f"[ERR] vote flush gave up, {len(batch)} votes lost")
+        _vote_stats["lost"] += len(batch)
+        # never written: let a redelivered copy of these votes score
+        for v in batch:
+            voters = _poll_voters.get(v.poll_id)
+            if voters is not None:
+                voters.discard(v.user_id)
+        return
+    apply_board_deltas(deltas)
+    _vote_stats["flushed"] += len(batch)
+    _vote_stats["batches"] += 1
+    _vote_stats["rows"] += len(deltas)
+    _vote_stats["last_batch"] = len(batch)
+    _vote_stats["max_batch"] = max(_vote_stats["max_batch"], len(batch))
+
+async def _vote_flush_loop():
+    loop = asyncio.get_running_loop()
+    stop = False
+    while not stop:
+        first = await _vote_queue.get()
+        if first is None:
+            break
+        batch = [first]
+        deadline = loop.time() + VOTE_FLUSH_MS / 1000
+        while len(batch) < VOTE_BATCH_MAX:
+            try:
+                v = _vote_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    v = await asyncio.wait_for(_vote_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if v is None:  # shutdown sentinel: write what we have and exit
+                stop = True
+                break
+            batch.append(v)
+        await _flush_votes(batch)
 
-async def get_active_poll(group_id:int):
-    row = await db_fetchrow("SELECT poll_id, question_id, message_id FROM active_polls WHERE group_id=$1" if USE_POSTGRES else "SELECT poll_id, question_id, message_id FROM active_polls WHERE group_id=?", group_id)
-    return row
+async def start_vote_pipeline():
+    global _vote_queue, _vote_flusher
+    _vote_queue = asyncio.Queue(maxsize=VOTE_QUEUE_MAX)
+    _vote_flusher = asyncio.create_task(_vote_flush_loop())
 
-async def remove_active_poll(group_id:int):
-    if USE_POSTGRES:
-        await db_execute("DELETE FROM active_polls WHERE group_id=$1", group_id)
+async def stop_vote_pipeline():
+    # Flush everything still queued, then stop the flusher
+    global _vote_flusher
+    if _vote_flusher is None:
+        return
+    await _vote_queue.put(None)
+    await _vote_flusher
+    _vote_flusher = None
+    print(f"[VOTE] pipeline drained ({_vote_stats['flushed']} votes written)")
+
+async def submit_vote(v: Vote) -> bool:
+    # False if the vote was dropped (VOTE_QUEUE_POLICY=drop and the queue is full)
+    if VOTE_QUEUE_POLICY == "drop":
+        try:
+            _vote_queue.put_nowait(v)
+        except asyncio.QueueFull:
+            _vote_stats["dropped"] += 1
+            return False
     else:
-        await db_execute("DELETE FROM active_polls WHERE group_id=?", group_id)
+        await _vote_queue.put(v)
+    _vote_stats["enqueued"] += 1
+    return True
+
+def vote_pipeline_stats() -> dict:
+    batches = _vote_stats["batches"]
+    return {
+        "queue_depth": _vote_queue.qsize() if _vote_queue else 0,
+        "queue_max": VOTE_QUEUE_MAX,
+        **_vote_stats,
+        "avg_batch": round(_vote_stats["flushed"] / batches, 1) if batches else 0.0,
+    }
+
+# ---------------- Close-time scoring ----------------
+# SCORING_MODE=close: quiz polls are sent with a close_period and scored once, when they close.
+# A timer per poll runs the finalizer, which reads the voters of each option in pages
+# (GetPollVotes) and writes the whole round in one transaction that also deletes the poll's
+# active_polls row, so a round is scored once even if the timer and the next send race.
+# A poll finalized before it closes (/quiznow, a shorter /setinterval) is closed first.
+# on_poll_vote only notes the choice in memory, used if the voter list can't be fetched;
+# the notes are saved at shutdown. After a crash they are incomplete, so a failed fetch is
+# retried instead of claiming the round with whatever was seen since the restart.
+POLL_VOTES_PAGE = 50
+FINALIZE_RETRY_SECONDS = 60
+FINALIZE_RETRIES = 10
+_poll_timers: dict[str, asyncio.Task] = {}  # poll_id -> close timer
+_poll_closes_at: dict[str, float] = {}      # poll_id -> when Telegram closes it
+_finalizing: dict[str, asyncio.Task] = {}   # poll_id -> running finalization
+_poll_tallies: dict[str, dict] = {}         # poll_id -> {user_id: option} seen in vote updates
+_tallies_partial: set = set()               # polls loaded without a tally snapshot
+_finalize_attempts: dict[str, int] = {}     # poll_id -> voter fetches failed so far
+
+def poll_close_period(interval_minutes: int) -> int:
+    # Telegram accepts 5..600 seconds; close before the next (jittered) question is due
+    return int(max(5, min(POLL_CLOSE_SECONDS, 600, int(interval_minutes) * 60 - SCHED_JITTER_SECONDS - 5)))
+
+def note_poll_vote(ap: ActivePoll, user_id: int, option: bytes, entity=None):
+    _poll_tallies.setdefault(ap.poll_id, {})[user_id] = option
+    if entity is not None:
+        _profiles.set(user_id, (getattr(entity, 'username', None), getattr(entity, 'first_name', None) or ""))
+
+def arm_poll_timer(ap: ActivePoll, delay: float):
+    old = _poll_timers.pop(ap.poll_id, None)
+    if old:
+        old.cancel()
+    _poll_closes_at.setdefault(ap.poll_id, time.time() + delay)  # retries don't move it
+    _poll_timers[ap.poll_id] = asyncio.create_task(_close_timer(ap, delay))
+
+def disarm_poll(poll_id: str):
+    t = _poll_timers.pop(poll_id, None)
+    if t:
+        t.cancel()
+    _poll_tallies.pop(poll_id, None)
+    _poll_closes_at.pop(poll_id, None)
+    _tallies_partial.discard(poll_id)
+    _finalize_attempts.pop(poll_id, None)
+
+def load_poll_tallies(rows) -> set:
+    # rows of tallies.active; user 0 marks a snapshot, so a poll nobody voted on still has one
+    saved = set()
+    for pid, uid, choice in rows:
+        pid = str(pid)
+        saved.add(pid)
+        if int(uid):
+            _poll_tallies.setdefault(pid, {})[int(uid)] = choice.encode("latin-1")
+    return saved
+
+async def save_poll_tallies():
+    rows = []
+    for ap in _active_polls.values():
+        if ap.poll_id in _tallies_partial:
+            continue  # still incomplete: a snapshot would pass it off as whole
+        rows.append((ap.poll_id, 0, ""))
+        rows += [(ap.poll_id, uid, opt.decode("latin-1")) for uid, opt in _poll_tallies.get(ap.poll_id, {}).items()]
+    if rows:
+        async with db_transaction() as conn:
+            await conn.executemany("tallies.save", rows)
 
-async def get_group_leaderboard(group_id:int, limit:int=10):
-    rows = await db_fetch("SELECT user_id, username, first_name, score, correct_answers, wrong_answers, current_streak, max_streak FROM players WHERE group_id=$1 ORDER BY score DESC, correct_answers DESC LIMIT $2" if USE_POSTGRES else "SELECT user_id, username, first_name, score, correct_answers, wrong_answers, current_streak, max_streak FROM players WHERE group_id=? ORDER BY score DESC, correct_answers DESC LIMIT ?", group_id, limit)
-    return rows
+async def close_poll(ap: ActivePoll):
+    # mark the poll closed in the chat: an edit carrying the same poll with closed=True
+    q = await db_fetchrow("questions.get", ap.question_id)
+    if not q:
+        return
+    media = types.InputMediaPoll(poll=quiz_poll(q, int(ap.poll_id), closed=True), correct_answers=[bytes([65 + ap.correct_answer])])
+    try:
+        await outbound(ap.group_id, PRIO_POLL, functools.partial(client, functions.messages.EditMessageRequest(peer=ap.group_id, id=ap.message_id, media=media)))
+    except errors.RPCError as e:
+        print(f"[WARN] close poll {ap.poll_id} in {ap.group_id}: {e}")
+
+async def _close_timer(ap: ActivePoll, delay: float):
+    await asyncio.sleep(delay + 2)  # a little after Telegram closes it
+    _poll_timers.pop(ap.poll_id, None)
+    try:
+        await asyncio.shield(finalize_poll(ap))
+    except Exception as e:
+        print(f"[ERR] finalize poll {ap.poll_id} in {ap.group_id}: {e}")
+
+def finalize_poll(ap: ActivePoll) -> asyncio.Task:
+    # one finalization per poll at a time; callers share the running one
+    t = _finalizing.get(ap.poll_id)
+    if t is None:
+        t = _finalizing[ap.poll_id] = asyncio.create_task(_finalize(ap))
+        t.add_done_callback(lambda _: _finalizing.pop(ap.poll_id, None))
+    return t
+
+async def _fetch_poll_votes(ap: ActivePoll) -> list:
+    correct = bytes([65 + ap.correct_answer])
+    votes = []
+    for option in (b"A", b"B", b"C", b"D"):
+        offset = None
+        while True:
+            res = await client(functions.messages.GetPollVotesRequest(peer=ap.group_id, id=ap.message_id, option=option, offset=offset, limit=POLL_VOTES_PAGE))
+            users = {u.id: u for u in res.users}
+            for pv in res.votes:
+                if not isinstance(pv.peer, types.PeerUser):
+                    continue
+                uid = pv.peer.user_id
+                username, first_name, changed = await resolve_voter_profile(users.get(uid), uid, ap.group_id)
+                votes.append(Vote(uid, ap.group_id, username, first_name, option == correct, changed))
+            offset = res.next_offset
+            if not offset or not res.votes:
+                break
+    return votes
+
+async def _finalize(ap: ActivePoll) -> Optional[int]:
+    # votes scored, or None if the round is left for a retry (the poll stays active)
+    if time.time() < _poll_closes_at.get(ap.poll_id, 0):
+        await close_poll(ap)  # finalized early: votes after this point would be ignored
+    try:
+        votes = await _fetch_poll_votes(ap)
+    except errors.RPCError as e:
+        seen = _poll_tallies.get(ap.poll_id, {})
+        if ap.poll_id in _tallies_partial:
+            attempt = _finalize_attempts[ap.poll_id] = _finalize_attempts.get(ap.poll_id, 0) + 1
+            if attempt < FINALIZE_RETRIES:
+                print(f"[WARN] voters of poll {ap.poll_id} unavailable ({e}), votes before the restart weren't kept; retry {attempt} in {FINALIZE_RETRY_SECONDS}s")
+                arm_poll_timer(ap, FINALIZE_RETRY_SECONDS)
+                return None
+            print(f"[WARN] voters of poll {ap.poll_id} unavailable ({e}) after {attempt} tries; scoring only the {len(seen)} votes seen since the restart")
+        else:
+            print(f"[WARN] voters of poll {ap.poll_id} unavailable ({e}); scoring the {len(seen)} votes seen live")
+        correct = bytes([65 + ap.correct_answer])
+        votes = []
+        for uid, option in seen.items():
+            username, first_name, changed = await resolve_voter_profile(None, uid, ap.group_id)
+            votes.append(Vote(uid, ap.group_id, username, first_name, option == correct, changed))
+    deltas = _coalesce_votes(votes)
+    async with db_transaction() as conn:
+        claimed = await conn.fetchval("polls.claim", ap.group_id, ap.poll_id)
+        if claimed is None:
+            return 0  # already scored
+        await conn.execute("tallies.forget", ap.poll_id)
+        await update_player_scores(conn, deltas)
+        await log_answers(conn, votes)
+    apply_board_deltas(deltas)
+    if _active_polls.get(ap.group_id) == ap:
+        _poll_changed(ap.group_id)
+        del _active_polls[ap.group_id]
+    _polls_by_id.pop(ap.poll_id, None)
+    disarm_poll(ap.poll_id)
+    print(f"[POLL] {ap.poll_id} in {ap.group_id} scored: {len(votes)} votes, {len(deltas)} players")
+    return len(votes)
+
+async def stop_poll_timers():
+    # pending closes are re-armed from active_polls on the next start, with the votes seen so far
+    for t in list(_poll_timers.values()):
+        t.cancel()
+    _poll_timers.clear()
+    if _finalizing:
+        await asyncio.gather(*_finalizing.values(), return_exceptions=True)
+    if SCORING_MODE == "close":
+        try:
+            await save_poll_tallies()
+        except Exception as e:
+            print(f"[ERR] saving poll tallies: {e}")
+
+# ---------------- Answer log rollups ----------------
+# Every scored vote is appended to answer_log (log_answers). A background job folds the rows
+# past the rollup_state watermark into answer_daily / answer_weekly (per group) and
+# global_scores (per user) in one transaction, so /weekboard and /globalboard read a few
+# pre-aggregated rows. Rows younger than ROLLUP_SETTLE seconds wait for the next pass: ids
+# come from a sequence, and a slower writer can commit a lower id after a higher one.
+# Raw rows are pruned ANSWER_LOG_DAYS after they were rolled up.
+ROLLUP_SETTLE = 5
+_ROLLUP_LOCK = 0x524F4C4C  # pg advisory lock key: one worker rolls up at a time
+_rollup_task: Optional[asyncio.Task] = None
+_rollup_stats = {"runs": 0, "rows": 0, "watermark": 0, "errors": 0}
+_rollup_boards = LRUCache(1024, ROLLUP_INTERVAL)  # rendered /weekboard and /globalboard texts
 
-async def get_all_users():
-    rows = await db_fetch("SELECT DISTINCT user_id FROM users")
-    return [r[0] for r in rows]
+def epoch_week(ts: float) -> int:
+    # Monday-based week number; must match rollup.weekly
+    return (int(ts) // 86400 + 3) // 7
 
-async def get_all_groups():
-    rows = await db_fetch("SELECT group_id FROM groups")
-    return [r[0] for r in rows]
+async def run_rollup() -> int:
+    # fold up to ROLLUP_BATCH log ids into the rollups; returns the id span consumed
+    async with db_transaction() as conn:
+        if USE_POSTGRES:
+            await conn.execute("locks.xact", _ROLLUP_LOCK)
+        lo = await conn.fetchval("rollup.watermark", "answers") or 0
+        hi = await conn.fetchval("rollup.high", lo, lo + ROLLUP_BATCH, int(time.time()) - ROLLUP_SETTLE)
+        if hi > lo:
+            for name in ("rollup.daily", "rollup.weekly", "rollup.global"):
+                await conn.execute(name, lo, hi)
+            await conn.execute("rollup.set_watermark", "answers", hi)
+    _rollup_stats["runs"] += 1
+    _rollup_stats["rows"] += hi - lo
+    _rollup_stats["watermark"] = hi
+    return hi - lo
+
+async def prune_answer_log():
+    # hourly: raw rows already rolled up and older than ANSWER_LOG_DAYS, daily rows past
+    # ROLLUP_DAILY_DAYS, and leftover dedupe and tally rows of closed polls
+    now = int(time.time())
+    async with db_conn() as conn:
+        watermark = await conn.fetchval("rollup.watermark", "answers") or 0
+        await conn.execute("answers.prune", watermark, now - ANSWER_LOG_DAYS * 86400)
+        await conn.execute("rollup.prune_daily", now // 86400 - ROLLUP_DAILY_DAYS)
+        await conn.execute("votes.prune")  # dedupe rows of polls closed while their last votes were queued
+        await conn.execute("tallies.prune")  # snapshots of polls removed without being scored
+
+async def _rollup_loop():
+    last_prune = 0.0
+    while True:
+        await asyncio.sleep(ROLLUP_INTERVAL)
+        try:
+            while await run_rollup() >= ROLLUP_BATCH:
+                pass  # backlog: keep going
+            if time.time() - last_prune > 3600:
+                await prune_answer_log()
+                last_prune = time.time()
+        except Exception as e:
+            _rollup_stats["errors"] += 1
+            print(f"[ERR] rollup: {e}")
+
+async def start_rollups():
+    global _rollup_task
+    _rollup_task = asyncio.create_task(_rollup_loop())
+
+async def stop_rollups():
+    global _rollup_task
+    if _rollup_task:
+        _rollup_task.cancel()
+        _rollup_task = None
+
+async def player_display_name(user_id: int) -> str:
+    prof = _profiles.get(user_id)
+    if prof is None:
+        row = await db_fetchrow("players.any_profile", user_id) or await db_fetchrow("users.profile", user_id)
+        prof = (row[0], row[1] or "") if row else (None, "")
+        _profiles.set(user_id, prof)
+    return f"@{prof[0]}" if prof[0] else (prof[1] or str(user_id))
+
+async def render_rollup_board(key: tuple, title: str, query: str, *params) -> Optional[str]:
+    # top-N straight from a rollup table; the text is cached for one rollup interval
+    text = _rollup_boards.get(key)
+    if text is None:
+        rows = await db_fetch(query, *params, LEADERBOARD_SIZE)
+        if not rows:
+            return None
+        lines = [title + "\n"]
+        medals = ["👑","🥈","🥉"]
+        for i, (uid, score, corr, wrong) in enumerate(rows, start=1):
+            rank = medals[i-1] if i<=3 else f"{i}."
+            disp = await player_display_name(int(uid))
+            lines.append(f"{rank} <b>{html_escape(disp)}</b>\n    💯 {score} | ✅ {corr} | ❌ {wrong}")
+        text = "\n".join(lines)
+        _rollup_boards.set(key, text)
+    return text
 
 # ---------------- Utilities ----------------
 async def is_owner(event) -> bool:
     return event.sender_id == OWNER_ID
 
+# Admin checks are answered locally: one bulk admin-list fetch per chat (cached with a TTL),
+# falling back to cached per-(chat, user) get_permissions when the list can't be read.
+# Participant/admin-rights updates invalidate both (see on_participant_update).
+_ADMIN_PARTICIPANTS = (types.ChannelParticipantAdmin, types.ChannelParticipantCreator, types.ChatParticipantAdmin, types.ChatParticipantCreator)
+_chat_admins = LRUCache(ADMIN_CACHE_SIZE, ADMIN_CACHE_TTL)   # chat_id -> frozenset of admin user ids
+_admin_perms = LRUCache(ADMIN_CACHE_SIZE, ADMIN_CACHE_TTL)   # (chat_id, user_id) -> bool
+
+async def get_chat_admins(chat_id: int) -> Optional[frozenset]:
+    admins = _chat_admins.get(chat_id)
+    if admins is not None:
+        return admins
+    try:
+        # supergroups honour the admins filter; basic groups return everyone, filtered by participant type
+        ids = set()
+        async for user in client.iter_participants(chat_id, filter=types.ChannelParticipantsAdmins):
+            if isinstance(getattr(user, 'participant', None), _ADMIN_PARTICIPANTS):
+                ids.add(user.id)
+        admins = frozenset(ids)
+    except Exception:
+        return None
+    _chat_admins.set(chat_id, admins)
+    return admins
+
+async def _user_is_admin(chat_id: int, user_id: int) -> bool:
+    admins = await get_chat_admins(chat_id)
+    if admins is not None:
+        return user_id in admins
+    cached = _admin_perms.get((chat_id, user_id))
+    if cached is not None:
+        return cached
+    try:
+        perms = await client.get_permissions(chat_id, user_id)
+        ok = bool(getattr(perms, 'is_admin', False) or getattr(perms, 'is_creator', False))
+    except Exception:
+        return False
+    _admin_perms.set((chat_id, user_id), ok)
+    return ok
+
+def invalidate_admin_cache(chat_id: int, user_id: Optional[int] = None):
+    _chat_admins.pop(chat_id)
+    if user_id is None:
+        _admin_perms.drop_where(lambda k: k[0] == chat_id)
+    else:
+        _admin_perms.pop((chat_id, user_id))
+
 async def is_admin(event) -> bool:
     if not event.is_group:
         return False
-    try:
-        perms = await client.get_permissions(event.chat_id, event.sender_id)
-        if getattr(perms, 'is_admin', False) or getattr(perms, 'is_creator', False):
-            return True
-    except Exception:
-        pass
+    if event.sender_id and await _user_is_admin(event.chat_id, event.sender_id):
+        return True
     # Anonymous admin heuristics
     msg = event.message
     if getattr(msg, 'post_author', None) is not None:
@@ -325,47 +2280,47 @@ def html_escape(s: str) -> str:
     return (s.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;"))
 
 # ---------------- Quiz sending (Telethon poll API) ----------------
+def quiz_poll(q, poll_id: int = 0, close_period: Optional[int] = None, closed: bool = False) -> types.Poll:
+    # q columns: id, question, option_a, option_b, option_c, option_d, correct_answer, category ...
+    text = q[1]; category = q[7]
+    # public_voters: bots only get UpdateMessagePollVote for non-anonymous polls.
+    # Polls can't carry a caption, so the category goes into the question.
+    return types.Poll(
+        id=poll_id,
+        question=f"[{category}] {text}"[:255] if category else text[:255],
+        answers=[types.PollAnswer(text=q[2 + i], option=bytes([65 + i])) for i in range(4)],
+        multiple_choice=False,
+        quiz=True,
+        public_voters=True,
+        close_period=close_period,
+        close_date=None,
+        closed=closed,
+    )
+
+@instrumented
 async def send_quiz_question(group_id: int):
     try:
         active, interval = await get_group_settings(group_id)
         if not active:
             return
-        ap = await get_active_poll(group_id)
-        if ap:
-            try:
-                await client.delete_messages(group_id, ap[2])
-            except Exception:
-                pass
+        ap = get_active_poll(group_id)
+        if ap and SCORING_MODE == "close":
+            # score the previous round first; closed polls stay in the chat
+            if await finalize_poll(ap) is None:
+                print(f"[WARN] {group_id}: previous round not scored yet, skipping this quiz")
+                return
+        elif ap:
+            outbound_background(group_id, PRIO_DELETE, functools.partial(client.delete_messages, group_id, ap.message_id))
             await remove_active_poll(group_id)
         q = await get_next_question(group_id)
         if not q:
             print(f"[WARN] No questions for {group_id}")
             return
-        # q columns: id, question, option_a, option_b, option_c, option_d, correct_answer, category ...
-        qid = q[0]; text = q[1]; a = q[2]; b = q[3]; c = q[4]; d = q[5]; correct = int(q[6]); category = q[7]
-
-        answers = [
-            types.PollAnswer(text=a, option=b"A"),
-            types.PollAnswer(text=b, option=b"B"),
-            types.PollAnswer(text=c, option=b"C"),
-            types.PollAnswer(text=d, option=b"D"),
-        ]
-        correct_byte = bytes([65 + correct])
-        poll = types.Poll(
-            id=0,
-            question=text,
-            answers=answers,
-            multiple_choice=False,
-            quiz=True,
-            public_voters=False,
-            close_date=None,
-            closed=False,
-            correct_answers=[correct_byte],
-            solution=None,
-            solution_entities=None,
-        )
-        caption = f"📚 <b>Quiz Time!</b>\n\n<b>Category:</b> {html_escape(category)}\n\n{html_escape(text)}"
-        updates = await client(functions.messages.SendMediaRequest(peer=group_id, media=types.InputMediaPoll(poll=poll), message=caption, random_id=random.getrandbits(64), parse_mode='html'))
+        qid = q[0]; correct = int(q[6])
+        close_period = poll_close_period(interval) if SCORING_MODE == "close" else None
+        media = types.InputMediaPoll(poll=quiz_poll(q, close_period=close_period), correct_answers=[bytes([65 + correct])])
+        request = functions.messages.SendMediaRequest(peer=group_id, media=media, message="", random_id=random.getrandbits(63))
+        updates = await outbound(group_id, PRIO_POLL, functools.partial(client, request))
         # extract message and poll id
         message_id = None; poll_id = None
         for u in updates.updates:
@@ -377,36 +2332,599 @@ async def send_quiz_question(group_id: int):
             except Exception:
                 continue
         if message_id and poll_id:
-            await store_active_poll(group_id, str(poll_id), qid, message_id)
+            await store_active_poll(group_id, str(poll_id), qid, message_id, correct)
+            _capture("quiz", group=_anon(group_id))
+            if close_period:
+                arm_poll_timer(get_active_poll(group_id), close_period)
         print(f"[OK] Quiz sent to {group_id} msg={message_id}")
     except Exception as e:
         print(f"[ERR] send_quiz_question {group_id}: {e}")
 
-async def schedule_quiz_for_group(group_id: int):
+# ---------------- Quiz scheduler ----------------
+# One task drives a min-heap of (fire_at, group_id) in wall-clock seconds. _sched_due holds
+# each scheduled group's current fire time; heap entries that don't match it are stale
+# (rescheduled or stopped) and are skipped when popped.
+_sched_heap: list[Tuple[float, int]] = []
+_sched_due: dict[int, float] = {}
+_sched_wakeup = asyncio.Event()
+_sched_task: Optional[asyncio.Task] = None
+_send_sem: Optional[asyncio.Semaphore] = None
+_group_tasks: dict[int, asyncio.Task] = {}  # in-flight scheduled sends, at most one per group
+_sched_checkpoint: dict[int, float] = {}     # fire times saved by the last graceful shutdown
+
+def _interval_delay(interval_minutes: int) -> float:
+    base = max(60, int(interval_minutes) * 60)
+    return max(30.0, base + random.uniform(-SCHED_JITTER_SECONDS, SCHED_JITTER_SECONDS))
+
+def schedule_group_at(group_id: int, fire_at: float):
+    _sched_due[group_id] = fire_at
+    heapq.heappush(_sched_heap, (fire_at, group_id))
+    if len(_sched_heap) > 2 * len(_sched_due) + 64:
+        # too many stale entries: rebuild from the live schedule
+        _sched_heap[:] = [(t, g) for g, t in _sched_due.items()]
+        heapq.heapify(_sched_heap)
+    if _sched_heap[0] == (fire_at, group_id):
+        _sched_wakeup.set()
+
+def start_group_quiz_schedule(group_id: int):
+    # send right away and keep going; no-op if the group is already scheduled
+    if group_id in _sched_due:
+        return
+    schedule_group_at(group_id, time.time())
+
+def stop_group_quiz_schedule(group_id: int):
+    _sched_due.pop(group_id, None)
+
+def reschedule_group(group_id: int, interval_minutes: int):
+    # new interval applies now: fire no later than one new interval from now
+    due = _sched_due.get(group_id)
+    if due is None:
+        return
+    schedule_group_at(group_id, min(due, time.time() + _interval_delay(interval_minutes)))
+
+async def _run_scheduled(group_id: int, fire_at: float):
+    try:
+        active, interval = await get_group_settings(group_id)
+        if not active:
+            return
+        schedule_group_at(group_id, time.time() + _interval_delay(interval))
+        if not owns_chat(group_id):
+            return  # our lease lapsed; the next rebalance drops the group if it really moved
+        async with _send_sem:
+            SCHED_LAG_SECONDS.observe(max(0.0, time.time() - fire_at))
+            await send_quiz_question(group_id)
+    except Exception as e:
+        print(f"[ERR] scheduler {group_id}: {e}")
+        if group_id not in _sched_due:
+            schedule_group_at(group_id, time.time() + 300)
+    finally:
+        _group_tasks.pop(group_id, None)
+
+async def _scheduler_loop():
     while True:
+        now = time.time()
+        while _sched_heap and _sched_heap[0][0] <= now:
+            fire_at, gid = heapq.heappop(_sched_heap)
+            if _sched_due.get(gid) != fire_at:
+                continue  # stale entry
+            del _sched_due[gid]
+            if gid in _group_tasks:
+                # previous send still running: skip this round
+                schedule_group_at(gid, now + 60)
+                continue
+            _group_tasks[gid] = asyncio.create_task(_run_scheduled(gid, fire_at))
+        timeout = _sched_heap[0][0] - now if _sched_heap else None
+        _sched_wakeup.clear()
         try:
-            active, interval = await get_group_settings(group_id)
-            if active:
-                await send_quiz_question(group_id)
-            await asyncio.sleep(max(60, int(interval) * 60))
-        except asyncio.CancelledError:
-            break
+            await asyncio.wait_for(_sched_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+async def load_scheduler_state():
+    _sched_checkpoint.clear()
+    for gid, fire_at in await db_fetch("scheduler.all"):
+        _sched_checkpoint[int(gid)] = float(fire_at)
+
+async def save_scheduler_state():
+    # checkpoint our groups' next fire times; owned groups that aren't scheduled lose their row
+    owned = [gid for gid in _group_settings if owns_chat(gid)]
+    async with db_transaction() as conn:
+        await conn.executemany("scheduler.save", [(gid, t) for gid, t in _sched_due.items()])
+        await conn.executemany("scheduler.delete", [(gid,) for gid in owned if gid not in _sched_due])
+    print(f"[SCHED] checkpointed {len(_sched_due)} fire times")
+
+async def start_scheduler():
+    # Schedule every active group (from the settings cache): at its checkpointed fire time if
+    # the last shutdown saved one, else spread over its first interval so restarts don't fire
+    # them all at once. Times that passed while we were down fire within the next minute.
+    global _sched_task, _send_sem
+    _send_sem = asyncio.Semaphore(QUIZ_SEND_CONCURRENCY)
+    now = time.time()
+    resumed = 0
+    for gid, (active, interval) in _group_settings.items():
+        if active and owns_chat(gid):
+            fire_at = _sched_checkpoint.get(gid)
+            if fire_at is None:
+                fire_at = now + random.uniform(0, max(60, interval * 60))
+            else:
+                resumed += 1
+                if fire_at < now:
+                    fire_at = now + random.uniform(0, 60)
+            schedule_group_at(gid, fire_at)
+    _sched_checkpoint.clear()
+    _sched_task = asyncio.create_task(_scheduler_loop())
+    print(f"[SCHED] {len(_sched_due)} groups scheduled ({resumed} from checkpoint)")
+
+async def stop_scheduler():
+    # stop firing, give in-flight sends SHUTDOWN_GRACE to finish, then checkpoint
+    global _sched_task
+    if _sched_task is None:
+        return
+    _sched_task.cancel()
+    _sched_task = None
+    if _group_tasks:
+        _, pending = await asyncio.wait(list(_group_tasks.values()), timeout=SHUTDOWN_GRACE)
+        for t in pending:
+            t.cancel()
+        if pending:
+            print(f"[SCHED] {len(pending)} sends cancelled after {SHUTDOWN_GRACE:.0f}s")
+    try:
+        await save_scheduler_state()
+    except Exception as e:
+        print(f"[ERR] scheduler checkpoint: {e}")
+
+# ---------------- Broadcast jobs ----------------
+# A broadcast is a row in broadcast_jobs. Recipients are read in keyset pages
+# (id > cursor), sent by BROADCAST_WORKERS workers under one shared token bucket, and the
+# cursor/counters are checkpointed after every page, so a restart resumes from the last
+# finished page. Peers that can't be reached until they act (blocked us, deleted, kicked us)
+# go to unreachable_peers and are skipped by later jobs; /start from the user, or /start in
+# a group that re-added us, takes them off. Errors that can pass on their own (an invalid
+# peer, a muted or restricted bot) only count as failed for that job.
+BROADCAST_PHASES = {"users": ("users",), "groups": ("groups",), "all": ("users", "groups")}
+_CURSOR_START = -(1 << 63)
+_UNREACHABLE_ERRORS = (
+    errors.UserIsBlockedError, errors.InputUserDeactivatedError, errors.UserDeactivatedError,
+    errors.ChannelPrivateError, errors.UserBannedInChannelError, errors.ChatIdInvalidError,
+    errors.UserKickedError,
+)
+
+_broadcast_bucket = TokenBucket(BROADCAST_RATE, max(1.0, BROADCAST_RATE))
+_broadcast_tasks: dict[int, asyncio.Task] = {}
+
+async def _broadcast_page(phase: str, cursor: int) -> list:
+    rows = await db_fetch("broadcast.page_" + phase, cursor, BROADCAST_PAGE)
+    return [int(r[0]) for r in rows]
+
+async def mark_unreachable(peer_id: int, reason: str):
+    await db_execute("unreachable.mark", peer_id, reason)
+
+async def _broadcast_send(peer_id: int, text: str) -> str:
+    for _ in range(5):
+        await _broadcast_bucket.acquire()
+        try:
+            await outbound(peer_id, PRIO_BULK, functools.partial(client.send_message, peer_id, text, parse_mode='html'))
+            return "sent"
+        except errors.FloodWaitError as e:
+            print(f"[BCAST] FloodWait {e.seconds}s")
+            _broadcast_bucket.pause(e.seconds + 1)
+        except _UNREACHABLE_ERRORS as e:
+            await mark_unreachable(peer_id, type(e).__name__)
+            return "unreachable"
         except Exception as e:
-            print(f"[ERR] scheduler {group_id}: {e}")
-            await asyncio.sleep(300)
+            print(f"[BCAST] send {peer_id} failed: {e}")
+            return "failed"
+    return "failed"
 
-def start_group_quiz_schedule(group_id: int):
-    if group_id in _group_tasks:
+def _broadcast_status(job: dict, done: bool = False) -> str:
+    head = "✅ <b>Broadcast done</b>" if done else "📢 <b>Broadcasting…</b>"
+    phases = BROADCAST_PHASES[job["target"]]
+    where = "" if done else f"\nPhase: {phases[min(job['phase'], len(phases) - 1)]}"
+    return f"{head} (job {job['job_id']}){where}\nSent: {job['sent']} | Failed: {job['failed']} | Unreachable: {job['unreachable']}"
+
+async def _save_broadcast(job: dict):
+    await db_execute("broadcast.save", job["phase"], job["cursor"], job["sent"], job["failed"], job["unreachable"], job["state"], job["job_id"])
+
+async def _edit_status(job: dict, done: bool = False):
+    if not job["status_msg_id"]:
         return
-    _group_tasks[group_id] = asyncio.create_task(schedule_quiz_for_group(group_id))
+    try:
+        await outbound(job["owner_chat"], PRIO_BULK, functools.partial(client.edit_message, job["owner_chat"], job["status_msg_id"], _broadcast_status(job, done), parse_mode='html'))
+    except Exception as e:
+        print(f"[BCAST] status edit failed: {e}")
 
-def stop_group_quiz_schedule(group_id: int):
-    t = _group_tasks.pop(group_id, None)
-    if t:
+async def run_broadcast(job: dict):
+    phases = BROADCAST_PHASES[job["target"]]
+    last_edit = 0.0
+    try:
+        while job["phase"] < len(phases):
+            if not owns_chat(job["owner_chat"]):
+                print(f"[BCAST] job {job['job_id']} handed off to another worker")
+                return
+            ids = await _broadcast_page(phases[job["phase"]], job["cursor"])
+            if not ids:
+                job["phase"] += 1
+                job["cursor"] = _CURSOR_START
+                await _save_broadcast(job)
+                continue
+            it = iter(ids)
+            async def worker():
+                for peer_id in it:
+                    job[await _broadcast_send(peer_id, job["text"])] += 1
+            await asyncio.gather(*(worker() for _ in range(min(BROADCAST_WORKERS, len(ids)))))
+            job["cursor"] = ids[-1]
+            await _save_broadcast(job)
+            if time.monotonic() - last_edit >= BROADCAST_PROGRESS_SECONDS:
+                last_edit = time.monotonic()
+                await _edit_status(job)
+        job["state"] = "done"
+        await _save_broadcast(job)
+        await _edit_status(job, done=True)
+        print(f"[BCAST] job {job['job_id']} done: sent={job['sent']} failed={job['failed']} unreachable={job['unreachable']}")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"[ERR] broadcast {job['job_id']}: {e}")
+    finally:
+        _broadcast_tasks.pop(job["job_id"], None)
+
+def _start_broadcast_task(job: dict):
+    _broadcast_tasks[job["job_id"]] = asyncio.create_task(run_broadcast(job))
+
+async def create_broadcast(owner_chat: int, status_msg_id: int, text: str, target: str) -> dict:
+    job = {"job_id": int(time.time() * 1000), "owner_chat": owner_chat, "status_msg_id": status_msg_id, "text": text, "target": target,
+           "phase": 0, "cursor": _CURSOR_START, "sent": 0, "failed": 0, "unreachable": 0, "state": "running"}
+    await db_execute("broadcast.create", job["job_id"], owner_chat, status_msg_id, text, target, 0, _CURSOR_START)
+    _start_broadcast_task(job)
+    return job
+
+async def resume_broadcasts():
+    rows = await db_fetch("broadcast.running")
+    rows = [r for r in rows if int(r[0]) not in _broadcast_tasks and owns_chat(r[1])]
+    for r in rows:
+        job = {"job_id": int(r[0]), "owner_chat": r[1], "status_msg_id": r[2], "text": r[3], "target": r[4], "phase": int(r[5]),
+               "cursor": int(r[6]) if r[6] is not None else _CURSOR_START, "sent": int(r[7]), "failed": int(r[8]), "unreachable": int(r[9]), "state": "running"}
+        _start_broadcast_task(job)
+    if rows:
+        print(f"[BCAST] resumed {len(rows)} job(s)")
+
+async def stop_broadcasts():
+    # progress is checkpointed per page; the interrupted page is resent on resume
+    for t in list(_broadcast_tasks.values()):
         t.cancel()
 
+# ---------------- Question import / export ----------------
+# /importq: the uploaded file is downloaded to a temp file and parsed row by row; valid,
+# non-duplicate rows are inserted IMPORT_BATCH at a time (COPY on Postgres, executemany in
+# one transaction on SQLite). /exportq pages the table by id into a temp file.
+def _iter_import_rows(path: str, fmt: str):
+    # yields (line_no, parts or None, error)
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        if fmt == "csv":
+            reader = csv.reader(f)
+            for row in reader:
+                line = reader.line_num
+                if not row or not any(c.strip() for c in row):
+                    continue
+                if line == 1 and row[0].strip().lower() == "question":
+                    continue  # header
+                yield line, row + ["General"] if len(row) == 6 else row, None
+        else:
+            for line, raw in enumerate(f, start=1):
+                if not raw.strip():
+                    continue
+                try:
+                    obj = json.loads(raw)
+                    opts = obj.get("options") or [obj.get("option_a"), obj.get("option_b"), obj.get("option_c"), obj.get("option_d")]
+                    parts = [obj.get("question"), *opts, obj.get("correct_answer", obj.get("correct")), obj.get("category") or "General"]
+                except Exception as e:
+                    yield line, None, f"bad JSON: {e}"
+                    continue
+                yield line, parts, None
+
+async def _insert_questions(batch: list):
+    async with db_transaction() as conn:
+        if USE_POSTGRES:
+            await conn.copy_records_to_table("questions", records=batch, columns=list(QUESTION_COLUMNS))
+        else:
+            await conn.executemany("questions.insert", batch)
+    note_write()
+
+async def import_questions(path: str, fmt: str) -> Tuple[int, int, list]:
+    # returns (accepted, duplicates, [(line, reason), ...])
+    # duplicates within the file are caught by a local set; the bank's set only takes the
+    # hashes of a batch once it has committed, so a failed insert can be retried
+    bank = bank_hashes()
+    seen = set()
+    accepted = dupes = 0
+    rejected = []
+    batch = []
+    for line, parts, err in _iter_import_rows(path, fmt):
+        if err is None:
+            try:
+                row = validate_question(parts)
+            except ValueError as e:
+                err = str(e)
+        if err is not None:
+            rejected.append((line, err))
+            continue
+        h = question_hash(row[:5])
+        if h in seen or h in bank:
+            dupes += 1
+            continue
+        seen.add(h)
+        batch.append(row)
+        if len(batch) >= IMPORT_BATCH:
+            await _insert_questions(batch)
+            bank.update(question_hash(r[:5]) for r in batch)
+            accepted += len(batch); batch = []
+    if batch:
+        await _insert_questions(batch)
+        bank.update(question_hash(r[:5]) for r in batch)
+        accepted += len(batch)
+    await load_question_bank()  # pick up the new ids so decks deal them
+    return accepted, dupes, rejected
+
+async def export_questions(path: str, fmt: str) -> int:
+    count = 0
+    last = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer:
+            writer.writerow(QUESTION_COLUMNS)
+        while True:
+            rows = await db_fetch("questions.page", last, IMPORT_BATCH)
+            if not rows:
+                break
+            for r in rows:
+                if writer:
+                    writer.writerow(r[1:8])
+                else:
+                    f.write(json.dumps(dict(zip(QUESTION_COLUMNS, r[1:8])), ensure_ascii=False) + "\n")
+            count += len(rows)
+            last = rows[-1][0]
+    return count
+
+# ---------------- Runtime profiling ----------------
+# On demand only (/profile N in the owner's PM, or /debug/profile with PROFILE_TOKEN): a
+# cProfile session over the event loop thread for N seconds, loop-lag samples taken every
+# 100ms meanwhile, and a snapshot of the pending tasks at the end. Nothing runs otherwise.
+PROFILE_LAG_INTERVAL = 0.1
+PROFILE_TOP = 40
+_profile_lock = asyncio.Lock()
+
+async def _sample_loop_lag(out: list):
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(PROFILE_LAG_INTERVAL)
+        out.append(loop.time() - t0 - PROFILE_LAG_INTERVAL)
+
+def _task_waiting_on(task: asyncio.Task) -> str:
+    # "outer > inner > Future" await chain of a suspended task, with the innermost line
+    coro = task.get_coro()
+    chain, where = [], ""
+    while coro is not None:
+        chain.append(getattr(coro, "__qualname__", type(coro).__name__))
+        frame = getattr(coro, "cr_frame", None)
+        if frame is not None:
+            where = f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno}"
+        coro = getattr(coro, "cr_await", None)
+    return " > ".join(chain) + (f" ({where})" if where else "")
+
+def _profile_report(seconds: float, prof: cProfile.Profile, lags: list) -> str:
+    out = io.StringIO()
+    out.write(f"NK Quiz Bot profile: {seconds:.0f}s ending {time.strftime('%Y-%m-%d %H:%M:%S')} on {WORKER_ID}\n\n")
+    lags = sorted(lags)
+    out.write(f"== Event loop lag ({len(lags)} samples every {PROFILE_LAG_INTERVAL * 1000:.0f}ms) ==\n")
+    if lags:
+        def pick(q):
+            return lags[min(len(lags) - 1, int(q * len(lags)))] * 1000
+        out.write(f"avg {sum(lags) / len(lags) * 1000:.1f}ms  p50 {pick(0.5):.1f}ms  p95 {pick(0.95):.1f}ms  p99 {pick(0.99):.1f}ms  max {lags[-1] * 1000:.1f}ms\n")
+    tasks = [t for t in asyncio.all_tasks() if not t.done()]
+    kinds = OrderedDict()
+    for t in tasks:
+        name = getattr(t.get_coro(), "__qualname__", "?")
+        kinds[name] = kinds.get(name, 0) + 1
+    out.write(f"\n== Pending tasks ({len(tasks)}) ==\n")
+    for name, n in sorted(kinds.items(), key=lambda kv: -kv[1]):
+        out.write(f"{n:6}  {name}\n")
+    out.write(f"\n== Scheduled sends in flight ({len(_group_tasks)}) ==\n")
+    for gid, t in list(_group_tasks.items())[:50]:
+        out.write(f"{gid}: {_task_waiting_on(t)}\n")
+    out.write(f"\nscheduled groups {len(_sched_due)} | active polls {len(_active_polls)} | vote queue {vote_pipeline_stats()['queue_depth']} | outbound queued {_out_stats['queued']}\n")
+    out.write(f"\n== Top {PROFILE_TOP} functions by cumulative time ==\n")
+    pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    return out.getvalue()
+
+async def profile_runtime(seconds: float) -> str:
+    # one session at a time (the profiler hooks the whole thread)
+    if _profile_lock.locked():
+        raise RuntimeError("a profile is already running")
+    async with _profile_lock:
+        seconds = max(1.0, min(float(seconds), PROFILE_MAX_SECONDS))
+        lags = []
+        sampler = asyncio.create_task(_sample_loop_lag(lags))
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            prof.disable()
+            sampler.cancel()
+        return _profile_report(seconds, prof, lags)
+
+# ---------------- Traffic capture ----------------
+# CAPTURE_PATH set: every poll vote and command reaching the handlers, and every quiz sent,
+# is appended as one JSON line with its offset from capture start, for replay.py.
+# Ids go through a keyed hash (fresh key per process, the owner becomes 1); command
+# arguments are kept only when they're numbers or fixed keywords, never free text.
+CAPTURE_KEYWORDS = {"csv", "jsonl"}
+_capture_file = None
+_capture_t0 = 0.0
+_capture_count = 0
+_capture_key = os.urandom(16)
+
+def _anon(peer_id: Optional[int]) -> Optional[int]:
+    if peer_id is None:
+        return None
+    if OWNER_ID and peer_id == OWNER_ID:
+        return 1
+    h = int.from_bytes(hashlib.blake2b(str(peer_id).encode(), key=_capture_key, digest_size=6).digest(), "big") | 2
+    return -h if peer_id < 0 else h  # sign kept: negative ids are still groups
+
+def _capture(kind: str, **fields):
+    global _capture_count
+    if _capture_file is None:
+        return
+    rec = {"t": round(time.monotonic() - _capture_t0, 4), "k": kind}
+    rec.update(fields)
+    _capture_file.write(json.dumps(rec, separators=(",", ":")) + "\n")
+    _capture_count += 1
+    if _capture_count >= CAPTURE_MAX_EVENTS:
+        print(f"[CAPTURE] {_capture_count} records, limit reached")
+        stop_capture()
+
+def capture_vote(upd, ap):
+    # group is None for votes on polls this process doesn't know (replayed as stale)
+    options = getattr(upd, "options", None) or []
+    _capture("vote", group=_anon(ap.group_id) if ap else None, user=_anon(get_peer_id(upd.peer)),
+             opt=options[0].decode("latin-1") if options else None,
+             ent=1 if (getattr(upd, "_entities", None) or {}).get(get_peer_id(upd.peer)) else 0)
+
+def _capture_text(text: str) -> str:
+    cmd, *args = text.split()
+    if args and not all(a.isdigit() or a in CAPTURE_KEYWORDS for a in args):
+        args = ["_"]  # free text: only its presence is recorded
+    return " ".join([cmd] + args)
+
+async def capture_message(event):
+    if _capture_file is not None and event.raw_text:
+        _capture("msg", chat=_anon(event.chat_id), user=_anon(event.sender_id), text=_capture_text(event.raw_text))
+
+def start_capture():
+    global _capture_file, _capture_t0, _capture_count
+    if not CAPTURE_PATH or _capture_file is not None:
+        return
+    _capture_file = open(CAPTURE_PATH, "a", encoding="utf-8")
+    _capture_t0 = time.monotonic()
+    _capture_count = 0
+    _capture("meta", started=int(time.time()), scoring=SCORING_MODE, poll_close=POLL_CLOSE_SECONDS)
+    print(f"[CAPTURE] recording updates to {CAPTURE_PATH}")
+
+def stop_capture():
+    global _capture_file
+    if _capture_file is None:
+        return
+    f, _capture_file = _capture_file, None
+    f.close()
+    print(f"[CAPTURE] closed {CAPTURE_PATH} ({_capture_count} records)")
+
+if CAPTURE_PATH:
+    # registered ahead of the command handlers below, so it sees each message first
+    client.add_event_handler(capture_message, events.NewMessage(pattern=r"/|(users|groups|all)$"))
+
+# ---------------- Worker sharding ----------------
+# SHARDING=1 (Postgres only): several workers share one database, each logged in with its own
+# session (SESSION_NAME) for the same bot token. Every worker receives every update and acts
+# only on chats it owns. Workers heartbeat a row in worker_leases; the live set (rows fresher
+# than LEASE_TTL by the DB clock) assigns chats by rendezvous hashing, so when a worker joins
+# or dies only its share of chats moves. A worker whose own lease has lapsed (DB unreachable)
+# owns nothing until it renews. Without SHARDING every check below is a no-op.
+_workers: Tuple[Tuple[int, str], ...] = ()  # (hash, worker_id) for each live worker
+_lease_renewed = 0.0                         # monotonic time of our last successful heartbeat
+_lease_task: Optional[asyncio.Task] = None
+
+def _worker_hash(worker_id: str) -> int:
+    return int.from_bytes(hashlib.blake2b(worker_id.encode(), digest_size=8).digest(), "big")
+
+def chat_owner(chat_id: int) -> Optional[str]:
+    if not _workers:
+        return None
+    return max(_workers, key=lambda w: _mix64(w[0] ^ (chat_id & _M64)))[1]
+
+def owns_chat(chat_id) -> bool:
+    if not SHARDING:
+        return True
+    if chat_id is None or time.monotonic() - _lease_renewed > LEASE_TTL:
+        return False
+    return chat_owner(chat_id) == WORKER_ID
+
+async def _heartbeat() -> bool:
+    # renew our lease and read the live set; True if it changed
+    global _workers, _lease_renewed
+    t0 = time.monotonic()
+    async with db_transaction() as conn:
+        await conn.execute("leases.renew", WORKER_ID)
+        await conn.execute("leases.prune", LEASE_TTL * 10)
+        rows = await conn.fetch("leases.live", LEASE_TTL)
+    _lease_renewed = t0
+    live = tuple(sorted((_worker_hash(r[0]), r[0]) for r in rows))
+    changed = live != _workers
+    _workers = live
+    return changed
+
+async def rebalance():
+    # The live set changed: reload per-group state for chats we may have gained (another
+    # worker wrote it), and stop scheduling / polling / broadcasting for chats we lost.
+    await load_group_settings()
+    await load_decks()
+    await load_active_polls()
+    for gid in [g for g in _boards if not owns_chat(g)]:
+        drop_board(gid)
+    for gid in [g for g in _sched_due if not owns_chat(g)]:
+        stop_group_quiz_schedule(gid)
+    now = time.time()
+    for gid, (active, interval) in _group_settings.items():
+        if active and gid not in _sched_due and owns_chat(gid):
+            schedule_group_at(gid, now + random.uniform(0, max(60, interval * 60)))
+    await resume_broadcasts()  # running jobs we lost stop themselves at their next page
+    print(f"[SHARD] {len(_workers)} live worker(s); {len(_sched_due)} groups scheduled here")
+
+async def _lease_loop():
+    while True:
+        await asyncio.sleep(LEASE_HEARTBEAT)
+        try:
+            if await _heartbeat():
+                await rebalance()
+            await refresh_question_bank()
+        except Exception as e:
+            print(f"[ERR] lease heartbeat: {e}")
+
+async def start_sharding():
+    # first heartbeat before anything is scheduled, so startup only loads our share
+    global _lease_task
+    if not SHARDING:
+        return
+    await _heartbeat()
+    print(f"[SHARD] worker {WORKER_ID}: {len(_workers)} live worker(s)")
+    _lease_task = asyncio.create_task(_lease_loop())
+
+async def stop_sharding():
+    # drop our lease so the others take our chats at their next heartbeat, not after LEASE_TTL
+    global _lease_task
+    if _lease_task:
+        _lease_task.cancel()
+        _lease_task = None
+    if SHARDING:
+        try:
+            await db_execute("leases.release", WORKER_ID)
+        except Exception as e:
+            print(f"[ERR] lease release: {e}")
+
+def sharded(handler):
+    # multi-worker mode: only the owner of the chat handles its messages
+    @functools.wraps(handler)
+    async def wrapper(event):
+        if not owns_chat(event.chat_id):
+            return
+        await handler(event)
+    return wrapper
+
 # ---------------- Event Handlers ----------------
 @client.on(events.NewMessage(pattern=r"/start"))
+@sharded
+@instrumented
 async def start_handler(event):
     global BOT_USERNAME
     me = await client.get_me()
@@ -415,8 +2933,9 @@ async def start_handler(event):
         gid = event.chat_id; gname = getattr(event.chat, 'title', 'Group')
         await add_group(gid, gname)
         start_group_quiz_schedule(gid)
-        await event.respond(("🤖 <b>Quiz Bot Enabled!</b>\n\n"
+        await respond(event, ("🤖 <b>Quiz Bot Enabled!</b>\n\n"
                              "• I will send quiz polls periodically.\n"
+                             "• Polls are <b>not anonymous</b>: everyone here can see who picked which answer.\n"
                              "• Default interval: <b>30 minutes</b>. Use <code>/setinterval &lt;min&gt;</code> to change.\n"
                              "• Scoring: <b>+4</b> correct, <b>-1</b> wrong.\n\n"
                              "<b>Admin commands</b> (creator/admins):\n"
@@ -425,188 +2944,329 @@ async def start_handler(event):
                              "<code>/quiznow</code> – send a question now\n"
                              "<code>/setinterval 5..1440</code> – set minutes\n"
                              "<code>/leaderboard</code> – group top 10\n"
+                             "<code>/myrank</code> – your position\n"
+                             "<code>/weekboard</code> – this week's top 10\n"
+                             "<code>/globalboard</code> – top 10 across all groups\n"
                              "<code>/resetboard</code> – clear scores\n"
                             ), parse_mode='html')
     else:
         btns = [[Button.url("➕ Add me to a group", f"https://t.me/{BOT_USERNAME}?startgroup=true")],[Button.inline("📖 Help", data=b"help")]]
         user = await event.get_sender()
         # ensure user stored
-        if USE_POSTGRES:
-            await db_execute("INSERT INTO users (user_id, username, first_name) VALUES ($1,$2,$3) ON CONFLICT (user_id) DO UPDATE SET username=EXCLUDED.username, first_name=EXCLUDED.first_name", user.id, user.username, user.first_name or "")
-        else:
-            await db_execute("INSERT OR REPLACE INTO users (user_id, username, first_name) VALUES (?,?,?)", user.id, user.username, user.first_name or "")
-        await event.respond(("👋 Hi! I run timed quiz polls in groups.\nAdd me to a group and send <code>/start</code> there.\n\nOwner‑only (PM) utilities: /addquestion, /newq, /deleteallq, /questioncount, /broadcast"), buttons=btns, parse_mode='html')
+        await db_execute("users.upsert", user.id, user.username, user.first_name or "")
+        await db_execute("unreachable.clear", user.id)  # unblocked us: back on the broadcast list
+        note_write()
+        _profiles.set(user.id, (user.username, user.first_name or ""))
+        await respond(event, ("👋 Hi! I run timed quiz polls in groups.\nAdd me to a group and send <code>/start</code> there.\n\nOwner‑only (PM) utilities: /addquestion, /newq, /importq, /exportq, /deleteallq, /questioncount, /dbstats, /profile, /broadcast"), buttons=btns, parse_mode='html')
 
 @client.on(events.CallbackQuery(data=b"help"))
+@sharded
+@instrumented
 async def pm_help_cb(event):
     if not event.is_private:
         await event.answer("Open in PM", alert=True)
         return
-    await event.edit(("<b>Help</b>\n\n"
-                      "➕ Add me to a group → press the button above.\n"
-                      "In a group, send <code>/start</code> to enable quizzes.\n\n"
-                      "<b>Group commands</b> (admins):\n"
-                      "• /quizstart, /quizstop, /quiznow\n"
-                      "• /setinterval &lt;5..1440&gt;\n"
-                      "• /leaderboard, /resetboard\n\n"
-                      "<b>Owner (PM)</b>: /addquestion, /newq, /deleteallq, /questioncount, /broadcast <text>"), buttons=[[Button.url("➕ Add to group", f"https://t.me/{(await client.get_me()).username}?startgroup=true")]], parse_mode='html')
+    text = ("<b>Help</b>\n\n"
+            "➕ Add me to a group → press the button above.\n"
+            "In a group, send <code>/start</code> to enable quizzes. Quiz polls are not anonymous:\n"
+            "members can see who picked which answer.\n\n"
+            "<b>Group commands</b> (admins):\n"
+            "• /quizstart, /quizstop, /quiznow\n"
+            "• /setinterval &lt;5..1440&gt;\n"
+            "• /leaderboard, /myrank, /weekboard, /globalboard, /resetboard\n\n"
+            "<b>Owner (PM)</b>: /addquestion, /newq, /importq, /exportq, /deleteallq, /questioncount, /dbstats, /profile [sec], /broadcast <text>")
+    buttons = [[Button.url("➕ Add to group", f"https://t.me/{(await client.get_me()).username}?startgroup=true")]]
+    await outbound(event.chat_id, PRIO_REPLY, functools.partial(event.edit, text, buttons=buttons, parse_mode='html'))
 
 # group-only decorator
 def group_only(handler):
+    @functools.wraps(handler)
     async def wrapper(event):
         if not event.is_group:
-            await event.respond("⚠️ This command works only in groups. Add me to a group and try there.")
+            await respond(event, "⚠️ This command works only in groups. Add me to a group and try there.")
             return
         await handler(event)
     return wrapper
 
 @client.on(events.NewMessage(pattern=r"/quizstop"))
+@sharded
+@instrumented
 @group_only
 async def quiz_stop(event):
     if not await is_admin(event):
-        await event.respond("❌ Only group admins can use this.")
+        await respond(event, "❌ Only group admins can use this.")
         return
     gid = event.chat_id
     await update_group_settings(gid, quiz_active=False)
-    ap = await get_active_poll(gid)
+    stop_group_quiz_schedule(gid)
+    ap = get_active_poll(gid)
     if ap:
-        try:
-            await client.delete_messages(gid, ap[2])
-        except Exception:
-            pass
-        await remove_active_poll(gid)
-    await event.respond("🛑 Quiz stopped. Use /quizstart to resume.")
+        scored = True
+        if SCORING_MODE == "close":
+            try:
+                # score the round before the poll disappears; left for the retry timer if deferred
+                scored = await finalize_poll(ap) is not None
+            except Exception as e:
+                print(f"[ERR] finalize on stop {gid}: {e}")
+        if scored:
+            outbound_background(gid, PRIO_DELETE, functools.partial(client.delete_messages, gid, ap.message_id))
+            await remove_active_poll(gid)
+    await respond(event, "🛑 Quiz stopped. Use /quizstart to resume.")
 
 @client.on(events.NewMessage(pattern=r"/quizstart"))
+@sharded
+@instrumented
 @group_only
 async def quiz_start(event):
     if not await is_admin(event):
-        await event.respond("❌ Only group admins can use this.")
+        await respond(event, "❌ Only group admins can use this.")
         return
     gid = event.chat_id
     await update_group_settings(gid, quiz_active=True)
     start_group_quiz_schedule(gid)
-    await event.respond("✅ Quiz resumed.")
+    await respond(event, "✅ Quiz resumed.")
 
 @client.on(events.NewMessage(pattern=r"/quiznow"))
+@sharded
+@instrumented
 @group_only
 async def quiz_now(event):
     if not await is_admin(event):
-        await event.respond("❌ Only group admins can use this.")
+        await respond(event, "❌ Only group admins can use this.")
         return
     await send_quiz_question(event.chat_id)
 
 @client.on(events.NewMessage(pattern=r"/setinterval (\d+)"))
+@sharded
+@instrumented
 @group_only
 async def set_interval(event):
     if not await is_admin(event):
-        await event.respond("❌ Only group admins can use this.")
+        await respond(event, "❌ Only group admins can use this.")
         return
     try:
         minutes = int(event.pattern_match.group(1))
         if minutes < 5 or minutes > 1440:
-            await event.respond("❌ Interval must be between 5 and 1440 minutes.")
+            await respond(event, "❌ Interval must be between 5 and 1440 minutes.")
             return
         await update_group_settings(event.chat_id, interval_minutes=minutes)
-        await event.respond(f"⏰ Interval set to <b>{minutes}</b> minutes.", parse_mode='html')
+        reschedule_group(event.chat_id, minutes)
+        await respond(event, f"⏰ Interval set to <b>{minutes}</b> minutes.", parse_mode='html')
     except Exception:
-        await event.respond("⚠️ Usage: /setinterval 5..1440")
+        await respond(event, "⚠️ Usage: /setinterval 5..1440")
 
 @client.on(events.NewMessage(pattern=r"/leaderboard"))
+@sharded
+@instrumented
 @group_only
 async def leaderboard(event):
-    rows = await get_group_leaderboard(event.chat_id)
-    if not rows:
-        await event.respond("📊 No players yet. Answer a quiz to get on the board!")
+    text = render_board(await get_board(event.chat_id))
+    if not text:
+        await respond(event, "📊 No players yet. Answer a quiz to get on the board!")
+        return
+    await respond(event, text, parse_mode='html')
+
+@client.on(events.NewMessage(pattern=r"/myrank"))
+@sharded
+@instrumented
+@group_only
+async def my_rank(event):
+    board = await get_board(event.chat_id)
+    rank = board.rank(event.sender_id)
+    if rank is None:
+        await respond(event, "📊 You're not on the board yet. Answer a quiz first!")
         return
-    lines = ["🏆 <b>Group Leaderboard</b>\n"]
-    medals = ["👑","🥈","🥉"]
-    for i, r in enumerate(rows, start=1):
-        uid, uname, fname, score, corr, wrong, cur, mx = r
-        rank = medals[i-1] if i<=3 else f"{i}."
-        disp = f"@{uname}" if uname else (fname or str(uid))
-        streak = f" ({cur}🔥)" if cur>0 else ""
-        lines.append(f"{rank} <b>{html_escape(disp)}</b>{streak}\n    💯 {score} | ✅ {corr} | ❌ {wrong} | 🔥 Max {mx}")
-    await event.respond("\n".join(lines), parse_mode='html')
+    _, _, score, corr, wrong, cur, mx = board.players[event.sender_id]
+    await respond(event, f"📈 You're <b>#{rank}</b> of {len(board.players)}\n💯 {score} | ✅ {corr} | ❌ {wrong} | 🔥 {cur} (max {mx})", parse_mode='html')
+
+@client.on(events.NewMessage(pattern=r"/weekboard"))
+@sharded
+@instrumented
+@group_only
+async def week_board(event):
+    week = epoch_week(time.time())
+    text = await render_rollup_board(("week", event.chat_id, week), "🗓 <b>This Week's Leaderboard</b>", "rollup.week_top", event.chat_id, week)
+    if not text:
+        await respond(event, "📊 Nobody has scored this week yet.")
+        return
+    await respond(event, text, parse_mode='html')
+
+@client.on(events.NewMessage(pattern=r"/globalboard"))
+@sharded
+@instrumented
+async def global_board(event):
+    text = await render_rollup_board(("global",), "🌍 <b>Global Leaderboard</b>", "rollup.global_top")
+    if not text:
+        await respond(event, "📊 No scores yet.")
+        return
+    await respond(event, text, parse_mode='html')
 
 @client.on(events.NewMessage(pattern=r"/resetboard"))
+@sharded
+@instrumented
 @group_only
 async def reset_board(event):
     if not await is_admin(event):
-        await event.respond("❌ Only group admins can use this.")
+        await respond(event, "❌ Only group admins can use this.")
         return
-    if USE_POSTGRES:
-        await db_execute("UPDATE players SET score=0, correct_answers=0, wrong_answers=0, current_streak=0, max_streak=0 WHERE group_id=$1", event.chat_id)
-        await db_execute("DELETE FROM question_usage WHERE group_id=$1", event.chat_id)
-    else:
-        await db_execute("UPDATE players SET score=0, correct_answers=0, wrong_answers=0, current_streak=0, max_streak=0 WHERE group_id=?", event.chat_id)
-        await db_execute("DELETE FROM question_usage WHERE group_id=?", event.chat_id)
-    await event.respond("🔄 Leaderboard reset for this group.")
+    await db_execute("players.reset_group", event.chat_id)
+    note_write(event.chat_id)
+    drop_board(event.chat_id)
+    await reset_question_deck(event.chat_id)
+    await respond(event, "🔄 Leaderboard reset for this group.")
 
 # Owner-only PM decorator
 def owner_pm_only(handler):
+    @functools.wraps(handler)
     async def wrapper(event):
         if not event.is_private:
-            await event.respond("⚠️ PM me to use this command.")
+            await respond(event, "⚠️ PM me to use this command.")
             return
         if not await is_owner(event):
-            await event.respond("❌ Only the bot owner can use this.")
+            await respond(event, "❌ Only the bot owner can use this.")
             return
         await handler(event)
     return wrapper
 
 @client.on(events.NewMessage(pattern=r"/addquestion"))
+@sharded
+@instrumented
 @owner_pm_only
 async def addq_format(event):
-    await event.respond(("📝 <b>Add Question</b>\n\nSend: <code>/newq Question?|A|B|C|D|2|Category</code>\nCorrect index: 0=A,1=B,2=C,3=D"), parse_mode='html')
+    await respond(event, ("📝 <b>Add Question</b>\n\nSend: <code>/newq Question?|A|B|C|D|2|Category</code>\nCorrect index: 0=A,1=B,2=C,3=D"), parse_mode='html')
 
 @client.on(events.NewMessage(pattern=r"(?s)/newq (.+)"))
+@sharded
+@instrumented
 @owner_pm_only
 async def addq(event):
     try:
         payload = event.pattern_match.group(1)
         parts = [p.strip() for p in payload.split("|")]
         if len(parts) != 7:
-            await event.respond("❌ Wrong format. Use /addquestion for help.")
+            await respond(event, "❌ Wrong format. Use /addquestion for help.")
             return
-        q,a,b,c,d,corr,cat = parts
-        corr_i = int(corr)
-        if corr_i not in (0,1,2,3):
-            await event.respond("❌ Correct index must be 0..3")
+        try:
+            q,a,b,c,d,corr_i,cat = validate_question(parts)
+        except ValueError as e:
+            await respond(event, f"❌ {e}")
             return
-        if USE_POSTGRES:
-            await db_execute("INSERT INTO questions (question, option_a, option_b, option_c, option_d, correct_answer, category) VALUES ($1,$2,$3,$4,$5,$6,$7)", q,a,b,c,d,corr_i,cat)
-        else:
-            await db_execute("INSERT INTO questions (question, option_a, option_b, option_c, option_d, correct_answer, category) VALUES (?,?,?,?,?,?,?)", q,a,b,c,d,corr_i,cat)
-        await event.respond("✅ Question added.")
+        row = await db_fetchrow("questions.insert_returning", q,a,b,c,d,corr_i,cat)
+        note_write()
+        _bank_add((row[0], q, a, b, c, d, corr_i, cat))
+        await respond(event, "✅ Question added.")
+    except Exception as e:
+        await respond(event, f"❌ Error: {e}")
+
+@client.on(events.NewMessage(pattern=r"/importq"))
+@sharded
+@instrumented
+@owner_pm_only
+async def importq(event):
+    msg = event.message if event.message.file else (await event.get_reply_message() if event.is_reply else None)
+    if not msg or not msg.file:
+        await respond(event, ("📥 <b>Import questions</b>\n\nSend a <code>.csv</code> or <code>.jsonl</code> file with caption <code>/importq</code> (or reply <code>/importq</code> to it).\n"
+                             "CSV columns: question, option_a, option_b, option_c, option_d, correct_answer (0..3), category\n"
+                             "JSONL keys: the same, or <code>options</code> as a list of 4"), parse_mode='html')
+        return
+    name = (msg.file.name or "").lower()
+    fmt = "csv" if name.endswith(".csv") or msg.file.mime_type == "text/csv" else "jsonl"
+    fd, path = tempfile.mkstemp(suffix="." + fmt)
+    os.close(fd)
+    try:
+        await respond(event, "⏳ Importing…")
+        await client.download_media(msg, file=path)
+        accepted, dupes, rejected = await import_questions(path, fmt)
+        lines = [f"✅ Import done. Accepted: {accepted} | Duplicates: {dupes} | Rejected: {len(rejected)}"]
+        lines += [f"line {ln}: {why}" for ln, why in rejected[:20]]
+        if len(rejected) > 20:
+            lines.append(f"… and {len(rejected) - 20} more")
+        await respond(event, "\n".join(lines))
+    except Exception as e:
+        await respond(event, f"❌ Import failed: {e}")
+    finally:
+        os.remove(path)
+
+@client.on(events.NewMessage(pattern=r"/exportq(?: (csv|jsonl))?$"))
+@sharded
+@instrumented
+@owner_pm_only
+async def exportq(event):
+    fmt = event.pattern_match.group(1) or "csv"
+    fd, path = tempfile.mkstemp(prefix="questions_", suffix="." + fmt)
+    os.close(fd)
+    try:
+        count = await export_questions(path, fmt)
+        await outbound(event.chat_id, PRIO_REPLY, functools.partial(client.send_file, event.chat_id, path, caption=f"📤 {count} questions"))
+    except Exception as e:
+        await respond(event, f"❌ Export failed: {e}")
+    finally:
+        os.remove(path)
+
+@client.on(events.NewMessage(pattern=r"/profile(?: (\d+))?$"))
+@sharded
+@instrumented
+@owner_pm_only
+async def profile_cmd(event):
+    seconds = min(int(event.pattern_match.group(1) or 30), PROFILE_MAX_SECONDS)
+    if _profile_lock.locked():
+        await respond(event, "⚠️ A profile is already running.")
+        return
+    await respond(event, f"⏳ Profiling for {seconds}s…")
+    fd, path = tempfile.mkstemp(prefix="profile_", suffix=".txt")
+    os.close(fd)
+    try:
+        report = await profile_runtime(seconds)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(report)
+        await outbound(event.chat_id, PRIO_REPLY, functools.partial(client.send_file, event.chat_id, path, caption=f"🩺 {seconds}s profile"))
     except Exception as e:
-        await event.respond(f"❌ Error: {e}")
+        await respond(event, f"❌ Profile failed: {e}")
+    finally:
+        os.remove(path)
 
 @client.on(events.NewMessage(pattern=r"/deleteallq"))
+@sharded
+@instrumented
 @owner_pm_only
 async def delete_all_q(event):
-    if USE_POSTGRES:
-        await db_execute("DELETE FROM questions")
-        await db_execute("DELETE FROM question_usage")
-    else:
-        await db_execute("DELETE FROM questions")
-        await db_execute("DELETE FROM question_usage")
-    await event.respond("🗑️ All questions deleted.")
+    await clear_question_bank()
+    await respond(event, "🗑️ All questions deleted.")
 
 @client.on(events.NewMessage(pattern=r"/questioncount"))
+@sharded
+@instrumented
 @owner_pm_only
 async def qcount(event):
-    row = await db_fetchrow("SELECT COUNT(*) FROM questions" if USE_POSTGRES else "SELECT COUNT(*) FROM questions")
+    row = await db_fetchrow("questions.count")
     count = int(row[0]) if row else 0
-    await event.respond(f"📊 Total questions: {count}")
+    await respond(event, f"📊 Total questions: {count}")
+
+@client.on(events.NewMessage(pattern=r"/dbstats"))
+@sharded
+@instrumented
+@owner_pm_only
+async def db_stats(event):
+    lines = ["🗄 <b>DB pool</b>\n"] + [f"<b>{k}</b>: {v}" for k, v in db_pool_stats().items()]
+    lines += ["\n🗳 <b>Vote queue</b>\n"] + [f"<b>{k}</b>: {v}" for k, v in vote_pipeline_stats().items()]
+    lines += ["\n📚 <b>Answer rollups</b>\n"] + [f"<b>{k}</b>: {v}" for k, v in _rollup_stats.items()]
+    lines += ["\n📤 <b>Outbound</b>\n"] + [f"<b>{k}</b>: {v}" for k, v in outbound_stats().items()]
+    lines += ["\n⚙️ <b>Settings cache</b>\n"] + [f"<b>{k}</b>: {v}" for k, v in settings_cache_stats().items()]
+    lines += ["\n👤 <b>Profile cache</b>\n"] + [f"<b>{k}</b>: {v}" for k, v in _profiles.stats().items()]
+    lines += ["\n🛡 <b>Admin cache</b>\n"] + [f"<b>lists {k}</b>: {v}" for k, v in _chat_admins.stats().items()] + [f"<b>perms {k}</b>: {v}" for k, v in _admin_perms.stats().items()]
+    await respond(event, "\n".join(lines), parse_mode='html')
 
 @client.on(events.NewMessage(pattern=r"(?s)/broadcast (.+)"))
+@sharded
+@instrumented
 @owner_pm_only
 async def broadcast_prep(event):
     msg = event.pattern_match.group(1)
-    await event.respond(f"📢 <b>Broadcast preview</b>:\n\n{html_escape(msg)}\n\nReply: <code>users</code> | <code>groups</code> | <code>all</code>", parse_mode='html')
+    await respond(event, f"📢 <b>Broadcast preview</b>:\n\n{html_escape(msg)}\n\nReply: <code>users</code> | <code>groups</code> | <code>all</code>", parse_mode='html')
 
 @client.on(events.NewMessage(pattern=r"^(users|groups|all)$"))
+@sharded
+@instrumented
 async def broadcast_do(event):
     if not event.is_reply or not event.is_private or not await is_owner(event):
         return
@@ -617,100 +3277,265 @@ async def broadcast_do(event):
     try:
         text = replied.text.split("\n\n",2)[1]
     except Exception:
-        await event.respond("❌ Couldn't parse preview.")
+        await respond(event, "❌ Couldn't parse preview.")
         return
-    sent = failed = 0
-    if target in ("users","all"):
-        for uid in await get_all_users():
-            try:
-                await client.send_message(uid, text, parse_mode='html')
-                sent += 1
-                await asyncio.sleep(0.08)
-            except Exception:
-                failed += 1
-    if target in ("groups","all"):
-        for gid in await get_all_groups():
-            try:
-                await client.send_message(gid, text, parse_mode='html')
-                sent += 1
-                await asyncio.sleep(0.08)
-            except Exception:
-                failed += 1
-    await event.respond(f"✅ Broadcast done. Sent: {sent} | Failed: {failed}")
+    status = await respond(event, "📢 <b>Broadcast queued…</b>", parse_mode='html')
+    job = await create_broadcast(event.chat_id, status.id, text, target)
+    print(f"[BCAST] job {job['job_id']} started ({target})")
+
+# Participant / admin-rights changes: drop cached admin state for the chat
+@client.on(events.Raw(types=[types.UpdateChannelParticipant, types.UpdateChatParticipantAdmin, types.UpdateChatParticipant, types.UpdateChatParticipants]))
+@instrumented
+async def on_participant_update(upd):
+    if isinstance(upd, types.UpdateChannelParticipant):
+        invalidate_admin_cache(get_peer_id(types.PeerChannel(upd.channel_id)), upd.user_id)
+    elif isinstance(upd, types.UpdateChatParticipants):
+        invalidate_admin_cache(get_peer_id(types.PeerChat(upd.participants.chat_id)))
+    else:
+        invalidate_admin_cache(get_peer_id(types.PeerChat(upd.chat_id)), upd.user_id)
+
+@client.on(events.ChatAction)
+@instrumented
+async def on_chat_action(event):
+    if event.user_joined or event.user_added or event.user_left or event.user_kicked:
+        for uid in event.user_ids or [None]:
+            invalidate_admin_cache(event.chat_id, uid)
 
 # Poll vote updates handler
 @client.on(events.Raw(types=[types.UpdateMessagePollVote]))
+@instrumented
 async def on_poll_vote(event_raw):
     try:
         upd = event_raw
-        user_id = upd.user_id
-        msg_id = upd.msg_id
-        peer = upd.peer
-        # get peer chat id
-        group_id = get_peer_id(peer)
-        ap = await get_active_poll(group_id)
-        if not ap:
-            return
-        stored_poll_id, qid, message_id = ap
-        if message_id != msg_id:
-            return
-        try:
-            user = await client.get_entity(user_id)
-            username = user.username
-            first_name = user.first_name or ""
-        except Exception:
-            username = None; first_name = 'User'
-        await add_or_update_player(user_id, group_id, username, first_name)
-        row = await db_fetchrow("SELECT correct_answer FROM questions WHERE id=$1" if USE_POSTGRES else "SELECT correct_answer FROM questions WHERE id=?", qid)
-        if not row:
-            return
-        correct_idx = int(row[0])
-        correct_byte = bytes([65 + correct_idx])
+        ap = find_active_poll(upd.poll_id)
+        if _capture_file is not None:
+            capture_vote(upd, ap)
+        if not ap or not owns_chat(ap.group_id):
+            return  # stale, unknown or another worker's poll: dropped without touching the DB
+        user_id = get_peer_id(upd.peer)  # the voter
+        group_id = ap.group_id
+        correct_byte = bytes([65 + ap.correct_answer])
         selected = None
         if getattr(upd, 'options', None):
             selected = upd.options[0]
         if selected is None:
+            return  # retraction: quiz answers are final, the first one stays scored
+        entity = (getattr(upd, '_entities', None) or {}).get(user_id)
+        if SCORING_MODE == "close":
+            note_poll_vote(ap, user_id, selected, entity)
             return
-        is_correct = (selected == correct_byte)
-        points = 4 if is_correct else -1
-        await update_player_score(user_id, group_id, points, is_correct)
+        # redelivered update (reconnect, getDifference catch-up): dropped before any DB work.
+        # Marked before the first await so two copies arriving together can't both pass, and
+        # unmarked if this copy never reaches the queue, so a redelivery can still score it.
+        voters = _poll_voters.setdefault(ap.poll_id, set())
+        if user_id in voters:
+            _vote_stats["duplicates"] += 1
+            return
+        voters.add(user_id)
+        queued = False
+        try:
+            username, first_name, changed = await resolve_voter_profile(entity, user_id, group_id)
+            queued = await submit_vote(Vote(user_id, group_id, username, first_name, selected == correct_byte, changed, ap.poll_id))
+        finally:
+            if not queued:
+                voters.discard(user_id)
     except Exception as e:
         print(f"[ERR] poll vote: {e}")
 
-# ---------------- Flask keep-alive ----------------
-app = Flask(__name__)
-@app.get('/')
-def root():
-    return 'Quiz Bot is running!'
-@app.get('/health')
-def health():
-    return {'ok': True, 'time': datetime.utcnow().isoformat()}
+# ---------------- Web server (health / status / metrics) ----------------
+# Runs on the bot's own event loop, so the checks see live client, pool and scheduler state.
+# /health: process is serving. /ready: Telegram connected, DB answers, scheduler on time.
+_BOOT_TIME = time.time()
+_web_runner = None
+
+def scheduler_overdue() -> float:
+    # seconds the earliest due entry has been waiting; grows only if the loop is stuck or starved
+    if not _sched_heap:
+        return 0.0
+    return max(0.0, time.time() - _sched_heap[0][0])
+
+async def _db_ping():
+    async with db_conn() as conn:
+        await conn.fetchval("ping")
+
+async def readiness() -> dict:
+    checks = {"telegram": client.is_connected()}
+    try:
+        # timeout covers waiting for a connection too (a wedged pool is not ready)
+        await asyncio.wait_for(_db_ping(), READY_DB_TIMEOUT)
+        checks["db"] = True
+    except Exception as e:
+        checks["db"] = False
+        checks["db_error"] = str(e) or type(e).__name__
+    lag = scheduler_overdue()
+    checks["scheduler"] = _sched_task is not None and not _sched_task.done() and lag <= READY_MAX_SCHED_LAG
+    checks["scheduler_overdue_s"] = round(lag, 3)
+    checks["ok"] = checks["telegram"] and checks["db"] and checks["scheduler"]
+    return checks
+
+async def web_root(request):
+    return web.Response(text='Quiz Bot is running!')
+
+async def web_health(request):
+    return web.json_response({'ok': True, 'uptime_s': round(time.time() - _BOOT_TIME, 1)})
+
+async def web_ready(request):
+    checks = await readiness()
+    return web.json_response(checks, status=200 if checks["ok"] else 503)
 
-def run_web():
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 10000)))
+async def web_status(request):
+    return web.json_response({
+        'uptime_s': round(time.time() - _BOOT_TIME, 1),
+        'telegram_connected': client.is_connected(),
+        'groups_cached': len(_group_settings),
+        'groups_scheduled': len(_sched_due),
+        'sends_in_flight': len(_group_tasks),
+        'scheduler_overdue_s': round(scheduler_overdue(), 3),
+        'active_polls': len(_active_polls),
+        'questions': len(_question_ids),
+        'broadcasts_running': len(_broadcast_tasks),
+        'vote_queue': vote_pipeline_stats(),
+        'outbound': outbound_stats(),
+        'db_pool': db_pool_stats(),
+        'worker': {'id': WORKER_ID, 'live_workers': len(_workers)} if SHARDING else None,
+    })
+
+async def web_metrics(request):
+    return web.Response(body=render_metrics().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def web_profile(request):
+    # only routed when PROFILE_TOKEN is set
+    supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(supplied.encode(), PROFILE_TOKEN.encode()):
+        raise web.HTTPForbidden()
+    try:
+        seconds = float(request.query.get("seconds", 30))
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds must be a number")
+    try:
+        report = await profile_runtime(seconds)
+    except RuntimeError as e:
+        raise web.HTTPConflict(text=str(e))
+    return web.Response(text=report)
+
+async def start_web():
+    global _web_runner
+    app = web.Application()
+    app.router.add_get('/', web_root)
+    app.router.add_get('/health', web_health)
+    app.router.add_get('/ready', web_ready)
+    app.router.add_get('/status', web_status)
+    app.router.add_get('/metrics', web_metrics)
+    if PROFILE_TOKEN:
+        app.router.add_get('/debug/profile', web_profile)
+    _web_runner = web.AppRunner(app, access_log=None)
+    await _web_runner.setup()
+    await web.TCPSite(_web_runner, '0.0.0.0', WEB_PORT).start()
+    print(f'[WEB] serving on :{WEB_PORT}')
+
+async def stop_web():
+    global _web_runner
+    if _web_runner is not None:
+        await _web_runner.cleanup()
+        _web_runner = None
 
 async def keep_alive():
     if not KEEPALIVE_URL:
         return
-    while True:
-        try:
-            async with aiohttp.ClientSession() as sess:
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as sess:
+        while True:
+            try:
                 async with sess.get(KEEPALIVE_URL) as resp:
-                    _ = await resp.text()
-            print('[PING] keep-alive sent')
-        except Exception as e:
-            print(f'[PING] failed: {e}')
-        await asyncio.sleep(KEEPALIVE_INTERVAL)
+                    await resp.read()
+                print('[PING] keep-alive sent')
+            except Exception as e:
+                print(f'[PING] failed: {e}')
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
 
 # ---------------- Main ----------------
+async def _timed(timings: dict, name: str, coro):
+    t0 = time.perf_counter()
+    await coro
+    timings[name] = time.perf_counter() - t0
+
+async def start_services():
+    # schema and ownership first, then every cache at once, then the loops that read them
+    t0 = time.perf_counter()
+    timings = {}
+    await _timed(timings, "db", init_db())
+    await _timed(timings, "sharding", start_sharding())
+    await asyncio.gather(
+        _timed(timings, "settings", load_group_settings()),
+        _timed(timings, "polls", load_active_polls()),
+        _timed(timings, "questions", load_question_bank()),
+        _timed(timings, "decks", load_decks()),
+        _timed(timings, "checkpoint", load_scheduler_state()),
+        _timed(timings, "boards", warm_boards()),
+    )
+    await start_vote_pipeline()
+    await start_outbound()
+    await start_rollups()
+    start_capture()
+    await _timed(timings, "scheduler", start_scheduler())
+    await _timed(timings, "broadcasts", resume_broadcasts())
+    breakdown = ", ".join(f"{k} {v * 1000:.0f}ms" for k, v in timings.items())
+    print(f"[BOOT] services up in {(time.perf_counter() - t0) * 1000:.0f}ms ({breakdown})")
+
+async def stop_services():
+    # idempotent: shutdown() runs the Telegram-bound steps before disconnecting
+    await stop_broadcasts()
+    await stop_scheduler()
+    await stop_poll_timers()
+    await stop_outbound()
+    await stop_vote_pipeline()
+    await stop_rollups()
+    await stop_sharding()
+    await close_db()
+    stop_capture()
+
+_shutdown_task: Optional[asyncio.Task] = None
+
+async def _shutdown(reason: str):
+    # Stop serving, let scheduled sends and poll closes finish while Telegram is still up,
+    # disconnect (no more votes arrive), then drain the vote queue and close the DB
+    print(f"[BOT] {reason}: shutting down")
+    t0 = time.perf_counter()
+    await stop_web()
+    await stop_broadcasts()
+    await stop_scheduler()
+    await stop_poll_timers()
+    await stop_outbound()
+    if client.is_connected():
+        await client.disconnect()
+    await stop_services()
+    print(f"[BOT] shutdown done in {(time.perf_counter() - t0) * 1000:.0f}ms")
+
+def request_shutdown(reason: str) -> asyncio.Task:
+    global _shutdown_task
+    if _shutdown_task is None:
+        _shutdown_task = asyncio.ensure_future(_shutdown(reason))
+    return _shutdown_task
+
 if __name__ == '__main__':
+    t_start = time.perf_counter()
+    client.start(bot_token=BOT_TOKEN)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(init_db())
+    t_login = time.perf_counter()
+    loop.run_until_complete(start_services())
     print('[DB] init done')
-    multiprocessing.Process(target=run_web, daemon=True).start()
-    print('[WEB] flask started')
+    loop.run_until_complete(start_web())
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, request_shutdown, sig.name)
+        except NotImplementedError:
+            pass  # no loop signal handlers on Windows; Ctrl+C still lands in the finally below
     # start keepalive
     if KEEPALIVE_URL:
         client.loop.create_task(keep_alive())
+    print(f"[BOOT] ready in {(time.perf_counter() - t_start) * 1000:.0f}ms (telegram login {(t_login - t_start) * 1000:.0f}ms)")
     print('[BOT] starting...')
-    client.run_until_disconnected()
\ No newline at end of file
+    try:
+        client.run_until_disconnected()
+    finally:
+        loop.run_until_complete(request_shutdown("disconnected"))
+        print('[DB] closed')
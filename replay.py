@@ -0,0 +1,192 @@
+# replay.py — replay a captured update log (CAPTURE_PATH in main.py) against a local DB
+# Feeds the recorded quiz sends, poll votes and commands through the real handlers, with
+# bench.py's stand-in client and instrumentation, either at the recorded pace (--speed 1,
+# 2 = twice as fast) or as fast as the handlers take them (--speed 0). The same log gives
+# the same input on every version of the bot, so saved results compare like for like.
+#
+#   CAPTURE_PATH=capture.jsonl python main.py        # record in production / staging
+#   python replay.py capture.jsonl --speed 0 --save bench_results/replay_base.json
+#   python replay.py capture.jsonl --speed 0 --compare bench_results/replay_base.json
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+from collections import Counter
+from contextlib import redirect_stdout
+
+import bench
+
+def load_log(path: str):
+    meta, records = {}, []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            if rec["k"] == "meta":
+                meta = meta or rec  # appended captures: the first header wins, offsets restart
+                continue
+            records.append(rec)
+    return meta, records
+
+def command_handlers():
+    # (compiled pattern, pattern string, handler) for every NewMessage handler on the real client
+    main = bench.main
+    handlers = []
+    for callback, event in main.client.list_event_handlers():
+        if isinstance(event, main.events.NewMessage) and event.pattern and callback is not main.capture_message:
+            regex = event.pattern.__self__
+            handlers.append((regex, regex.pattern, callback))
+    return handlers
+
+async def seed(records: list, questions: int):
+    # the groups seen in the log, and a question bank, so quiz sends and boards have rows
+    main = bench.main
+    groups = sorted({r["group"] for r in records if r["k"] == "quiz" and r.get("group")})
+    await bench.seed_db(groups, questions, "Replay")
+    # quizzes come from the log only, never from the scheduler
+    for g in list(main._sched_due):
+        main.stop_group_quiz_schedule(g)
+
+async def replay(args, fake: bench.FakeClient, records: list) -> dict:
+    main = bench.main
+    types = main.types
+    on_vote = bench.timed("on_poll_vote", main.on_poll_vote)
+    counts = Counter()
+    pending = set()
+    quiz_tasks = {}  # group -> its latest quiz send; resolves to the poll that send opened
+
+    def spawn(coro):
+        t = asyncio.create_task(coro)
+        pending.add(t)
+        t.add_done_callback(pending.discard)
+        return t
+
+    async def quiz(group, prev):
+        # one group's quizzes land in recorded order, whatever the pace
+        if prev is not None:
+            await asyncio.wait([prev])
+        await main.send_quiz_question(group)
+        return main.get_active_poll(group)
+
+    async def vote(rec):
+        # bound to the poll of the quiz recorded before it, even if a later one has landed
+        sent = quiz_tasks.get(rec["group"])
+        ap = await sent if sent is not None else None
+        uid = rec["user"]
+        option = (rec.get("opt") or "").encode("latin-1")
+        if ap is None:
+            counts["stale_votes"] += 1
+            poll_id = random.getrandbits(62)
+        else:
+            poll_id = int(ap.poll_id)
+            if option:
+                fake.poll_votes[(ap.group_id, ap.message_id)].setdefault(uid, option)
+        upd = types.UpdateMessagePollVote(poll_id=poll_id, peer=types.PeerUser(uid), options=[option] if option else [], qts=0)
+        if rec.get("ent"):
+            upd._entities = {uid: types.User(id=uid, username=f"user{uid}", first_name=f"User {uid}")}
+        await on_vote(upd)
+
+    def fire(rec):
+        kind = rec["k"]
+        counts[kind] += 1
+        if kind == "quiz":
+            quiz_tasks[rec["group"]] = spawn(quiz(rec["group"], quiz_tasks.get(rec["group"])))
+        elif kind == "vote":
+            spawn(vote(rec))
+        elif kind == "msg":
+            matched = False
+            for regex, pattern, handler in args.handlers:
+                if regex.match(rec["text"]):
+                    matched = True
+                    op = bench.timed(f"cmd {rec['text'].split()[0]}", handler)  # same op names as bench.py
+                    spawn(op(bench.FakeEvent(fake, rec["chat"], rec["user"], rec["text"], pattern)))
+            if not matched:
+                counts["unmatched_msgs"] += 1
+
+    loop = asyncio.get_running_loop()
+    t0 = time.perf_counter()
+    start = loop.time()
+    first = records[0]["t"] if records else 0.0
+    for rec in records:
+        if args.speed > 0:
+            delay = start + (rec["t"] - first) / args.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif len(pending) >= args.max_inflight:
+            # as fast as possible, but bounded; votes still wait for their group's quiz to land
+            await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        fire(rec)
+    if pending:
+        await asyncio.wait(pending)
+    elapsed = time.perf_counter() - t0
+    events = sum(counts[k] for k in ("quiz", "vote", "msg"))
+    return {"elapsed_s": round(elapsed, 3), "events": events, "events_per_s": round(events / elapsed, 1),
+            "recorded_s": round(records[-1]["t"] - records[0]["t"], 3) if records else 0.0, **counts}
+
+async def run(args, records: list) -> dict:
+    main = bench.main
+    args.handlers = command_handlers()
+    fake = bench.FakeClient(args.rpc_ms, admin_id=1)
+    main.client = fake
+    bench.instrument()
+    log = io.StringIO()
+    with redirect_stdout(log if args.quiet else sys.stdout):
+        await main.start_services()
+        await seed(records, args.questions)
+        load = await replay(args, fake, records)
+        await main.stop_services()
+        pipeline = main.vote_pipeline_stats()
+        outbound = main.outbound_stats()
+    del args.handlers  # not JSON, and not part of the run's parameters
+    result = bench.summarize(args, load, fake, pipeline)
+    result["outbound"] = outbound
+    return result
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Replay a captured update log through the quiz bot handlers")
+    p.add_argument("log", help="JSONL written by main.py with CAPTURE_PATH set")
+    p.add_argument("--speed", type=float, default=1.0, help="pace multiplier: 1 = as recorded, 0 = as fast as possible")
+    p.add_argument("--max-inflight", type=int, default=500, help="--speed 0: events in flight before waiting for one to finish")
+    p.add_argument("--questions", type=int, default=2000, help="question bank size")
+    p.add_argument("--rpc-ms", type=float, default=20.0, help="simulated Telegram RPC latency")
+    p.add_argument("--postgres", metavar="URL", help="use this (scratch!) Postgres database instead of a temp SQLite file")
+    p.add_argument("--scoring", choices=("vote", "close"), help="SCORING_MODE to replay with (default: the one recorded)")
+    p.add_argument("--rate-limits", action="store_true", help="keep the outbound dispatcher's Telegram rate limits (off by default)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--save", metavar="PATH", help="write results JSON here")
+    p.add_argument("--compare", metavar="PATH", help="baseline JSON to diff against")
+    p.add_argument("--verbose", dest="quiet", action="store_false", help="show the bot's own log lines")
+    return p.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    random.seed(args.seed)
+    meta, records = load_log(args.log)
+    if not records:
+        sys.exit(f"{args.log}: no records")
+    args.scoring = args.scoring or meta.get("scoring", "vote")
+    args.interval = meta.get("poll_close", 600)  # bench.setup_env derives POLL_CLOSE_SECONDS from it
+    os.environ.pop("CAPTURE_PATH", None)  # never capture the replay itself
+    tmpdir = bench.setup_env(args)
+    try:
+        result = asyncio.run(run(args, records))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)  # the temp SQLite DB
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    bench.print_report(result, baseline)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"saved {args.save}")